@@ -0,0 +1,416 @@
+"""音楽機能の負荷試験ハーネス
+
+Discord には接続せず、偽の VoiceClient / チャンネルとローカル HTTP 音声サーバーを
+使って N ギルド分の再生と操作 (cmd_play / cmd_queue / seek / skip など) を同時に
+走らせ、次を計測する。
+
+- イベントループの遅延 (p50 / p99 / 最大)
+- 1 ストリームあたりの CPU 使用率 (Python 側 + ffmpeg 子プロセス)
+- 1 ギルドあたりのメモリ増加量 (RSS)
+- Discord へのメッセージ送信・編集レート
+
+再生には本物の ffmpeg を使うので PATH に ffmpeg が必要。
+
+使い方::
+
+    python -m discordbot.bench_music --guilds 50 --duration 60
+"""
+from __future__ import annotations
+
+import argparse
+import array
+import asyncio
+import itertools
+import math
+import os
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import wave
+from types import SimpleNamespace
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import discord
+from aiohttp import web
+
+from . import bot
+
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+SAMPLE_RATE = discord.opus.Encoder.SAMPLING_RATE
+
+
+class Bench:
+    """計測値と設定の入れ物"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.sends = 0
+        self.edits = 0
+        self.deletes = 0
+        self.frames = 0
+        self.commands = 0
+        self.errors = 0
+        self.lag: list[float] = []
+        self.ids = itertools.count(1)
+        self.user = SimpleNamespace(id=0, bot=True, name="bench", display_name="bench")
+
+    async def api_call(self) -> None:
+        """Discord REST の往復を模した待ち"""
+        if self.args.api_latency:
+            await asyncio.sleep(self.args.api_latency)
+
+
+# ──────────── 偽 Discord オブジェクト ────────────
+class FakeMessage:
+    def __init__(self, bench: Bench, guild: "FakeGuild", author, content: str = ""):
+        self.bench = bench
+        self.id = next(bench.ids)
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = author
+        self.content = content
+        self.attachments: list = []
+        self.reference = None
+        self.mentions: list = []
+
+    async def edit(self, **kwargs):
+        self.bench.edits += 1
+        await self.bench.api_call()
+        return self
+
+    async def delete(self):
+        self.bench.deletes += 1
+        await self.bench.api_call()
+
+    async def reply(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    async def add_reaction(self, emoji):
+        await self.bench.api_call()
+
+
+class FakeTextChannel:
+    def __init__(self, bench: Bench, guild: "FakeGuild"):
+        self.bench = bench
+        self.guild = guild
+
+    async def send(self, *args, **kwargs):
+        self.bench.sends += 1
+        await self.bench.api_call()
+        return FakeMessage(self.bench, self.guild, self.bench.user)
+
+
+class FakeVoiceChannel:
+    def __init__(self, bench: Bench, guild: "FakeGuild"):
+        self.bench = bench
+        self.guild = guild
+        self.members: list = []
+
+    async def connect(self, *, self_deaf: bool = True, cls=None):
+        await asyncio.sleep(self.bench.args.connect_delay)
+        vc = FakeVoiceClient(self.bench, self)
+        self.guild.voice_client = vc
+        return vc
+
+
+class FakeVoiceClient:
+    """discord.VoiceClient の代わり。AudioPlayer と同じく 20ms ごとに read() する"""
+
+    def __init__(self, bench: Bench, channel: FakeVoiceChannel):
+        self.bench = bench
+        self.channel = channel
+        self.guild = channel.guild
+        self._connected = True
+        self._source = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._source is not None and self._resumed.is_set()
+
+    def is_paused(self) -> bool:
+        return self._source is not None and not self._resumed.is_set()
+
+    def play(self, source, *, after=None):
+        if self._source is not None:
+            raise discord.ClientException("Already playing audio.")
+        self._source = source
+        self._stop = threading.Event()
+        self._resumed.set()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._stop), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stop: threading.Event):
+        error = None
+        try:
+            start = time.perf_counter()
+            loops = 0
+            while not stop.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    start = time.perf_counter()
+                    loops = 0
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                self.bench.frames += 1
+                loops += 1
+                delay = start + loops * FRAME_SECONDS - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            self._source = None
+            source.cleanup()
+            if after is not None:
+                after(error)
+
+    def stop(self):
+        self._stop.set()
+        self._resumed.set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected = False
+        self.guild.voice_client = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, 5)
+
+
+class FakeGuild:
+    def __init__(self, bench: Bench, gid: int):
+        self.id = gid
+        self.voice_client: FakeVoiceClient | None = None
+        self.text_channel = FakeTextChannel(bench, self)
+        self.voice_channel = FakeVoiceChannel(bench, self)
+        self.member = SimpleNamespace(
+            id=10_000 + gid, bot=False, name=f"user{gid}", display_name=f"user{gid}",
+            voice=SimpleNamespace(channel=self.voice_channel),
+        )
+        self.voice_channel.members.append(self.member)
+
+
+# ──────────── ローカル音声サーバー ────────────
+def make_tone(path: str, seconds: int) -> None:
+    """440Hz のステレオ 16bit WAV を書き出す"""
+    period = [int(8000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE)) for i in range(SAMPLE_RATE // 440 * 4)]
+    frames = array.array("h", itertools.chain.from_iterable((s, s) for s in period))
+    loops = math.ceil(seconds * SAMPLE_RATE / len(period))
+    with wave.open(path, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        data = frames.tobytes()
+        for _ in range(loops):
+            w.writeframes(data)
+
+
+async def start_audio_server(path: str) -> tuple[web.AppRunner, int]:
+    """Range 対応の静的ファイルサーバーを立てる (FileResponse が Range を処理する)"""
+    async def handler(_req: web.Request) -> web.FileResponse:
+        return web.FileResponse(path)
+
+    app = web.Application()
+    app.router.add_get("/{name}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port
+
+
+# ──────────── 計測 ────────────
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def sample_lag(bench: Bench, stop: asyncio.Event, interval: float = 0.05) -> None:
+    """interval ごとに眠り、予定より遅れて起きた分をループ遅延として記録"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        bench.lag.append(max(0.0, loop.time() - expected))
+
+
+def pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# ──────────── シナリオ ────────────
+def command_mix(bench: Bench, guild: FakeGuild, base_url: str):
+    """(重み, コルーチン関数) の一覧"""
+    def message(content: str = "") -> FakeMessage:
+        return FakeMessage(bench, guild, guild.member, content)
+
+    def state():
+        return bot.guild_states.get(guild.id)
+
+    async def play(rng):
+        await bot.cmd_play(message(), f"{base_url}/extra-{rng.randrange(1000)}.wav")
+
+    async def queue(_rng):
+        await bot.cmd_queue(message(), "")
+
+    async def seek(rng):
+        await bot.cmd_seek(message(), str(rng.randrange(max(1, bench.args.track_seconds - 5))))
+
+    async def forward(_rng):
+        await bot.cmd_forward(message(), "5")
+
+    async def rewind(_rng):
+        await bot.cmd_rewind(message(), "5")
+
+    async def skip(_rng):
+        if st := state():
+            await st.request("skip")
+
+    async def pause(_rng):
+        if st := state():
+            await st.request("pause")
+
+    async def remove(_rng):
+        await bot.cmd_remove(message(), "1")
+
+    return [
+        (3, play), (2, queue), (2, seek), (1, forward), (1, rewind),
+        (1, skip), (1, pause), (1, remove),
+    ]
+
+
+async def drive_guild(bench: Bench, guild: FakeGuild, base_url: str, deadline: float, seed: int) -> None:
+    rng = random.Random(seed)
+    first = FakeMessage(bench, guild, guild.member)
+    urls = ", ".join(f"{base_url}/tone-{i}.wav" for i in range(bench.args.tracks))
+    await bot.cmd_play(first, urls, split_commas=True)
+    await bot.cmd_queue(FakeMessage(bench, guild, guild.member), "")
+
+    mix = command_mix(bench, guild, base_url)
+    weights = [w for w, _ in mix]
+    actions = [a for _, a in mix]
+    while time.monotonic() < deadline:
+        await asyncio.sleep(rng.expovariate(1 / bench.args.command_interval))
+        action = rng.choices(actions, weights)[0]
+        try:
+            await action(rng)
+            bench.commands += 1
+        except Exception as e:
+            bench.errors += 1
+            bot.logger.error("bench command failed: %s", e)
+
+
+async def run(args: argparse.Namespace) -> None:
+    if not shutil.which("ffmpeg"):
+        raise SystemExit("ffmpeg が見つかりません")
+    bench = Bench(args)
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_music_")
+    tone = os.path.join(tmpdir, "tone.wav")
+    make_tone(tone, args.track_seconds)
+    runner, port = await start_audio_server(tone)
+    base_url = f"http://127.0.0.1:{port}"
+
+    if not args.resolve:
+        # yt-dlp を通さずローカル URL をそのまま Track にする
+        def local_extract(url: str) -> list[bot.Track]:
+            return [bot.Track(url.rsplit("/", 1)[-1], url, args.track_seconds)]
+        bot.yt_extract = local_extract
+
+    guilds = [FakeGuild(bench, 1_000 + i) for i in range(args.guilds)]
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(sample_lag(bench, stop))
+
+    rss_before = rss_bytes()
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(
+        drive_guild(bench, g, base_url, deadline, args.seed + i)
+        for i, g in enumerate(guilds)
+    ))
+    elapsed = time.monotonic() - started
+    rss_after = rss_bytes()
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    # 後片付け (ffmpeg を終了させて子プロセスの CPU 時間を確定させる)
+    stop.set()
+    await lag_task
+    for g in guilds:
+        if st := bot.guild_states.pop(g.id, None):
+            await st.close()
+        if g.voice_client:
+            await g.voice_client.disconnect()
+    await runner.cleanup()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    self_cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    child_cpu = children.ru_utime + children.ru_stime
+    stream_seconds = bench.frames * FRAME_SECONDS
+    per_stream = (self_cpu + child_cpu) / stream_seconds * 100 if stream_seconds else 0.0
+
+    lines = [
+        f"guilds              : {args.guilds}",
+        f"duration            : {elapsed:.1f}s",
+        f"commands            : {bench.commands} ({bench.errors} errors)",
+        f"audio streamed      : {stream_seconds:.1f}s ({stream_seconds / elapsed:.1f} concurrent streams avg)",
+        f"loop lag p50/p99/max: {pct(bench.lag, 0.5) * 1000:.1f} / {pct(bench.lag, 0.99) * 1000:.1f}"
+        f" / {max(bench.lag, default=0) * 1000:.1f} ms",
+        f"cpu (python/ffmpeg) : {self_cpu:.2f}s / {child_cpu:.2f}s",
+        f"cpu per stream      : {per_stream:.2f}% of one core",
+        f"memory per guild    : {(rss_after - rss_before) / max(1, args.guilds) / 1024:.0f} KiB (RSS delta)",
+        f"discord sends       : {bench.sends} ({bench.sends / elapsed:.2f}/s)",
+        f"discord edits       : {bench.edits} ({bench.edits / elapsed:.2f}/s,"
+        f" {bench.edits / elapsed / max(1, args.guilds):.3f}/s per guild)",
+        f"discord deletes     : {bench.deletes}",
+    ]
+    if bench.lag:
+        lines.append(f"loop lag mean       : {statistics.fmean(bench.lag) * 1000:.2f} ms")
+    print("\n".join(lines))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="音楽機能の負荷試験")
+    parser.add_argument("--guilds", type=int, default=20, help="同時に動かすギルド数")
+    parser.add_argument("--duration", type=float, default=30.0, help="計測時間 (秒)")
+    parser.add_argument("--tracks", type=int, default=5, help="最初にキューへ入れる曲数")
+    parser.add_argument("--track-seconds", type=int, default=30, help="テスト音源の長さ (秒)")
+    parser.add_argument("--command-interval", type=float, default=5.0, help="ギルドごとの平均コマンド間隔 (秒)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Discord API 呼び出し 1 回の模擬遅延 (秒)")
+    parser.add_argument("--connect-delay", type=float, default=0.2, help="VC 接続の模擬所要時間 (秒)")
+    parser.add_argument("--resolve", action="store_true", help="曲の取得に yt-dlp を通す")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
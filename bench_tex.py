@@ -0,0 +1,119 @@
+"""TeX 描画の 2 段構成 (mathtext / usetex) のベンチマーク
+
+よく使われる形の数式を並べたコーパスについて、mathtext でこのプロセス内に
+描いた場合と、usetex のワーカープールで描いた場合の所要時間を比べる。
+キャッシュは使わない。latex / dvipng が無い環境では mathtext 側だけを測る。
+
+使い方::
+
+    python -m discordbot.bench_tex --repeat 5
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+
+from .tex_render import TexError, TexRenderer, _MathtextUnsupported, draw_mathtext, needs_usetex
+
+CORPUS = [
+    r"x^2 + y^2 = z^2",
+    r"e^{i\pi} + 1 = 0",
+    r"\frac{a}{b}",
+    r"\sqrt{2}",
+    r"\sum_{n=1}^{\infty} \frac{1}{n^2} = \frac{\pi^2}{6}",
+    r"\int_0^1 x^2\,dx",
+    r"\lim_{x \to 0} \frac{\sin x}{x} = 1",
+    r"\alpha + \beta = \gamma",
+    r"f(x) = \left( \frac{x+1}{x-1} \right)^2",
+    r"\nabla \cdot \mathbf{E} = \frac{\rho}{\varepsilon_0}",
+    r"\binom{n}{k} = \frac{n!}{k!(n-k)!}",
+    r"\mathbb{R}^n",
+    r"a_{ij} = \sum_k b_{ik} c_{kj}",
+    r"\overline{z} = x - iy",
+    r"\hat{H}\psi = E\psi",
+    r"\text{if } x > 0",
+    r"\begin{pmatrix} a & b \\ c & d \end{pmatrix}",
+    r"\begin{cases} 1 & x > 0 \\ 0 & x \le 0 \end{cases}",
+    r"\begin{aligned} a &= b + c \\ d &= e \end{aligned}",
+    r"x \equiv 1 \pmod{3}",
+]
+
+
+def time_mathtext(formula: str, repeat: int) -> float | None:
+    """mathtext 1 回あたりの秒数 (描けなければ None)"""
+    if needs_usetex(formula):
+        return None
+    try:
+        draw_mathtext(formula)  # フォント読み込みなどを除くため 1 回捨てる
+    except _MathtextUnsupported:
+        return None
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        draw_mathtext(formula)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+async def time_usetex(renderer: TexRenderer, formula: str, repeat: int) -> float | None:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        try:
+            await renderer._render_in_pool(formula)
+        except TexError:
+            return None
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def fmt_ms(value: float | None) -> str:
+    return "-" if value is None else f"{value * 1000:8.1f}"
+
+
+async def run(args: argparse.Namespace) -> None:
+    usetex_reason = TexRenderer.available()
+    renderer = None
+    if usetex_reason is None:
+        renderer = TexRenderer(cache_dir=tempfile.mkdtemp(prefix="bench_tex_"), workers=args.workers)
+        renderer.start()
+        # ワーカーの起動と温めを待つ
+        await renderer._render_in_pool("x")
+    else:
+        print(f"usetex skipped: {usetex_reason}")
+
+    rows = []
+    for formula in CORPUS:
+        fast = time_mathtext(formula, args.repeat)
+        slow = await time_usetex(renderer, formula, args.repeat) if renderer else None
+        rows.append((formula, fast, slow))
+    if renderer:
+        renderer.shutdown()
+
+    print(f"{'mathtext ms':>11} {'usetex ms':>10}  formula")
+    for formula, fast, slow in rows:
+        print(f"{fmt_ms(fast):>11} {fmt_ms(slow):>10}  {formula}")
+
+    handled = [r for r in rows if r[1] is not None]
+    print()
+    print(f"fast path coverage : {len(handled)}/{len(rows)}")
+    if handled:
+        print(f"mathtext median    : {statistics.median(r[1] for r in handled) * 1000:.1f} ms")
+    both = [r for r in rows if r[1] is not None and r[2] is not None]
+    if both:
+        print(f"usetex median      : {statistics.median(r[2] for r in both) * 1000:.1f} ms (same formulas)")
+        print(f"median speedup     : {statistics.median(r[2] / r[1] for r in both):.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="TeX 描画のベンチマーク")
+    parser.add_argument("--repeat", type=int, default=5, help="1 式あたりの計測回数")
+    parser.add_argument("--workers", type=int, default=1, help="usetex ワーカー数")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
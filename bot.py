@@ -1,6 +1,7 @@
+import time
+_STARTED = time.perf_counter()     # 起動時間の計測用 (重い import より前に取る)
 import os
 import re
-import time
 import random
 import discord
 import tempfile
@@ -8,14 +9,15 @@ import logging
 import datetime
 import asyncio
 import base64
-import shutil
+import io
+import enum
+import collections
+import shlex
+import socket
+import signal
 from discord import app_commands
-from cappuccino_agent import CappuccinoAgent
 import json
-import feedparser
 import aiohttp
-from openai import AsyncOpenAI
-from bs4 import BeautifulSoup
 
 # 音声読み上げや文字起こし機能は削除したため関連ライブラリは不要
 from urllib.parse import urlparse, parse_qs, urlunparse
@@ -23,9 +25,26 @@ from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
 
 from dataclasses import dataclass
-from typing import Any
-
-from .poker import PokerMatch, PokerView
+from typing import Any, Callable
+
+from .music_queue import TrackQueue
+from .voice_manager import VoiceManager, VoiceCircuitOpen
+from .loop_monitor import LoopMonitor
+from . import metrics
+from .command_registry import Command, CommandRegistry, CommandRejected, no_args
+from .rate_limit import Busy, Limits, Rate, RateLimited, RateLimiter
+from .tex_render import TexRenderer, TexError, TexTimeout, TexUnavailable
+from .code_images import CodeImageService, CodeError, CodeUnavailable
+from .quote_card import QuoteCardRenderer
+from .content_cache import ContentCache
+from .purge_engine import PurgeEngine, PurgeFilter, PurgeProgress
+from .member_index import MemberActivityIndex
+from . import memory_profile
+from .lease import LeaseManager
+from .shutdown import ShutdownGate, make_media_dir, remove_media_dir
+from . import music_store
+from . import startup
+from .tree_sync import TreeSyncer
 
 
 # ───────────────── TOKEN / KEY ─────────────────
@@ -120,23 +139,49 @@ EEW_CHANNEL_ID = _load_eew_channel()
 LAST_EEW_ID = _load_last_eew()
 WEATHER_CHANNEL_ID = _load_weather_channel()
 
+# ───────────────── 遅延読み込み ─────────────────
+# 一部のコマンドでしか使わない重いモジュールとクライアントは、最初の利用時か
+# on_ready 後の先読み (BOT_WARMUP=0 で無効) で読み込む。ログインまでの時間を短くするため
+startup_timer = startup.StartupTimer(_STARTED)
+BOT_WARMUP = os.getenv("BOT_WARMUP", "1") != "0"
+yt_dlp = startup.LazyModule("yt_dlp")
+bs4 = startup.LazyModule("bs4")
+feedparser = startup.LazyModule("feedparser")
+
+
+def _make_cappuccino_agent():
+    from cappuccino_agent import CappuccinoAgent
+    return CappuccinoAgent(api_key=OPENAI_API_KEY)
+
+
+def _make_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+
 # Initialize CappuccinoAgent for GPT interactions
-cappuccino_agent = CappuccinoAgent(api_key=OPENAI_API_KEY)
+cappuccino_agent = startup.LazyObject("cappuccino_agent", _make_cappuccino_agent)
 
 # Direct OpenAI client for bot commands
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+openai_client = startup.LazyObject("openai", _make_openai_client)
+
+LAZY_MODULES = {
+    "yt_dlp": yt_dlp, "bs4": bs4, "feedparser": feedparser,
+    "openai": openai_client, "cappuccino": cappuccino_agent,
+}
 
 async def call_openai_api(prompt: str) -> tuple[str, list[discord.File]]:
     """Send query directly to OpenAI and return text and generated images."""
-    resp = await openai_client.responses.create(
-        model="gpt-4.1",
-        tools=[
-            {"type": "web_search_preview"},
-            {"type": "code_interpreter", "container": {"type": "auto"}},
-            {"type": "image_generation"},
-        ],
-        input=[{"role": "user", "content": prompt}],
-    )
+    with metrics.external("llm"):
+        resp = await openai_client.responses.create(
+            model="gpt-4.1",
+            tools=[
+                {"type": "web_search_preview"},
+                {"type": "code_interpreter", "container": {"type": "auto"}},
+                {"type": "image_generation"},
+            ],
+            input=[{"role": "user", "content": prompt}],
+        )
 
     text_blocks: list[str] = []
     images: list[discord.File] = []
@@ -159,12 +204,32 @@ async def call_openai_api(prompt: str) -> tuple[str, list[discord.File]]:
 
 # ───────────────── Voice Transcription / TTS ─────────────────
 
+# ───────────────── シャード ─────────────────
+# launcher.py が子プロセスごとに SHARD_COUNT / SHARD_IDS を渡す。
+# どちらも未設定なら従来どおりシャードなしの 1 プロセスで動く。
+SHARD_COUNT = os.getenv("SHARD_COUNT", "").strip()          # 数値または auto
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()]
+if SHARD_COUNT and SHARD_COUNT != "auto" and not SHARD_COUNT.isdigit():
+    raise RuntimeError(f"SHARD_COUNT must be a number or 'auto', got {SHARD_COUNT!r}")
+if SHARD_IDS:
+    # 受け持つシャードを指定するときは総数も必要 (auto では決まらない)
+    if not SHARD_COUNT.isdigit():
+        raise RuntimeError("SHARD_IDS requires a numeric SHARD_COUNT (the total number of shards)")
+    if any(i < 0 or i >= int(SHARD_COUNT) for i in SHARD_IDS):
+        raise RuntimeError(f"SHARD_IDS must be between 0 and {int(SHARD_COUNT) - 1}")
+
 # ───────────────── Logger ─────────────────
-handler = RotatingFileHandler('bot.log', maxBytes=1_000_000, backupCount=5, encoding='utf-8')
+# 複数プロセスで同じファイルをローテートしないよう、シャードごとに分ける
+LOG_FILE = f"bot.shard{SHARD_IDS[0]}.log" if SHARD_IDS else "bot.log"
+handler = RotatingFileHandler(LOG_FILE, maxBytes=1_000_000, backupCount=5, encoding='utf-8')
 logging.basicConfig(level=logging.INFO, handlers=[handler])
 logging.getLogger('discord').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# イベントループ遅延の監視 (この時間以上止まったらスタックを記録)
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "250"))
+loop_monitor = LoopMonitor(threshold=LOOP_STALL_MS / 1000)
+
 # チャンネル型の許可タプル (Text / Thread / Stage)
 MESSAGE_CHANNEL_TYPES: tuple[type, ...] = (
     discord.TextChannel,
@@ -176,14 +241,62 @@ MESSAGE_CHANNEL_TYPES: tuple[type, ...] = (
 # ───────────────── Logger ─────────────────
 
 # ───────────────── Discord 初期化 ─────────────────
+# presence / メンバー / メッセージのキャッシュ量は BOT_MEMORY_PROFILE (full, balanced, lean) で決める
+MEMORY_PROFILE = memory_profile.load_profile(os.getenv("BOT_MEMORY_PROFILE"))
 intents = discord.Intents.default()
 intents.message_content = True          # メッセージ内容を取得
 intents.reactions = True 
-intents.members   = True
-intents.presences = True 
 intents.voice_states    = True
-client = discord.Client(intents=intents)
+client_options = MEMORY_PROFILE.apply(intents)     # members / presences もここで設定
+if os.getenv("BOT_MAX_MESSAGES"):
+    client_options["max_messages"] = int(os.getenv("BOT_MAX_MESSAGES")) or None
+if SHARD_COUNT or SHARD_IDS:
+    client = discord.AutoShardedClient(
+        intents=intents,
+        shard_count=int(SHARD_COUNT) if SHARD_COUNT.isdigit() else None,
+        shard_ids=SHARD_IDS or None,
+        **client_options,
+    )
+else:
+    client = discord.Client(intents=intents, **client_options)
 tree = app_commands.CommandTree(client)
+metrics.instrument_http(client.http)
+# 最終発言とオンライン人数 (y!user / y!server 用)
+member_index = MemberActivityIndex()
+
+# /metrics を返すローカル HTTP サーバー (METRICS_PORT 未設定なら起動しない)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+metrics_runner = None
+
+# ニュース・地震速報・天気の定期ジョブを 1 プロセスだけで動かすためのリース
+leases = LeaseManager(
+    os.getenv("LEASE_DB", os.path.join(ROOT_DIR, "leases.sqlite3")),
+    owner=f"{socket.gethostname()}:{os.getpid()}:shards={','.join(map(str, SHARD_IDS)) or 'all'}",
+)
+
+# スラッシュコマンドは定義が変わったときだけ同期する。
+# DEV_GUILD_ID を指定するとグローバルではなくそのギルドにだけ同期する (反映が即時)
+DEV_GUILD_ID = int(os.getenv("DEV_GUILD_ID", "0") or 0)
+tree_syncer = TreeSyncer(tree, os.getenv("COMMAND_FINGERPRINT_FILE", os.path.join(ROOT_DIR, "command_tree.json")))
+
+# 終了時は新しいコマンドを断り、実行中のものを待ってから再生状態を保存する
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+MUSIC_STATE_FILE = os.getenv(
+    "MUSIC_STATE_FILE",
+    os.path.join(ROOT_DIR, f"music_state.shard{SHARD_IDS[0]}.json.gz" if SHARD_IDS else "music_state.json.gz"),
+)
+MUSIC_RESUME_MAX_AGE = float(os.getenv("MUSIC_RESUME_MAX_AGE", "600"))   # これより古い保存は再開しない
+shutdown_gate = ShutdownGate()
+# 添付ファイル・シーク用先読みの置き場 (終了時にまとめて消す)
+MEDIA_DIR = make_media_dir()
+
+# アイコン・記事ページ・地震情報などの取得結果を共有するキャッシュ
+content_cache = ContentCache(
+    cache_dir=os.path.join(ROOT_DIR, "cache", "http"),
+    memory_bytes=int(os.getenv("CONTENT_CACHE_MEMORY_MB", "32")) * 1024 * 1024,
+    disk_bytes=int(os.getenv("CONTENT_CACHE_DISK_MB", "256")) * 1024 * 1024,
+)
 
 # ───────────────── 便利関数 ─────────────────
 def parse_cmd(content: str):
@@ -268,8 +381,10 @@ class _SlashChannel:
 class SlashMessage:
     """Wrap discord.Interaction to mimic discord.Message."""
 
-    def __init__(self, interaction: discord.Interaction, attachments: list[discord.Attachment] | None = None):
+    def __init__(self, interaction: discord.Interaction, attachments: list[discord.Attachment] | None = None,
+                 ephemeral: bool = False):
         self._itx = interaction
+        self.ephemeral = ephemeral
         self.channel = _SlashChannel(interaction)
         self.guild = interaction.guild
         self.author = interaction.user
@@ -282,8 +397,11 @@ class SlashMessage:
     async def add_reaction(self, emoji):
         await self.channel.send(emoji)
 
+    async def defer(self) -> None:
+        if not self._itx.response.is_done():
+            await self._itx.response.defer(ephemeral=self.ephemeral)
+
 
-from yt_dlp import YoutubeDL
 YTDL_OPTS = {
     "quiet": True,
     "format": "bestaudio[ext=m4a]/bestaudio/best",
@@ -357,15 +475,19 @@ HELP_PAGES: list[tuple[str, str]] = [
                 "/dice, y!XdY : ダイス（例: 2d6）",
                 "/qr <text>, y!qr <text> : QRコード画像を生成",
                 "/barcode <text>, y!barcode <text> : バーコード画像を生成",
+                "/qrbatch, y!qrbatch [--zip] a | b | … : QRコードをまとめて生成",
+                "/barcodebatch, y!barcodebatch [--zip] a | b | … : バーコードをまとめて生成",
                 "/tex <式>, y!tex <式> : TeX 数式を画像に変換",
 
                 "/news <#channel>, y!news <#channel> : ニュース投稿チャンネルを設定",
                 "/eew <#channel>, y!eew <#channel> : 地震速報チャンネルを設定",
                 "/weather <#channel>, y!weather <#channel> : 天気予報チャンネルを設定",
+                "/lag, y!lag : イベントループ遅延レポート (管理者)",
+                "/memory, y!memory : キャッシュのメモリ使用量レポート (管理者)",
 
                 "/poker [@user], y!poker [@user] : 1vs1 ポーカーで対戦",
 
-                "/purge <n|link>, y!purge <n|link> : メッセージ一括削除",
+                "/purge <n|link> [#ch] [@user] [bots] [contains:語], y!purge … : メッセージ一括削除",
                 "/help, y!help : このヘルプ",
                 "y!? … 返信で使うと名言化",
                 "",
@@ -385,6 +507,7 @@ HELP_PAGES: list[tuple[str, str]] = [
                 "　例: y!play Never Gonna Give You Up, Bad Apple!!",
                 "/play はファイル添付もOK、入力順に再生",
                 "/queue でキューを表示、ボタンから Skip/Loop など操作",
+                "　◀ ▶ でページ送り、📄 を押すとページ番号を指定して移動",
                 "/remove 2 で2番目を削除、/keep 1 で1曲だけ残す",
                 "/seek 1:30 で1分30秒へ移動、/forward 30 で30秒早送り",
                 "/stop または y!stop でボイスチャンネルから退出",
@@ -409,6 +532,8 @@ HELP_PAGES: list[tuple[str, str]] = [
                 "　例: /gpt Pythonとは？",
                 "/qr <text>, y!qr <text> : QRコード画像を生成",
                 "/barcode <text>, y!barcode <text> : Code128 バーコードを生成",
+                "/qrbatch, y!qrbatch [--zip] a | b | … : まとめて生成 (一覧画像 / zip)",
+                "/barcodebatch, y!barcodebatch [--zip] a | b | … : 同上 (バーコード)",
                 "/tex <式>, y!tex <式> : TeX 数式を画像化",
                 "どのコマンドもテキスト/スラッシュ形式に対応",
             ]
@@ -437,7 +562,7 @@ HELP_PAGES: list[tuple[str, str]] = [
                 "/eew <#channel> : 地震速報の通知先を設定 (管理者のみ)",
                 "/weather <#channel> : 天気予報の投稿先を設定 (管理者のみ)",
                 "/poker [@user] : 友達やBOTと1vs1ポーカー対戦",
-                "/purge <n|link> : メッセージをまとめて削除",
+                "/purge <n|link> [#ch…] [@user…] [bots] [contains:語] : メッセージをまとめて削除",
                 "返信で y!? と送るとその内容を名言化",
             ]
         ),
@@ -464,28 +589,39 @@ class Track:
     title: str
     url: str
     duration: int | None = None
+    page_url: str | None = None     # 再取得用の元ページ URL (ストリーム URL の期限切れ対策)
+    cache_path: str | None = None   # シーク用にローカルへ先読みしたファイル
+
+def _info_to_track(info: dict) -> Track:
+    return Track(
+        info.get("title", "?"),
+        info.get("url", ""),
+        info.get("duration"),
+        info.get("webpage_url") or info.get("original_url"),
+    )
 
 def yt_extract(url_or_term: str) -> list[Track]:
     """URL か検索語から Track 一覧を返す (単曲の場合は長さ1)"""
-    with YoutubeDL(YTDL_OPTS) as ydl:
+    with metrics.external("ytdlp"), yt_dlp.YoutubeDL(YTDL_OPTS) as ydl:
         info = ydl.extract_info(url_or_term, download=False)
         if "entries" in info:
             if info.get("_type") == "playlist":
                 results = []
                 for ent in info.get("entries", []):
                     if ent:
-                        results.append(Track(ent.get("title", "?"), ent.get("url", ""), ent.get("duration")))
+                        results.append(_info_to_track(ent))
                 return results
             info = info["entries"][0]
-        return [Track(info.get("title", "?"), info.get("url", ""), info.get("duration"))]
+        return [_info_to_track(info)]
 
 
 async def attachment_to_track(att: discord.Attachment) -> Track:
     """Discord 添付ファイルを一時保存して Track に変換"""
-    fd, path = tempfile.mkstemp(prefix="yone_", suffix=os.path.splitext(att.filename)[1])
+    fd, path = tempfile.mkstemp(prefix="yone_", suffix=os.path.splitext(att.filename)[1], dir=MEDIA_DIR)
     os.close(fd)
     await att.save(path)
-    return Track(att.filename, path)
+    # 元の URL は再起動後の再開用 (一時ファイルは終了時に消える)
+    return Track(att.filename, path, page_url=att.url)
 
 
 async def attachments_to_tracks(attachments: list[discord.Attachment]) -> list[Track]:
@@ -547,12 +683,12 @@ async def add_playlist_lazy(state: "MusicState", playlist_url: str,
     list_id = qs.get("list", [None])[0]
     if list_id:
         playlist_url = f"https://www.youtube.com/playlist?list={list_id}"
-    loop = asyncio.get_running_loop()
-    info = await loop.run_in_executor(
-        None,
-        lambda: YoutubeDL({**YTDL_OPTS, "extract_flat": True}).extract_info(
-            playlist_url, download=False)
-    )
+
+    def extract_flat():
+        with metrics.external("ytdlp"):
+            return yt_dlp.YoutubeDL({**YTDL_OPTS, "extract_flat": True}).extract_info(
+                playlist_url, download=False)
+    info = await asyncio.to_thread(extract_flat)
     entries = info.get("entries", [])
     if not entries:
         await channel.send("⚠️ プレイリストに曲が見つかりませんでした。", delete_after=5)
@@ -565,36 +701,163 @@ async def add_playlist_lazy(state: "MusicState", playlist_url: str,
         if not url:
             continue
         try:
-            tracks = await loop.run_in_executor(None, yt_extract, url)
+            tracks = await asyncio.to_thread(yt_extract, url)
         except Exception as e:
             logger.error("取得失敗 (%s): %s", url, e)
             continue
         if not tracks:
             continue
-        state.queue.append(tracks[0])
-        await refresh_queue(state)
-        if not voice.is_playing() and not state.play_next.is_set():
-            client.loop.create_task(state.player_loop(voice, channel))
+        state.ensure_player(voice, channel)
+        state.post("enqueue", [tracks[0]])
     await channel.send(f"✅ プレイリストの読み込みが完了しました ({len(entries)}曲)", delete_after=10)
 
 
 def cleanup_track(track: Track | None):
-    """ローカルファイルの場合は削除"""
-    if track and os.path.exists(track.url):
+    """ローカルファイルの場合は削除 (シーク用キャッシュも含む)"""
+    if not track:
+        return
+    drop_stream_cache(track)
+    if os.path.exists(track.url):
         try:
             os.remove(track.url)
         except Exception as e:
             logger.error("cleanup failed for %s: %s", track.url, e)
 
 
+# ──────────── 🎵  シーク用ストリームキャッシュ ────────────
+SEEK_CACHE_MAX_BYTES = 64 * 1024 * 1024   # これより大きい曲は先読みしない
+SEEK_CACHE_CHUNK = 4 * 1024 * 1024        # Range リクエスト 1 回あたりのサイズ
+STREAM_EXPIRY_MARGIN = 120                # 期限の何秒前から URL を取り直すか
+# 先読みは帯域とディスクを使うので、full 以外では最初にシークされた曲だけ
+SEEK_PREFETCH_ALWAYS = MEMORY_PROFILE.prefetch_streams
+SEEK_LATENCY = metrics.Histogram(
+    "bot_seek_latency_seconds", "Time from a seek request to the first audio frame at the new position"
+)
+
+
+def drop_stream_cache(track: Track) -> None:
+    """先読みファイルを削除"""
+    path, track.cache_path = track.cache_path, None
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception as e:
+            logger.error("cache cleanup failed for %s: %s", path, e)
+
+
+def stream_expired(url: str) -> bool:
+    """署名付きストリーム URL (expire=) の期限が近いか判定"""
+    try:
+        expire = parse_qs(urlparse(url).query).get("expire", [None])[0]
+        return expire is not None and int(expire) - STREAM_EXPIRY_MARGIN <= time.time()
+    except ValueError:
+        return False
+
+
+async def refresh_stream_url(track: Track) -> None:
+    """元ページからストリーム URL を取り直す"""
+    if not track.page_url:
+        return
+    loop = asyncio.get_running_loop()
+    tracks = await loop.run_in_executor(None, yt_extract, track.page_url)
+    if tracks and tracks[0].url:
+        track.url = tracks[0].url
+        logger.info("refreshed stream url for %s", track.title)
+
+
+async def prefetch_stream(track: Track) -> None:
+    """シーク用にストリームを Range リクエストでローカルへ先読みする
+
+    取得しきれたら track.cache_path に設定する。サイズ上限を超える場合や
+    途中で失敗・キャンセルされた場合は何も残さない。
+    """
+    fd, path = tempfile.mkstemp(prefix="yone_cache_", suffix=".audio", dir=MEDIA_DIR)
+    os.close(fd)
+    complete = False
+    try:
+        async with aiohttp.ClientSession() as sess:
+            with open(path, "wb") as f:
+                start = 0
+                while start < SEEK_CACHE_MAX_BYTES:
+                    headers = {"Range": f"bytes={start}-{start + SEEK_CACHE_CHUNK - 1}"}
+                    async with sess.get(track.url, headers=headers, timeout=30) as resp:
+                        if resp.status == 416:       # 末尾を越えた
+                            complete = True
+                            break
+                        resp.raise_for_status()
+                        if resp.status == 200:       # Range 非対応: 一括取得
+                            if (resp.content_length or 0) > SEEK_CACHE_MAX_BYTES:
+                                return
+                            data = await resp.read()
+                            await asyncio.to_thread(f.write, data)
+                            complete = len(data) <= SEEK_CACHE_MAX_BYTES
+                            break
+                        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                        if total.isdecimal() and int(total) > SEEK_CACHE_MAX_BYTES:
+                            return
+                        data = await resp.read()
+                    await asyncio.to_thread(f.write, data)
+                    start += len(data)
+                    if len(data) < SEEK_CACHE_CHUNK or (total.isdecimal() and start >= int(total)):
+                        complete = True
+                        break
+        if complete:
+            track.cache_path = path
+            logger.info("cached %s (%d bytes) for seeking", track.title, os.path.getsize(path))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning("stream prefetch failed for %s: %s", track.title, e)
+    finally:
+        if not complete:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000   # 1 フレーム = 20 ms
+
+
+class PlaybackSource(discord.AudioSource):
+    """FFmpegPCMAudio を包み、実際に送り出したフレーム数で再生位置を数える
+
+    一時停止中や ffmpeg が詰まっている間は read() が呼ばれない / 空を返すので
+    位置も進まない。最初のフレームを出した時点で on_first_frame を呼ぶ。
+    """
+
+    def __init__(self, inner: discord.AudioSource, on_first_frame=None, start: float = 0.0):
+        self.inner = inner
+        self.start = start      # シーク開始位置 (秒)
+        self.frames = 0         # 送り出したフレーム数
+        self._on_first_frame = on_first_frame
+
+    @property
+    def position(self) -> float:
+        return self.start + self.frames * FRAME_SECONDS
+
+    def read(self) -> bytes:
+        data = self.inner.read()
+        if data:
+            self.frames += 1
+            if self._on_first_frame is not None:
+                callback, self._on_first_frame = self._on_first_frame, None
+                callback()
+        return data
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self) -> None:
+        self.inner.cleanup()
+
+
 def parse_message_link(link: str) -> tuple[int, int, int] | None:
     """Discord メッセージリンクを guild, channel, message ID に分解"""
     m = re.search(r"discord(?:app)?\.com/channels/(\d+)/(\d+)/(\d+)", link)
     if not m:
         return None
     return int(m.group(1)), int(m.group(2)), int(m.group(3))
-    
-import collections
 
 def fmt_time(sec: int) -> str:
     m, s = divmod(int(sec), 60)
@@ -658,115 +921,399 @@ def num_emoji(n: int) -> str:
     emojis = ["0️⃣","1️⃣","2️⃣","3️⃣","4️⃣","5️⃣","6️⃣","7️⃣","8️⃣","9️⃣","🔟"]
     return emojis[n] if 0 <= n < len(emojis) else f'[{n}]'
 
+IDLE_TIMEOUT = 5  # キューが空になってから VC を抜けるまでの秒数
+RESUME_TIMEOUT = 60  # ボイス再接続を待って再開する最大秒数
+RECONNECT_LOSS = metrics.Histogram(
+    "bot_voice_reconnect_loss_seconds", "Playback time lost between a voice drop and resumed audio"
+)
+
+
+class PlayerStatus(enum.Enum):
+    """MusicState の再生状態"""
+    IDLE = "idle"          # キューが空で次の曲を待っている
+    PLAYING = "playing"
+    PAUSED = "paused"
+    RECONNECTING = "reconnecting"  # ボイス再接続を待っている
+    STOPPED = "stopped"    # y!stop などで停止済み
+
+
 class MusicState:
+    """ギルドごとの再生アクター
+
+    再生操作 (enqueue / skip / seek / pause / loop / stop) はすべて
+    ``post()`` で受信箱に積まれ、ギルドにつき 1 本だけ動く
+    ``player_loop`` タスクが順番に適用する。
+    """
     def __init__(self):
-        self.queue   = collections.deque()   # 再生待ち Track 一覧
+        self.queue: TrackQueue[Track] = TrackQueue()   # 再生待ち Track 一覧 (再生中の曲は含まない)
         self.loop    = 0  # 0:OFF,1:SONG,2:QUEUE
         self.auto_leave = True             # 全員退出時に自動で切断するか
-        self.current: Track | None = None
-        self.play_next = asyncio.Event()
+        self.current: Track | None = None      # 再生中の曲 (キューとは別に持つ)
         self.queue_msg: discord.Message | None = None
         self.panel_owner: int | None = None
-        self.start_time: float | None = None
-        self.pause_offset: float = 0.0
-        self.is_paused: bool = False
+        self.source: PlaybackSource | None = None   # 再生中のソース (位置の取得元)
         self.playlist_task: asyncio.Task | None = None
         self.seek_to: int | None = None
         self.seeking: bool = False
-
-    async def player_loop(self, voice: discord.VoiceClient, channel: discord.TextChannel):
+        self.status = PlayerStatus.IDLE
+        self.inbox: asyncio.Queue[tuple[str, Any, asyncio.Future | None]] = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+        self.voice: discord.VoiceClient | None = None
+        self.channel: discord.abc.Messageable | None = None
+        self._generation = 0   # 再生中ソースの世代番号 (古い終了通知を無視する)
+        self.page = 0                        # キューパネルで表示中のページ
+        self.page_cache: dict[int, str] = {}  # ページ番号 → 描画済みテキスト
+        self.page_cache_version = -1          # page_cache を作った時の queue.version
+        self.prefetch_task: asyncio.Task | None = None   # シーク用の先読み
+        self.seek_requested_at: float | None = None      # perf_counter() 基準
+        self.seek_latencies: collections.deque[float] = collections.deque(maxlen=50)
+        # ボイス切断時のスナップショット (曲, 位置, 切断時刻 monotonic)
+        self.resume_from: tuple[Track, float, float] | None = None
+        self.reconnect_losses: collections.deque[float] = collections.deque(maxlen=50)
+
+    @property
+    def is_paused(self) -> bool:
+        return self.status is PlayerStatus.PAUSED
+
+    @property
+    def position(self) -> float:
+        """再生位置 (秒)。音声ソースが実際に送ったフレーム数から求める"""
+        if self.source is None:
+            return 0.0
+        pos = self.source.position
+        if self.current and self.current.duration:
+            pos = min(pos, self.current.duration)
+        return pos
+
+    def ensure_player(self, voice: discord.VoiceClient, channel: discord.abc.Messageable) -> None:
+        """再生タスクが動いていなければ起動する (ギルドにつき常に 1 本)"""
+        self.voice, self.channel = voice, channel
+        if self.task is None or self.task.done():
+            self.status = PlayerStatus.IDLE
+            self.task = asyncio.create_task(self.player_loop(), context=metrics.detached())
+
+    def post(self, op: str, arg: Any = None) -> asyncio.Future:
+        """コマンドを受信箱に積む。タスク停止中はその場で適用する"""
+        fut = asyncio.get_running_loop().create_future()
+        if self.task is None or self.task.done():
+            self._apply(op, arg)
+            fut.set_result(None)
+        else:
+            self.inbox.put_nowait((op, arg, fut))
+        return fut
+
+    async def request(self, op: str, arg: Any = None) -> None:
+        """post() して適用されるまで待つ"""
+        await self.post(op, arg)
+
+    async def close(self) -> None:
+        """停止してキュー・一時ファイル・パネルを片付ける"""
+        self.post("stop")
+        if self.playlist_task and not self.playlist_task.done():
+            self.playlist_task.cancel()
+        self._release_current()
+        cleanup_track(self.current)
+        for tr in self.queue:
+            cleanup_track(tr)
+        if self.queue_msg:
+            try:
+                await self.queue_msg.delete()
+            except Exception:
+                pass
+            self.queue_msg = None
+            self.panel_owner = None
+
+    def voice_dropped(self) -> None:
+        """ボイス切断を検知したら曲と位置を控える (再接続後そこから再開)"""
+        if self.current is not None and self.resume_from is None:
+            self.resume_from = (self.current, self.position, time.monotonic())
+
+    def voice_restored(self) -> None:
+        self.post("restored")
+
+    def voice_lost(self) -> None:
+        """再接続を諦めたので再生を止める"""
+        self.resume_from = None
+        self.post("stop")
+
+    def _apply(self, op: str, arg: Any) -> None:
+        """1 コマンドを状態へ反映 (すべて定数時間)"""
+        voice = self.voice
+        active = (
+            voice is not None and voice.is_connected()
+            and (voice.is_playing() or voice.is_paused())
+        )
+        if op == "enqueue":
+            self.queue.extend(arg)
+        elif op == "skip":
+            if active:
+                voice.stop()
+        elif op == "seek":
+            if active:
+                self.seek_requested_at = time.perf_counter()
+                self.seek_to = arg
+                self.seeking = True
+                voice.stop()
+        elif op == "pause":
+            # arg: True で一時停止 / False で再開 / None で切り替え
+            if not active:
+                return
+            pause = not voice.is_paused() if arg is None else arg
+            if pause and voice.is_playing():
+                voice.pause()
+                self.status = PlayerStatus.PAUSED
+            elif not pause and voice.is_paused():
+                voice.resume()
+                self.status = PlayerStatus.PLAYING
+        elif op == "loop":
+            self.loop = arg
+        elif op == "stop":
+            self.status = PlayerStatus.STOPPED
+            if active:
+                voice.stop()
+        elif op == "restored":
+            # ソースが切断を生き延びていればそのまま続行
+            if self.resume_from is not None and active:
+                _, _, dropped = self.resume_from
+                self.resume_from = None
+                self._record_resume(dropped, self.position)
+        elif op != "finished":
+            logger.warning("unknown player command: %s", op)
+
+    def _handle(self, op: str, arg: Any, fut: asyncio.Future | None) -> None:
+        self._apply(op, arg)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    async def player_loop(self):
         """
-        キューが続く限り再生し続けるループ。
-        self.current に再生中タプル (title,url) をセットし、
-        曲が変わるたびに refresh_queue() を呼んで Embed を更新。
+        ギルドの再生アクター本体。
+        キューが続く限り再生し、曲の終了も含めたすべてのイベントを
+        受信箱から受け取って処理する (ポーリングなし)。
         """
-        while True:
-            self.play_next.clear()
-
-            # キューが空なら 5 秒待機→まだ空なら切断
-            if not self.queue:
-                await asyncio.sleep(5)
-                if not self.queue:
-                    await voice.disconnect()
-                    if self.queue_msg:
-                        try:
-                            await self.queue_msg.delete()
-                        except Exception:
-                            pass
-                        self.queue_msg = None
-                        self.panel_owner = None
-                    return
+        try:
+            while self.status is not PlayerStatus.STOPPED:
+                # キューが空ならコマンドを待つ → IDLE_TIMEOUT 秒来なければ切断
+                if self.current is None and not self.queue:
+                    self.status = PlayerStatus.IDLE
+                    try:
+                        op, arg, fut = await asyncio.wait_for(self.inbox.get(), IDLE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        await self._leave()
+                        return
+                    self._handle(op, arg, fut)
+                    continue
 
-            # 再生準備
-            self.current = self.queue[0]
-            seek_pos = self.seek_to
-            announce = not self.seeking
-            self.seek_to = None
-            self.seeking = False
-            title, url = self.current.title, self.current.url
-            self.is_paused = False
-            self.pause_offset = 0
-
-            before_opts = ""
-            if seek_pos is not None:
-                before_opts += f"-ss {seek_pos} "
-            before_opts += (
-                "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
-                if is_http_source(url) else ""
-            )
-            try:
-                ffmpeg_audio = discord.FFmpegPCMAudio(
-                    source=url,
-                    executable="ffmpeg",
-                    before_options=before_opts.strip(),
-                    options='-vn -loglevel warning -af "volume=0.9"'
-                )
-                voice.play(ffmpeg_audio, after=lambda _: self.play_next.set())
-            except FileNotFoundError:
-                logger.error("ffmpeg executable not found")
-                await channel.send(
-                    "⚠️ **ffmpeg が見つかりません** — サーバーに ffmpeg をインストールして再試行してください。",
-                    delete_after=5
-                )
-                cleanup_track(self.queue.popleft())
-                continue
-            except Exception as e:
-                logger.error(f"ffmpeg 再生エラー: {e}")
-                await channel.send(
-                    f"⚠️ `{title}` の再生に失敗しました（{e}）",
-                    delete_after=5
-                )
-                cleanup_track(self.queue.popleft())
-                continue
+                if not await self._start_current():
+                    continue
+
+                progress_task = asyncio.create_task(progress_updater(self))
+                try:
+                    await self._wait_finished()
+                finally:
+                    progress_task.cancel()
+                self.source = None
+                if self.status is PlayerStatus.STOPPED:
+                    break
+                if self.resume_from is not None:
+                    # 切断でソースが落ちた: 再接続を待って控えた位置から再開
+                    if not await self._wait_restored():
+                        logger.warning("voice did not come back, stopping playback")
+                        self.resume_from = None
+                        break
+                    self.seek_to = self.resume_from[1]
+                    self.seeking = True
+                if self.seek_to is not None:
+                    await refresh_queue(self)
+                    continue
 
-            self.start_time = time.time() - (seek_pos or 0)
+                # ループOFFなら再生し終えた曲を破棄、キューループなら末尾へ戻す
+                # (曲ループなら current をそのまま再生し直す)
+                if self.loop == 0:
+                    self._release_current()
+                    cleanup_track(self.current)
+                    self.current = None
+                elif self.loop == 2:
+                    self._release_current()
+                    drop_stream_cache(self.current)
+                    self.queue.append(self.current)
+                    self.current = None
 
+                await refresh_queue(self)
+        finally:
+            # 取り残されたコマンドも反映してから待機者を解放
+            while not self.inbox.empty():
+                self._handle(*self.inbox.get_nowait())
+
+    async def _start_current(self) -> bool:
+        """current (無ければキュー先頭) を再生開始。失敗したら曲を外して False"""
+        voice, channel = self.voice, self.channel
+        if self.current is None:
+            self.current = self.queue.popleft()
+        seek_pos = self.seek_to
+        announce = not self.seeking
+        self.seek_to = None
+        self.seeking = False
+        track = self.current
+        title = track.title
+
+        # シーク時はローカルの先読みファイルを優先。無ければ期限切れ URL を取り直す
+        if track.cache_path and os.path.exists(track.cache_path):
+            url = track.cache_path
+        else:
+            # URL が空なのは再起動前に保存した曲 (元ページから取り直す)
+            if not track.url or (is_http_source(track.url) and stream_expired(track.url)):
+                try:
+                    await refresh_stream_url(track)
+                except Exception as e:
+                    logger.error("stream url refresh failed (%s): %s", title, e)
+            url = track.url
+
+        before_opts = ""
+        if seek_pos is not None:
+            # -i より前の -ss は入力側の高速シーク (Range 対応ならその位置から取得)
+            before_opts += f"-ss {seek_pos} "
+        before_opts += (
+            "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+            if is_http_source(url) else ""
+        )
+        self._generation += 1
+        gen = self._generation
+        loop = asyncio.get_running_loop()
+        first_frame: list[Callable[[], None]] = []
+        user_seek = seek_pos is not None and self.seek_requested_at is not None
+        if user_seek:
+            requested, self.seek_requested_at = self.seek_requested_at, None
+            first_frame.append(lambda: self._record_seek_latency(requested))
+        if self.resume_from is not None:
+            dropped = self.resume_from[2]
+            self.resume_from = None
+            first_frame.append(lambda: self._record_resume(dropped, seek_pos or 0))
+
+        def on_first_frame() -> None:
+            for callback in first_frame:
+                callback()
 
+        try:
+            ffmpeg_audio = discord.FFmpegPCMAudio(
+                source=url,
+                executable="ffmpeg",
+                before_options=before_opts.strip(),
+                options='-vn -loglevel warning -af "volume=0.9"'
+            )
+            source = PlaybackSource(
+                ffmpeg_audio, on_first_frame if first_frame else None, start=seek_pos or 0
+            )
+            # 終了通知は音声スレッドから受信箱へ
+            voice.play(
+                source,
+                after=lambda _: loop.call_soon_threadsafe(
+                    self.inbox.put_nowait, ("finished", gen, None)
+                ),
+            )
+        except FileNotFoundError:
+            logger.error("ffmpeg executable not found")
+            await channel.send(
+                "⚠️ **ffmpeg が見つかりません** — サーバーに ffmpeg をインストールして再試行してください。",
+                delete_after=5
+            )
+            self._release_current()
+            cleanup_track(self.current)
+            self.current = None
+            return False
+        except Exception as e:
+            logger.error(f"ffmpeg 再生エラー: {e}")
+            await channel.send(
+                f"⚠️ `{title}` の再生に失敗しました（{e}）",
+                delete_after=5
+            )
+            self._release_current()
+            cleanup_track(self.current)
+            self.current = None
+            return False
 
+        self.status = PlayerStatus.PLAYING
+        self.source = source
+        if (
+            (SEEK_PREFETCH_ALWAYS or user_seek)
+            and not track.cache_path and is_http_source(url)
+            and (self.prefetch_task is None or self.prefetch_task.done())
+        ):
+            self.prefetch_task = asyncio.create_task(prefetch_stream(track))
 
-            # チャット通知 & Embed 更新
-            if announce:
-                await channel.send(f"▶️ **Now playing**: {title}")
-            await refresh_queue(self)
+        # チャット通知 & Embed 更新
+        if announce:
+            await channel.send(f"▶️ **Now playing**: {title}")
+        await refresh_queue(self)
+        return True
 
-            progress_task = asyncio.create_task(progress_updater(self))
+    def _record_seek_latency(self, requested: float) -> None:
+        """シーク要求から最初の音声フレームまでの時間を記録 (音声スレッドから呼ばれる)"""
+        latency = time.perf_counter() - requested
+        self.seek_latencies.append(latency)
+        SEEK_LATENCY.observe(latency)
+        logger.info("seek latency %.0f ms", latency * 1000)
+
+    def _record_resume(self, dropped: float, position: float) -> None:
+        """切断から音が戻るまでに失われた再生時間を記録"""
+        lost = time.monotonic() - dropped
+        self.reconnect_losses.append(lost)
+        RECONNECT_LOSS.observe(lost)
+        title = self.current.title if self.current else "?"
+        logger.info(
+            "resumed %s at %s after voice reconnect, %.1fs of playback lost",
+            title, fmt_time(position), lost,
+        )
 
-            # 次曲まで待機
-            await self.play_next.wait()
-            progress_task.cancel()
-            self.start_time = None
-            if self.seek_to is not None:
-                await refresh_queue(self)
-                continue
+    async def _wait_restored(self) -> bool:
+        """ボイスの再接続を待つ。戻れば True、停止・タイムアウトなら False"""
+        self.status = PlayerStatus.RECONNECTING
+        if self.voice and self.voice.is_connected():   # 先に戻っていた
+            return True
+        deadline = asyncio.get_running_loop().time() + RESUME_TIMEOUT
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            try:
+                op, arg, fut = await asyncio.wait_for(self.inbox.get(), max(0, remaining))
+            except asyncio.TimeoutError:
+                return False
+            if op == "restored":
+                if fut is not None and not fut.done():
+                    fut.set_result(None)
+                return True
+            self._handle(op, arg, fut)
+            if self.status is PlayerStatus.STOPPED:
+                return False
+
+    def _release_current(self) -> None:
+        """current を手放す前に先読みを止める"""
+        if self.prefetch_task and not self.prefetch_task.done():
+            self.prefetch_task.cancel()
+        self.prefetch_task = None
 
-            # ループOFFなら再生し終えた曲をキューから外す
-            if self.loop == 0 and self.queue:
-                finished = self.queue.popleft()
-                cleanup_track(finished)
-            elif self.loop == 2 and self.queue:
-                self.queue.rotate(-1)
+    async def _wait_finished(self) -> None:
+        """再生中の曲が終わるまで受信箱のコマンドを処理"""
+        while True:
+            op, arg, fut = await self.inbox.get()
+            if op == "finished":
+                if arg == self._generation:
+                    return
+                continue   # 以前のソースの終了通知
+            self._handle(op, arg, fut)
+            if op == "enqueue":
+                await refresh_queue(self)
 
-            await refresh_queue(self)
+    async def _leave(self) -> None:
+        """キューが空のまま待機時間を過ぎたので VC から抜ける"""
+        if self.voice:
+            await self.voice.disconnect()
+        if self.queue_msg:
+            try:
+                await self.queue_msg.delete()
+            except Exception:
+                pass
+            self.queue_msg = None
+            self.panel_owner = None
 
 
 # クラス外でOK
@@ -787,57 +1334,35 @@ async def refresh_queue(state: "MusicState"):
     except discord.HTTPException:
         pass
 
+PROGRESS_INTERVAL = 5   # シークバーを見直す間隔 (秒)
+
 async def progress_updater(state: "MusicState"):
-    """再生中は1秒ごとにシークバーを更新"""
+    """再生中はシークバーの表示が変わった時だけパネルを更新"""
+    shown = progress_line(state)
     try:
         while True:
-            await asyncio.sleep(1)
-            await refresh_queue(state)
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            line = progress_line(state)
+            if line != shown:   # 一時停止中・バッファ待ちの間は編集しない
+                shown = line
+                await refresh_queue(state)
     except asyncio.CancelledError:
         pass
 
-# ──────────── 🖼 名言化 APIヘルパ ────────────
-import pathlib
-
-FAKEQUOTE_URL = "https://api.voids.top/fakequote"
-
-async def make_quote_image(user, text, color=False) -> pathlib.Path:
-    """FakeQuote API で名言カードを生成しローカル保存 → Path を返す"""
-    payload = {
-        "username"    : user.name,
-        "display_name": user.display_name,
-        "text"        : text[:200],
-        "avatar"      : user.display_avatar.url,
-        "color"       : color,
-    }
-
-    async with aiohttp.ClientSession() as sess:
-        async with sess.post(
-            FAKEQUOTE_URL,
-            json=payload,
-            headers={"Accept": "text/plain"},
-            timeout=10
-        ) as r:
-            # 200, 201 どちらも成功扱いにする
-            raw = await r.text()
-            # Content-Type が text/plain でも JSON が来るので自前でパースを試みる
-            try:
-                data = json.loads(raw)
-                if not data.get("success", True):
-                    raise RuntimeError(data)
-                img_url = data["url"]
-            except json.JSONDecodeError:
-                # プレーンで URL だけ返ってきた場合
-                img_url = raw.strip()
-
-        async with sess.get(img_url) as img:
-            img_bytes = await img.read()
+# ──────────── 🖼 名言カード ────────────
+# PNG キャッシュの上限はメモリプロファイルに合わせる
+quote_cards = QuoteCardRenderer(
+    font_path=os.getenv("QUOTE_FONT"),
+    max_bytes=MEMORY_PROFILE.quote_cache_mb * 1024 * 1024,
+)
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-        tmp.write(img_bytes)
-        tmp_path = pathlib.Path(tmp.name)
 
-    return tmp_path
+async def make_quote_image(user, text, color=False) -> bytes:
+    """名言カードを生成して PNG を返す"""
+    asset = user.display_avatar.with_size(512).with_static_format("png")
+    # アイコンの URL はハッシュ入りなので、変われば別のキーになる
+    avatar = await content_cache.fetch(asset.url, ttl=24 * 3600, namespace="avatar")
+    return await quote_cards.render(asset.url, avatar.data, text[:200], user.display_name, user.name, color)
 
 # ──────────── ボタン付き View ────────────
 
@@ -859,15 +1384,18 @@ class QuoteView(discord.ui.View):
 
 
     async def _regen(self, interaction: discord.Interaction):
-        path = await make_quote_image(**self.payload)
+        gid = interaction.guild.id if interaction.guild else None
+        try:
+            rate_limiter.take("quote", QUOTE_LIMITS, interaction.user.id, gid)
+            async with rate_limiter.slot("quote", QUOTE_LIMITS):
+                png = await make_quote_image(**self.payload)
+        except (RateLimited, Busy) as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
+            return
         await interaction.response.edit_message(
-            attachments=[discord.File(path, filename=path.name)],
+            attachments=[discord.File(io.BytesIO(png), filename="quote.png")],
             view=self
         )
-        try:
-            path.unlink()
-        except Exception:
-            pass
 
 
     @discord.ui.button(label="🎨 カラー", style=discord.ButtonStyle.success)
@@ -899,12 +1427,16 @@ class QuoteView(discord.ui.View):
 
 # ──────────── 🎵  VCユーティリティ ────────────
 guild_states: dict[int, "MusicState"] = {}
-voice_lock = asyncio.Lock()
-last_4022: dict[int, float] = {}
+VOICE_CONNECT_TIMEOUT = 10       # 接続 1 回あたりのタイムアウト (秒)
+VOICE_MAX_HANDSHAKES = 4         # 全ギルド合計で同時に行う接続の上限
+VOICE_4022_COOLDOWN = 60         # 4022 を受けたギルドへの接続を止める秒数
+voice_manager = VoiceManager(max_handshakes=VOICE_MAX_HANDSHAKES)
 
 class YoneVoiceClient(discord.VoiceClient):
+    def _music_state(self) -> "MusicState | None":
+        return guild_states.get(self.guild.id)
+
     async def poll_voice_ws(self, reconnect: bool) -> None:
-        backoff = discord.utils.ExponentialBackoff()
         while True:
             try:
                 await self.ws.poll_event()
@@ -916,32 +1448,49 @@ class YoneVoiceClient(discord.VoiceClient):
                         break
                     if exc.code == 4014:
                         logger.info('Disconnected from voice by force... potentially reconnecting.')
+                        if state := self._music_state():
+                            state.voice_dropped()
                         successful = await self.potential_reconnect()
                         if not successful:
                             logger.info('Reconnect was unsuccessful, disconnecting from voice normally...')
+                            if state := self._music_state():
+                                state.voice_lost()
                             await self.disconnect()
                             break
                         else:
+                            if state := self._music_state():
+                                state.voice_restored()
                             continue
                     if exc.code == 4022:
-                        last_4022[self.guild.id] = time.time()
-                        logger.warning('Received 4022, suppressing reconnect for 60s')
+                        voice_manager.trip(self.guild.id, VOICE_4022_COOLDOWN)
+                        logger.warning('Received 4022, suppressing reconnect for %ds', VOICE_4022_COOLDOWN)
                         await self.disconnect()
                         break
                 if not reconnect:
                     await self.disconnect()
                     raise
 
-                retry = backoff.delay()
+                retry = voice_manager.next_reconnect_delay(self.guild.id)
+                if retry is None:
+                    logger.warning('Too many voice reconnects in guild %s, giving up for now.', self.guild.id)
+                    if state := self._music_state():
+                        state.voice_lost()
+                    await self.disconnect()
+                    break
+                if state := self._music_state():
+                    state.voice_dropped()
                 logger.exception('Disconnected from voice... Reconnecting in %.2fs.', retry)
                 self._connected.clear()
                 await asyncio.sleep(retry)
                 await self.voice_disconnect()
                 try:
-                    await self.connect(reconnect=True, timeout=self.timeout)
+                    async with voice_manager.handshake(self.guild.id, count_failure=False):
+                        await self.connect(reconnect=True, timeout=self.timeout)
                 except asyncio.TimeoutError:
                     logger.warning('Could not connect to voice... Retrying...')
                     continue
+                if state := self._music_state():
+                    state.voice_restored()
 
 
 async def ensure_voice(msg: discord.Message, self_deaf: bool = True) -> discord.VoiceClient | None:
@@ -950,27 +1499,33 @@ async def ensure_voice(msg: discord.Message, self_deaf: bool = True) -> discord.
         await msg.reply("🎤 まず VC に入室してからコマンドを実行してね！")
         return None
 
-    if time.time() - last_4022.get(msg.guild.id, 0) < 60:
-        return None
-
     voice = msg.guild.voice_client
     if voice and voice.is_connected():                 # すでに接続済み
         if voice.channel != msg.author.voice.channel:  # 別チャンネルなら移動
             await voice.move_to(msg.author.voice.channel)
         return voice
 
-    # 未接続 → 接続を試みる（10 秒タイムアウト）
+    def connected() -> discord.VoiceClient | None:
+        vc = msg.guild.voice_client
+        return vc if vc and vc.is_connected() else None
+
+    # 未接続 → 接続を試みる（ギルドごとに直列化、10 秒タイムアウト）
     try:
-        async with voice_lock:
-            if msg.guild.voice_client and msg.guild.voice_client.is_connected():
-                return msg.guild.voice_client
-            return await asyncio.wait_for(
-                msg.author.voice.channel.connect(self_deaf=self_deaf, cls=YoneVoiceClient),
-                timeout=10
-            )
+        return await voice_manager.connect(
+            msg.guild.id,
+            lambda: msg.author.voice.channel.connect(self_deaf=self_deaf, cls=YoneVoiceClient),
+            timeout=VOICE_CONNECT_TIMEOUT,
+            existing=connected,
+        )
+    except VoiceCircuitOpen as e:
+        await msg.reply(
+            f"⚠️ VC への接続を一時停止しています。{int(e.retry_after) + 1}秒ほど待ってから試してね！",
+            delete_after=5
+        )
+        return None
     except discord.errors.ConnectionClosed as e:
         if e.code == 4022:
-            last_4022[msg.guild.id] = time.time()
+            voice_manager.trip(msg.guild.id, VOICE_4022_COOLDOWN)
         await msg.reply("⚠️ VC への接続に失敗しました。", delete_after=5)
         return None
     except asyncio.TimeoutError:
@@ -982,48 +1537,72 @@ async def ensure_voice(msg: discord.Message, self_deaf: bool = True) -> discord.
 
 
 # ──────────── 🎵  Queue UI ここから ────────────
+QUEUE_PAGE_SIZE = 10       # 1 ページの曲数 (削除ボタンの数と同じ)
+# Embed のフィールド値は 1024 文字まで。そこから 1 行の最大長を決める
+QUEUE_LINE_MAX = (1024 - (QUEUE_PAGE_SIZE - 1)) // QUEUE_PAGE_SIZE
+QUEUE_PAGE_CACHE = 32      # 描画済みページを何ページ分覚えておくか
+
+
+def queue_page_count(state: "MusicState") -> int:
+    return max(1, -(-len(state.queue) // QUEUE_PAGE_SIZE))
+
+
+def queue_page(state: "MusicState") -> int:
+    """表示中のページ番号を範囲内に丸めて返す"""
+    state.page = max(0, min(state.page, queue_page_count(state) - 1))
+    return state.page
+
+
+def render_queue_page(state: "MusicState", page: int) -> str:
+    """キューの 1 ページ分を文字列化 (キューが変わるまでキャッシュ)"""
+    if state.page_cache_version != state.queue.version:
+        state.page_cache.clear()
+        state.page_cache_version = state.queue.version
+    body = state.page_cache.get(page)
+    if body is None:
+        start = page * QUEUE_PAGE_SIZE
+        lines = []
+        for i, tr in enumerate(state.queue.page(start, QUEUE_PAGE_SIZE), start + 1):
+            line = f"{num_emoji(i)} {tr.title}"
+            if len(line) > QUEUE_LINE_MAX:
+                line = line[:QUEUE_LINE_MAX - 1] + "…"
+            lines.append(line)
+        body = "\n".join(lines) or "Empty"
+        if len(state.page_cache) >= QUEUE_PAGE_CACHE:
+            state.page_cache.pop(next(iter(state.page_cache)))
+        state.page_cache[page] = body
+    return body
+
+
+def progress_line(state: "MusicState") -> str | None:
+    """シークバー行 (長さ不明・未再生なら None)"""
+    if state.source is None or not state.current or not state.current.duration:
+        return None
+    pos = int(state.position)
+    bar = make_bar(pos, state.current.duration)
+    return f"[{bar}] {fmt_time(pos)} / {fmt_time(state.current.duration)}"
+
+
 def make_embed(state: "MusicState") -> discord.Embed:
     emb = discord.Embed(title="🎶 Queue")
 
     # Now Playing
     if state.current:
         emb.add_field(name="▶️ Now Playing:", value=state.current.title, inline=False)
-        if state.start_time is not None and state.current.duration:
-            if state.is_paused:
-                pos = int(state.pause_offset)
-            else:
-                pos = int(time.time() - state.start_time)
-            pos = max(0, min(pos, state.current.duration))
-            bar = make_bar(pos, state.current.duration)
-            emb.add_field(
-                name=f"[{bar}] {fmt_time(pos)} / {fmt_time(state.current.duration)}",
-                value="\u200b",
-                inline=False
-            )
+        if line := progress_line(state):
+            emb.add_field(name=line, value="\u200b", inline=False)
     else:
         emb.add_field(name="Now Playing", value="Nothing", inline=False)
 
-    # Up Next
-    queue_list = list(state.queue)
-    if state.current in queue_list:   # どこにあっても 1 回だけ除外
-        queue_list.remove(state.current)
-
-    if queue_list:
-        lines, chars = [], 0
-        for i, tr in enumerate(queue_list, 1):
-            line = f"{num_emoji(i)} {tr.title}"
-            if chars + len(line) + 1 > 800:
-                lines.append(f"…and **{len(queue_list)-i+1}** more")
-                break
-            lines.append(line)
-            chars += len(line) + 1
-        body = "\n".join(lines)
-    else:
-        body = "Empty"
-
-    emb.add_field(name="Up Next", value=body, inline=False)
+    # Up Next (表示中のページだけ描画)
+    page = queue_page(state)
+    name = f"Up Next ({len(state.queue)}曲)" if state.queue else "Up Next"
+    emb.add_field(name=name, value=render_queue_page(state, page), inline=False)
     loop_map = {0: "OFF", 1: "Song", 2: "Queue"}
-    footer = f"Loop: {loop_map.get(state.loop, 'OFF')} | Auto Leave: {'ON' if state.auto_leave else 'OFF'}"
+    footer = (
+        f"Page {page + 1}/{queue_page_count(state)} | "
+        f"Loop: {loop_map.get(state.loop, 'OFF')} | Auto Leave: {'ON' if state.auto_leave else 'OFF'}"
+    )
     emb.set_footer(text=footer)
     return emb
 
@@ -1056,8 +1635,7 @@ class ControlView(discord.ui.View):
     @discord.ui.button(label="⏭ Skip", style=discord.ButtonStyle.primary)
     async def _skip(self, itx: discord.Interaction, _: discord.ui.Button):
         try:
-            if self.vc.is_playing():
-                self.vc.stop()
+            await self.state.request("skip")
             new_view = QueueRemoveView(self.state, self.vc, self.owner_id)
             await itx.response.edit_message(embed=make_embed(self.state), view=new_view)
             self.state.queue_msg = itx.message
@@ -1073,7 +1651,7 @@ class ControlView(discord.ui.View):
     @discord.ui.button(label="🔀 Shuffle", style=discord.ButtonStyle.primary)
     async def _shuffle(self, itx: discord.Interaction, _: discord.ui.Button):
         try:
-            random.shuffle(self.state.queue)
+            self.state.queue.shuffle()
             new_view = QueueRemoveView(self.state, self.vc, self.owner_id)
             await itx.response.edit_message(embed=make_embed(self.state), view=new_view)
             self.state.queue_msg = itx.message
@@ -1090,16 +1668,7 @@ class ControlView(discord.ui.View):
     @discord.ui.button(label="⏯ Pause/Resume", style=discord.ButtonStyle.secondary)
     async def _pause_resume(self, itx: discord.Interaction, _: discord.ui.Button):
         try:
-            if self.vc.is_playing():
-                self.vc.pause()
-                self.state.is_paused = True
-                if self.state.start_time is not None:
-                    self.state.pause_offset = time.time() - self.state.start_time
-            elif self.vc.is_paused():
-                self.vc.resume()
-                self.state.is_paused = False
-                if self.state.start_time is not None:
-                    self.state.start_time = time.time() - self.state.pause_offset
+            await self.state.request("pause")
             new_view = QueueRemoveView(self.state, self.vc, self.owner_id)
             await itx.response.edit_message(embed=make_embed(self.state), view=new_view)
             self.state.queue_msg = itx.message
@@ -1117,7 +1686,7 @@ class ControlView(discord.ui.View):
     async def loop_toggle(self, itx: discord.Interaction, btn: discord.ui.Button):
         try:
 
-            self.state.loop = (self.state.loop + 1) % 3
+            await self.state.request("loop", (self.state.loop + 1) % 3)
             self._update_labels()
             await itx.response.edit_message(embed=make_embed(self.state), view=self)
             self.state.queue_msg = itx.message
@@ -1151,7 +1720,9 @@ class ControlView(discord.ui.View):
 # ──────────── 削除ボタン付き View ──────────
 class RemoveButton(discord.ui.Button):
     def __init__(self, index: int):
-        super().__init__(label=f"🗑 {index}", style=discord.ButtonStyle.danger, row=1 + (index - 1) // 5)
+        # index はキュー全体での番号。ページ内の位置で行を決める
+        row = 1 + ((index - 1) % QUEUE_PAGE_SIZE) // 5
+        super().__init__(label=f"🗑 {index}", style=discord.ButtonStyle.danger, row=row)
         self.index = index
 
     async def callback(self, interaction: discord.Interaction):
@@ -1162,16 +1733,14 @@ class RemoveButton(discord.ui.Button):
                 ephemeral=True,
             )
             return
-        base = 1 if view.state.current and view.state.current in view.state.queue else 0
-        remove_index = base + self.index - 1
+        remove_index = self.index - 1
         if remove_index >= len(view.state.queue):
             await interaction.response.send_message(
                 "⚠️ この操作パネルは無効です。\n`y!queue` で再表示してね！",
                 ephemeral=True,
             )
             return
-        tr = list(view.state.queue)[remove_index]
-        del view.state.queue[remove_index]
+        tr = view.state.queue.pop(remove_index)
         cleanup_track(tr)
         new_view = QueueRemoveView(view.state, view.vc, view.owner_id)
         await interaction.response.edit_message(embed=make_embed(view.state), view=new_view)
@@ -1180,16 +1749,56 @@ class RemoveButton(discord.ui.Button):
         await refresh_queue(view.state)
 
 
+class QueueJumpModal(discord.ui.Modal, title="ページ移動"):
+    page_no = discord.ui.TextInput(label="ページ番号", max_length=6)
+
+    def __init__(self, view: "QueueRemoveView"):
+        super().__init__()
+        self.view = view
+        self.page_no.placeholder = f"1〜{queue_page_count(view.state)}"
+
+    async def on_submit(self, itx: discord.Interaction):
+        value = self.page_no.value.strip()
+        if not value.isdecimal():
+            await itx.response.send_message("ページ番号は数字で入力してね！", ephemeral=True)
+            return
+        await self.view._goto(itx, int(value) - 1)
+
+
 class QueueRemoveView(ControlView):
     def __init__(self, state: "MusicState", vc: discord.VoiceClient, owner_id: int):
         super().__init__(state, vc, owner_id)
 
-        qlist = list(state.queue)
-        if state.current in qlist:
-            qlist.remove(state.current)
-        for i, _ in enumerate(qlist[:10], 1):
+        page = queue_page(state)
+        start = page * QUEUE_PAGE_SIZE
+        for i in range(start + 1, min(len(state.queue), start + QUEUE_PAGE_SIZE) + 1):
             self.add_item(RemoveButton(i))
 
+        pages = queue_page_count(state)
+        self.page_jump.label = f"📄 {page + 1}/{pages}"
+        self.page_prev.disabled = page == 0
+        self.page_next.disabled = page >= pages - 1
+        self.page_jump.disabled = pages == 1
+
+    async def _goto(self, itx: discord.Interaction, page: int):
+        self.state.page = page
+        new_view = QueueRemoveView(self.state, self.vc, self.owner_id)
+        await itx.response.edit_message(embed=make_embed(self.state), view=new_view)
+        self.state.queue_msg = itx.message
+        self.state.panel_owner = self.owner_id
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary, row=3)
+    async def page_prev(self, itx: discord.Interaction, _: discord.ui.Button):
+        await self._goto(itx, self.state.page - 1)
+
+    @discord.ui.button(label="📄 1/1", style=discord.ButtonStyle.secondary, row=3)
+    async def page_jump(self, itx: discord.Interaction, _: discord.ui.Button):
+        await itx.response.send_modal(QueueJumpModal(self))
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary, row=3)
+    async def page_next(self, itx: discord.Interaction, _: discord.ui.Button):
+        await self._goto(itx, self.state.page + 1)
+
 
 
 # ──────────── 🎵  Queue UI ここまで ──────────
@@ -1266,6 +1875,12 @@ class HelpView(discord.ui.View):
 
 # ───────────────── コマンド実装 ─────────────────
 async def cmd_ping(msg: discord.Message):
+    shard = None
+    if isinstance(client, discord.AutoShardedClient) and msg.guild:
+        shard = client.get_shard(msg.guild.shard_id)
+    if shard is not None:   # このサーバーを受け持つシャードの遅延
+        await msg.channel.send(f"Pong! `{shard.latency * 1000:.0f} ms` 🏓 (shard {shard.id}/{client.shard_count})")
+        return
     ms = client.latency * 1000
     await msg.channel.send(f"Pong! `{ms:.0f} ms` 🏓")
 
@@ -1274,6 +1889,7 @@ async def cmd_queue(msg: discord.Message, _):
     if not state:
         await msg.reply("キューは空だよ！"); return
     vc   = msg.guild.voice_client
+    state.page = 0
     view = QueueRemoveView(state, vc, msg.author.id)
     if state.queue_msg:
         try:
@@ -1321,10 +1937,14 @@ async def build_user_embed(target: discord.User | discord.Member,
     if member:
         joined = member.joined_at.strftime('%Y年%m月%d日 %a %H:%M') if member.joined_at else '—'
         embed.add_field(name="サーバー参加日", value=joined, inline=False)
-        embed.add_field(name="ステータス", value=str(member.status))
-        embed.add_field(name="デバイス別ステータス",
-                        value=f"PC:{member.desktop_status} / Mobile:{member.mobile_status} / Web:{member.web_status}",
-                        inline=False)
+        if client.intents.presences:
+            embed.add_field(name="ステータス", value=str(member.status))
+            embed.add_field(name="デバイス別ステータス",
+                            value=f"PC:{member.desktop_status} / Mobile:{member.mobile_status} / Web:{member.web_status}",
+                            inline=False)
+        else:   # presence を受け取らないプロファイルでは分からない
+            embed.add_field(name="ステータス", value='—')
+            embed.add_field(name="デバイス別ステータス", value='—', inline=False)
         embed.add_field(name="ニックネーム", value=member.nick or '—')
         roles = [r for r in member.roles if r.name != '@everyone']
         embed.add_field(name="役職数", value=str(len(roles)))
@@ -1344,14 +1964,8 @@ async def build_user_embed(target: discord.User | discord.Member,
         embed.add_field(name="権限一覧", value='—', inline=False)
         embed.add_field(name="VC参加中", value='—')
 
-    last = '—'
-    try:
-        async for m in channel.history(limit=100):
-            if m.author.id == target.id:
-                last = m.created_at.strftime('%Y年%m月%d日 %a %H:%M')
-                break
-    except Exception:
-        pass
+    found = await member_index.find_last_message(channel, target.id)
+    last = found.created_at.strftime('%Y年%m月%d日 %a %H:%M') if found else '—'
     embed.add_field(name="最後の発言", value=last, inline=False)
     return embed
 
@@ -1363,31 +1977,28 @@ async def cmd_user(msg: discord.Message, arg: str = ""):
         await msg.reply("ユーザーは1人だけ指定してください")
         return
 
-    target: discord.User | discord.Member
-
     if not arg:
-        target = msg.author
+        uid = msg.author.id
     elif arg.isdigit():
-        try:
-            target = await client.fetch_user(int(arg))
-        except discord.NotFound:
-            await msg.reply("その ID のユーザーは見つかりませんでした。")
-            return
-    elif arg.startswith("<@") and arg.endswith(">"):
-        uid = arg.removeprefix("<@").removeprefix("!").removesuffix(">")
-        try:
-            target = await client.fetch_user(int(uid))
-        except discord.NotFound:
-            await msg.reply("そのユーザーは見つかりませんでした。")
-            return
+        uid = int(arg)
+    elif arg.startswith("<@") and arg.endswith(">") and arg.removeprefix("<@").removeprefix("!")[:-1].isdigit():
+        uid = int(arg.removeprefix("<@").removeprefix("!")[:-1])
     else:
         await msg.reply("`y!user @メンション` または `y!user 1234567890` の形式で指定してね！")
         return
 
-    member: discord.Member | None = None
-    if msg.guild:
+    # キャッシュ済みの Member を優先する (presence も残っている)。無いときだけ HTTP で取る
+    member: discord.Member | None = msg.guild.get_member(uid) if msg.guild else None
+    target: discord.User | discord.Member | None = member or client.get_user(uid)
+    if target is None:
         try:
-            member = await msg.guild.fetch_member(target.id)
+            target = await client.fetch_user(uid)
+        except discord.NotFound:
+            await msg.reply("そのユーザーは見つかりませんでした。")
+            return
+    if msg.guild and member is None and not msg.guild.chunked:
+        try:
+            member = await msg.guild.fetch_member(uid)
         except discord.NotFound:
             member = None
 
@@ -1411,7 +2022,7 @@ async def cmd_server(msg: discord.Message):
         emb.add_field(name="オーナー", value=g.owner.mention, inline=False)
     emb.add_field(name="作成日", value=g.created_at.strftime('%Y年%m月%d日'))
     emb.add_field(name="メンバー数", value=str(g.member_count))
-    online = sum(1 for m in g.members if m.status != discord.Status.offline)
+    online = member_index.online(g) if client.intents.presences else '—'
     emb.add_field(name="オンライン数", value=str(online))
     emb.add_field(name="テキストCH数", value=str(len(g.text_channels)))
     emb.add_field(name="ボイスCH数", value=str(len(g.voice_channels)))
@@ -1591,36 +2202,21 @@ async def cmd_play(msg: discord.Message, query: str = "", *, first_query: bool =
         return
 
     if tracks:
-        state.queue.extend(tracks)
-        await refresh_queue(state)
+        # 再生タスクは 1 ギルド 1 本。動いていなければここで起動する
+        state.ensure_player(voice, msg.channel)
+        await state.request("enqueue", tracks)
         await msg.channel.send(f"⏱️ **{len(tracks)}曲** をキューに追加しました！")
 
 
-    # 再生していなければループを起動
-    if state.queue and not voice.is_playing() and not state.play_next.is_set():
-        client.loop.create_task(state.player_loop(voice, msg.channel))
-
-
 
 
 async def cmd_stop(msg: discord.Message, _):
     """Bot を VC から切断し、キュー初期化"""
-    if vc := msg.guild.voice_client:
-        await vc.disconnect()
     state = guild_states.pop(msg.guild.id, None)
     if state:
-        if state.playlist_task and not state.playlist_task.done():
-            state.playlist_task.cancel()
-        cleanup_track(state.current)
-        for tr in state.queue:
-            cleanup_track(tr)
-        if state.queue_msg:
-            try:
-                await state.queue_msg.delete()
-            except Exception:
-                pass
-            state.queue_msg = None
-            state.panel_owner = None
+        await state.close()
+    if vc := msg.guild.voice_client:
+        await vc.disconnect()
     await msg.add_reaction("⏹️")
 
 
@@ -1633,12 +2229,10 @@ async def cmd_remove(msg: discord.Message, arg: str):
     if not nums:
         await msg.reply("番号を指定してね！")
         return
-    q = list(state.queue)
     removed = []
     for i in sorted(set(nums), reverse=True):
-        if 1 <= i <= len(q):
-            removed.append(q.pop(i-1))
-    state.queue = collections.deque(q)
+        if 1 <= i <= len(state.queue):
+            removed.append(state.queue.pop(i-1))
     for tr in removed:
         cleanup_track(tr)
     await refresh_queue(state)
@@ -1654,15 +2248,7 @@ async def cmd_keep(msg: discord.Message, arg: str):
     if not nums:
         await msg.reply("番号を指定してね！")
         return
-    q = list(state.queue)
-    kept = []
-    removed = []
-    for i, tr in enumerate(q, 1):
-        if i in nums:
-            kept.append(tr)
-        else:
-            removed.append(tr)
-    state.queue = collections.deque(kept)
+    removed = state.queue.keep(i - 1 for i in nums)
     for tr in removed:
         cleanup_track(tr)
     await refresh_queue(state)
@@ -1691,9 +2277,7 @@ async def cmd_seek(msg: discord.Message, arg: str):
         await msg.reply(f"曲の長さは {dur//60}分{dur%60}秒です。短い時間を指定してください")
         return
 
-    state.seek_to = pos
-    state.seeking = True
-    voice.stop()
+    await state.request("seek", pos)
     await msg.channel.send(f"{fmt_time_jp(pos)}から再生します")
 
 
@@ -1715,14 +2299,7 @@ async def cmd_rewind(msg: discord.Message, arg: str):
         await msg.reply("再生中の曲がありません")
         return
 
-    if state.start_time is not None:
-        cur = state.pause_offset if state.is_paused else time.time() - state.start_time
-    else:
-        cur = 0
-    cur = max(0, int(cur))
-    if state.current.duration:
-        cur = min(cur, state.current.duration)
-
+    cur = int(state.position)
     new_pos = max(0, cur - delta)
     await cmd_seek(msg, str(new_pos))
 
@@ -1745,13 +2322,8 @@ async def cmd_forward(msg: discord.Message, arg: str):
         await msg.reply("再生中の曲がありません")
         return
 
-    if state.start_time is not None:
-        cur = state.pause_offset if state.is_paused else time.time() - state.start_time
-    else:
-        cur = 0
-    cur = max(0, int(cur))
+    cur = int(state.position)
     if state.current.duration:
-        cur = min(cur, state.current.duration)
         new_pos = min(cur + delta, state.current.duration)
     else:
         new_pos = cur + delta
@@ -1759,126 +2331,128 @@ async def cmd_forward(msg: discord.Message, arg: str):
     await cmd_seek(msg, str(new_pos))
 
 
-async def cmd_purge(msg: discord.Message, arg: str):
-    """指定数またはリンク以降のメッセージを一括削除"""
-    if not msg.guild:
-        await msg.reply("サーバー内でのみ使用できます。")
-        return
+PURGE_MAX = 1000            # 件数指定で消せる上限 (チャンネルごと)
+PURGE_MAX_CHANNELS = 10
+PURGE_USAGE = (
+    "`y!purge <数|メッセージリンク> [#チャンネル...] [@ユーザー...] [bots] [contains:文字列]` の形式で指定してね！"
+)
 
-    target_channel: discord.abc.GuildChannel = msg.channel
-    target_message: discord.Message | None = None
-    arg = arg.strip()
-    if not arg:
-        await msg.reply("`y!purge <数>` または `y!purge <メッセージリンク>` の形式で指定してね！")
-        return
 
-    if arg.isdigit():
-        limit = min(int(arg), 1000)
-    else:
-        ids = parse_message_link(arg)
-        if not ids:
-            await msg.reply("形式が正しくないよ！")
-            return
-        gid, cid, mid = ids
-        if gid != msg.guild.id:
-            await msg.reply("このサーバーのメッセージリンクを指定してね！")
-            return
-        ch = msg.guild.get_channel(cid)
-        if ch is None or not isinstance(ch, MESSAGE_CHANNEL_TYPES):
-            await msg.reply(
-                f"リンク先チャンネルが見つかりません (取得型: {type(ch).__name__ if ch else 'None'})。"
-            )
-            return
-        target_channel = ch
-        if isinstance(ch, (discord.TextChannel, discord.Thread)):
-            try:
-                target_message = await ch.fetch_message(mid)
-            except discord.NotFound:
-                await msg.reply("指定メッセージが存在しません。")
-                return
-        else:
-            try:
-                target_message = await ch.fetch_message(mid)
-            except Exception:
-                await msg.reply("このチャンネル型では purge が未対応です。")
-                return
-        limit = None
+@dataclass
+class PurgeRequest:
+    channels: list
+    check: PurgeFilter
+    limit: int | None
+    after: discord.Object | None
 
-    # 権限チェック
-    perms_user = target_channel.permissions_for(msg.author)
-    perms_bot = target_channel.permissions_for(msg.guild.me)
-    if not (perms_user.manage_messages and perms_bot.manage_messages):
-        await msg.reply("管理メッセージ権限が足りません。", delete_after=5)
-        return
 
-    deleted_total = 0
+async def _parse_purge(msg: discord.Message, arg: str) -> PurgeRequest | str:
+    """y!purge の引数を解釈する。不正なら理由の文字列を返す"""
+    try:
+        tokens = shlex.split(arg)
+    except ValueError:
+        tokens = arg.split()
+    count = None
+    link = None
+    channel_ids: list[int] = []
+    authors: set[int] = set()
+    bots_only = False
+    contains = ""
+    for tok in tokens:
+        if tok.isdigit():
+            count = min(int(tok), PURGE_MAX)
+        elif (m := re.fullmatch(r"<#(\d+)>", tok)):
+            channel_ids.append(int(m.group(1)))
+        elif (m := re.fullmatch(r"<@!?(\d+)>", tok)):
+            authors.add(int(m.group(1)))
+        elif tok.lower() in ("bot", "bots"):
+            bots_only = True
+        elif tok.lower().startswith(("contains:", "text:")):
+            contains = tok.split(":", 1)[1]
+        elif (ids := parse_message_link(tok)):
+            link = ids
+        else:
+            return f"`{tok}` が分からないよ。\n{PURGE_USAGE}"
+    if count is None and link is None:
+        return PURGE_USAGE
 
-    def _skip_cmd(m: discord.Message) -> bool:
-        if m.id == msg.id:
-            return False
-        if (
-            m.type
-            in (
-                discord.MessageType.chat_input_command,
-                discord.MessageType.context_menu_command,
-            )
-            and m.interaction
-            and m.interaction.id == msg.id
-        ):
-            return False
-        return True
+    after = None
+    if link:
+        gid, cid, mid = link
+        if gid != msg.guild.id:
+            return "このサーバーのメッセージリンクを指定してね！"
+        ch = msg.guild.get_channel_or_thread(cid)
+        if ch is None or not isinstance(ch, MESSAGE_CHANNEL_TYPES):
+            return f"リンク先チャンネルが見つかりません (取得型: {type(ch).__name__ if ch else 'None'})。"
+        try:
+            await ch.fetch_message(mid)
+        except discord.NotFound:
+            return "指定メッセージが存在しません。"
+        except discord.HTTPException:
+            return "このチャンネル型では purge が未対応です。"
+        # リンクのメッセージ自身も消す。ID は時刻順なので他のチャンネルにも使える
+        after = discord.Object(id=mid - 1)
+        if not channel_ids:
+            channel_ids.append(cid)
+    if not channel_ids:
+        channel_ids.append(msg.channel.id)
+
+    channels = []
+    for cid in dict.fromkeys(channel_ids):
+        ch = msg.guild.get_channel_or_thread(cid)
+        if ch is None or not isinstance(ch, MESSAGE_CHANNEL_TYPES):
+            return f"<#{cid}> はメッセージを削除できるチャンネルではありません。"
+        user_perms = ch.permissions_for(msg.author)
+        bot_perms = ch.permissions_for(msg.guild.me)
+        if not (user_perms.manage_messages and bot_perms.manage_messages and bot_perms.read_message_history):
+            return f"<#{cid}> で管理メッセージ権限が足りません。"
+        channels.append(ch)
+    if len(channels) > PURGE_MAX_CHANNELS:
+        return f"一度に指定できるチャンネルは {PURGE_MAX_CHANNELS} 個までです。"
+    return PurgeRequest(channels, PurgeFilter(frozenset(authors), contains, bots_only), count, after)
 
-    try:
-        if target_message is None:
-            if hasattr(target_channel, "purge"):
-                try:
-                    deleted = await target_channel.purge(limit=limit, check=_skip_cmd)
-                except discord.NotFound:
-                    deleted = []
-                deleted_total = len(deleted)
-            else:
-                msgs = [
-                    m
-                    async for m in target_channel.history(limit=limit)
-                    if _skip_cmd(m)
-                ]
-                try:
-                    await target_channel.delete_messages(msgs)
-                except discord.NotFound:
-                    pass
-                deleted_total = len(msgs)
-        else:
-            after = target_message
-            while True:
-                if hasattr(target_channel, "purge"):
-                    try:
-                        batch = await target_channel.purge(after=after, limit=100, check=_skip_cmd)
-                    except discord.NotFound:
-                        batch = []
-                else:
-                    batch = [
-                        m
-                        async for m in target_channel.history(after=after, limit=100)
-                        if _skip_cmd(m)
-                    ]
-                    try:
-                        await target_channel.delete_messages(batch)
-                    except discord.NotFound:
-                        pass
-                if not batch:
-                    break
-                deleted_total += len(batch)
-                after = batch[-1]
-            try:
-                await target_message.delete()
-                deleted_total += 1
-            except (discord.HTTPException, discord.NotFound):
-                pass
-    except discord.Forbidden:
-        await msg.reply("権限不足で削除できませんでした。", delete_after=5)
+
+async def cmd_purge(msg: discord.Message, arg: str):
+    """指定数またはリンク以降のメッセージを一括削除 (複数チャンネル・投稿者・内容で絞り込み可)"""
+    req = await _parse_purge(msg, arg.strip())
+    if isinstance(req, str):
+        await msg.reply(req, delete_after=10)
         return
 
-    await msg.channel.send(f"🧹 {deleted_total}件削除しました！", delete_after=5)
+    head = f"🧹 {req.check.describe()}\n" if req.check.describe() else ""
+    status = await msg.channel.send(f"{head}🧹 削除を開始します…")
+
+    async def show(progress: PurgeProgress) -> None:
+        await status.edit(content=head + progress.render())
+
+    engine = PurgeEngine(
+        req.channels,
+        req.check,
+        limit=req.limit,
+        after=req.after,
+        # コマンドより後のメッセージ (この進捗メッセージを含む) は対象外
+        before=discord.Object(id=msg.id),
+        on_progress=show,
+        reason=f"purge by {msg.author} ({msg.author.id})",
+    )
+    progress = await engine.run()
+    if not any(c.error for c in progress.channels.values()):
+        await status.delete(delay=10)
+
+
+code_images = CodeImageService()
+
+
+async def _send_code(msg: discord.Message, kind: str, text: str) -> None:
+    try:
+        png = await code_images.render(kind, text)
+    except CodeUnavailable as e:
+        await msg.reply(str(e))
+        return
+    except CodeError as e:
+        await msg.reply(str(e), delete_after=5)
+        return
+    await msg.channel.send(file=discord.File(io.BytesIO(png), filename=f"{kind}.png"))
 
 
 async def cmd_qr(msg: discord.Message, text: str) -> None:
@@ -1887,30 +2461,7 @@ async def cmd_qr(msg: discord.Message, text: str) -> None:
     if not text:
         await msg.reply("QRコードにする文字列を指定してね！")
         return
-
-    try:
-        import qrcode
-    except ModuleNotFoundError:
-        await msg.reply("qrcode モジュールが見つかりません。`pip install qrcode` を実行してください。")
-        return
-
-    qr = qrcode.QRCode(box_size=4, border=2)
-    qr.add_data(text)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    path = tmp.name
-    tmp.close()
-    await asyncio.to_thread(img.save, path)
-
-    try:
-        await msg.channel.send(file=discord.File(path))
-    finally:
-        try:
-            os.remove(path)
-        except Exception:
-            pass
+    await _send_code(msg, "qr", text)
 
 
 async def cmd_barcode(msg: discord.Message, text: str) -> None:
@@ -1919,31 +2470,52 @@ async def cmd_barcode(msg: discord.Message, text: str) -> None:
     if not text:
         await msg.reply("バーコードにする文字列を指定してね！")
         return
+    await _send_code(msg, "barcode", text)
 
-    try:
-        import barcode
-        from barcode.writer import ImageWriter
-        from barcode.errors import IllegalCharacterError
-    except ModuleNotFoundError:
-        await msg.reply("barcode モジュールが見つかりません。`pip install python-barcode` を実行してください。")
+
+def _split_batch(arg: str) -> tuple[list[str], bool]:
+    """`--zip a | b | c` → (["a", "b", "c"], True)。改行区切りも可"""
+    arg = arg.strip()
+    as_zip = arg.startswith("--zip")
+    if as_zip:
+        arg = arg[len("--zip"):]
+    items = [t.strip() for t in re.split(r"[|\n]", arg) if t.strip()]
+    return items, as_zip
+
+
+async def _send_code_batch(msg: discord.Message, kind: str, arg: str) -> None:
+    items, as_zip = _split_batch(arg)
+    if not items:
+        await msg.reply(f"`y!{kind}batch [--zip] 文字列1 | 文字列2 | ...` の形式で指定してね！")
         return
     try:
-        code = barcode.get("code128", text, writer=ImageWriter())
-    except IllegalCharacterError:
-        await msg.reply("Code128 では英数字など ASCII 文字のみ利用できます。", delete_after=5)
+        data, filename = await code_images.render_batch(kind, items, as_zip=as_zip)
+    except CodeUnavailable as e:
+        await msg.reply(str(e))
         return
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    path = tmp.name
-    tmp.close()
-    await asyncio.to_thread(code.write, path)
+    except CodeError as e:
+        await msg.reply(str(e), delete_after=10)
+        return
+    await msg.channel.send(file=discord.File(io.BytesIO(data), filename=filename))
 
-    try:
-        await msg.channel.send(file=discord.File(path))
-    finally:
-        try:
-            os.remove(path)
-        except Exception:
-            pass
+
+async def cmd_qr_batch(msg: discord.Message, arg: str) -> None:
+    """複数の QR コードをまとめて生成 (一覧画像か zip)"""
+    await _send_code_batch(msg, "qr", arg)
+
+
+async def cmd_barcode_batch(msg: discord.Message, arg: str) -> None:
+    """複数のバーコードをまとめて生成 (一覧画像か zip)"""
+    await _send_code_batch(msg, "barcode", arg)
+
+
+# TeX 描画ワーカー (別プロセス) と PNG キャッシュ
+tex_renderer = TexRenderer(
+    cache_dir=os.path.join(ROOT_DIR, "cache", "tex"),
+    workers=int(os.getenv("TEX_WORKERS", "2")),
+    cpu_seconds=int(os.getenv("TEX_CPU_SECONDS", "10")),
+    timeout=float(os.getenv("TEX_TIMEOUT", "20")),
+)
 
 
 async def cmd_tex(msg: discord.Message, formula: str) -> None:
@@ -1954,88 +2526,43 @@ async def cmd_tex(msg: discord.Message, formula: str) -> None:
         return
 
     try:
-        import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-    except ModuleNotFoundError:
-        await msg.reply(
-            "matplotlib モジュールが見つかりません。`pip install matplotlib` を実行してください。"
-        )
+        png = await tex_renderer.render(formula)
+    except TexUnavailable as e:
+        await msg.reply(str(e))
         return
-
-    # Verify external LaTeX tools are available before enabling text.usetex
-    if not shutil.which("latex") or not shutil.which("dvipng"):
-        await msg.reply(
-            "LaTeX 環境 (latex, dvipng) が見つかりません。インストールしてください。"
-        )
+    except TexTimeout as e:
+        await msg.reply(f"数式が複雑すぎるよ！ ({e})")
+        return
+    except TexError as e:
+        logger.warning("TeX rendering failed: %s", e)
+        await msg.reply(f"数式の構文が間違っているよ！\n```\n{str(e)[:1500]}\n```")
         return
 
-    plt.rcParams.update(
-        {
-            "text.usetex": True,
-            "font.family": "serif",
-            "text.latex.preamble": r"\usepackage{amsmath}",
-        }
-    )
+    await msg.channel.send(file=discord.File(io.BytesIO(png), filename="tex.png"))
 
 
-    # 余白を抑えるため一度描画し、テキストの bbox からキャンバスサイズを求める
-    dpi = 300
-    pad = 0.05
-    fig = plt.figure(dpi=dpi)
 
-    text = fig.text(
-        0,
-        0,
-        f"${formula}$",
-        fontsize=20,
-        ha="left",
-        va="bottom",
-    )
-    try:
-        fig.canvas.draw()
-        bbox = text.get_window_extent()
-        width, height = bbox.width / dpi, bbox.height / dpi
-        fig.set_size_inches(width * (1 + pad), height * (1 + pad))
-        text.set_position((pad / 2, pad / 2))
-        text.set_transform(fig.transFigure)
-        fig.canvas.draw()
-    except Exception as e:
-        plt.close(fig)
-        err = str(e)
-        logger.exception("TeX rendering failed: %s", err)
-        if "latex could not be found" in err or "dvipng was not found" in err:
-            await msg.reply(
-                "LaTeX 環境 (latex, dvipng) が見つかりません。インストールしてください。"
-            )
-        else:
-            await msg.reply(f"数式の構文が間違っているよ！\n```\n{err}\n```")
-        return
 
+# ──────────── メンバー活動インデックスの更新 ────────────
 
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    path = tmp.name
-    tmp.close()
-    await asyncio.to_thread(
-        fig.savefig,
-        path,
-        dpi=dpi,
-        transparent=True,
-        pad_inches=0.05,
+@client.event
+async def on_presence_update(before: discord.Member, after: discord.Member):
+    member_index.on_presence_update(before, after)
 
-    )
-    plt.close(fig)
 
-    try:
-        await msg.channel.send(file=discord.File(path))
-    finally:
-        try:
-            os.remove(path)
-        except Exception:
-            pass
+@client.event
+async def on_member_join(member: discord.Member):
+    member_index.on_member_join(member)
 
 
+@client.event
+async def on_member_remove(member: discord.Member):
+    member_index.on_member_remove(member)
+
 
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+    member_index.forget_guild(guild.id)
 
 # ──────────── 🎵  自動切断ハンドラ ────────────
 
@@ -2052,28 +2579,133 @@ async def on_voice_state_update(member, before, after):
 
     # VC 内のヒト(≠bot) が 0 人になった & auto_leave が有効？
     if len([m for m in voice.channel.members if not m.bot]) == 0 and state.auto_leave:
+        st = guild_states.pop(member.guild.id, None)
         try:
-            await voice.disconnect()
-        finally:
-            st = guild_states.pop(member.guild.id, None)
             if st:
-                if st.playlist_task and not st.playlist_task.done():
-                    st.playlist_task.cancel()
-                cleanup_track(st.current)
-                for tr in st.queue:
-                    cleanup_track(tr)
-                if st.queue_msg:
-                    try:
-                        await st.queue_msg.delete()
-                    except Exception:
-                        pass
-                    st.queue_msg = None
-                    st.panel_owner = None
+                await st.close()
+        finally:
+            await voice.disconnect()
+
+
+# ──────────── 🎵  再起動をまたいだ再生の引き継ぎ ────────────
+def _saved_player(guild_id: int, state: MusicState) -> music_store.SavedPlayer | None:
+    """再生状態を保存用に変換 (VC か通知先が無ければ None)"""
+    voice = state.voice
+    if voice is None or voice.channel is None or state.channel is None:
+        return None
+    current, position = state.current, state.position
+    if state.resume_from is not None:       # 再接続待ちの間は控えた位置
+        current, position = state.resume_from[0], state.resume_from[1]
+    elif state.seek_to is not None:         # シークの途中
+        position = state.seek_to
+    tracks = []
+    playing = False
+    if current is not None:
+        saved = music_store.compact_track(current.title, current.url, current.duration, current.page_url)
+        if saved is not None:
+            tracks.append(saved)
+            playing = True
+    for tr in state.queue:
+        saved = music_store.compact_track(tr.title, tr.url, tr.duration, tr.page_url)
+        if saved is not None:
+            tracks.append(saved)
+    if not tracks:
+        return None
+    return music_store.SavedPlayer(
+        guild_id, voice.channel.id, state.channel.id,
+        loop=state.loop, auto_leave=state.auto_leave,
+        position=position if playing else 0.0, playing=playing, tracks=tracks,
+    )
+
+
+async def save_music_states() -> None:
+    """全ギルドの再生状態をファイルに書き、再生を止めて VC から抜ける"""
+    players = [
+        saved for gid, state in guild_states.items()
+        if (saved := _saved_player(gid, state)) is not None
+    ]
+    try:
+        await asyncio.to_thread(music_store.save, MUSIC_STATE_FILE, players)
+    except OSError as e:
+        logger.error("failed to save player state: %s", e)
+    for gid in list(guild_states):
+        state = guild_states.pop(gid)
+        try:
+            await state.close()
+            if state.voice and state.voice.is_connected():
+                await state.voice.disconnect(force=True)
+        except Exception as e:
+            logger.warning("failed to stop player in guild %s: %s", gid, e)
+
+
+async def _resume_player(saved: music_store.SavedPlayer) -> None:
+    guild = client.get_guild(saved.guild_id)
+    if guild is None or guild.id in guild_states:   # 別のシャードのギルド / 既に再生中
+        return
+    voice_channel = guild.get_channel(saved.voice_channel_id)
+    text_channel = guild.get_channel_or_thread(saved.text_channel_id)
+    if not isinstance(voice_channel, (discord.VoiceChannel, discord.StageChannel)):
+        return
+    if not isinstance(text_channel, MESSAGE_CHANNEL_TYPES):
+        return
+    if saved.auto_leave and not any(not m.bot for m in voice_channel.members):
+        logger.info("not resuming playback in guild %s: voice channel is empty", guild.id)
+        return
+
+    def connected() -> discord.VoiceClient | None:
+        vc = guild.voice_client
+        return vc if vc and vc.is_connected() else None
+
+    try:
+        voice = await voice_manager.connect(
+            guild.id,
+            lambda: voice_channel.connect(self_deaf=True, cls=YoneVoiceClient),
+            timeout=VOICE_CONNECT_TIMEOUT,
+            existing=connected,
+        )
+    except (VoiceCircuitOpen, discord.errors.ConnectionClosed, discord.ClientException, asyncio.TimeoutError) as e:
+        logger.warning("could not rejoin voice in guild %s: %s", guild.id, e)
+        return
+
+    tracks = [Track(title, url, duration, page_url) for title, url, duration, page_url in saved.tracks]
+    state = guild_states.setdefault(guild.id, MusicState())
+    state.loop, state.auto_leave = saved.loop, saved.auto_leave
+    if saved.playing:
+        state.current = tracks.pop(0)
+        if saved.position >= 1:
+            state.seek_to = int(saved.position)
+        state.seeking = True        # 「Now playing」は出さない
+    state.queue.extend(tracks)
+    state.ensure_player(voice, text_channel)
+    where = f" ({fmt_time(int(saved.position))} から)" if saved.playing else ""
+    try:
+        await text_channel.send(f"🔁 再起動前の再生を再開します{where}", delete_after=15)
+    except discord.HTTPException:
+        pass
+    logger.info("resumed playback in guild %s (%d tracks)", guild.id, len(saved.tracks))
+
+
+async def restore_music_states() -> None:
+    """前回の終了時に保存した再生状態を読み、VC に入り直して続きから再生する"""
+    players = await asyncio.to_thread(music_store.load, MUSIC_STATE_FILE, MUSIC_RESUME_MAX_AGE)
+    # このプロセスに無いギルド (シャードの割り当てが変わったなど) は手を付けずに残す
+    mine = [p for p in players if client.get_guild(p.guild_id) is not None]
+    others = [p for p in players if client.get_guild(p.guild_id) is None]
+    results = await asyncio.gather(*(_resume_player(p) for p in mine), return_exceptions=True)
+    for saved, result in zip(mine, results):
+        if isinstance(result, Exception):
+            logger.error("failed to resume playback in guild %s: %r", saved.guild_id, result)
+    # 再開を試みた分を消す (残りが無ければファイルごと消える)
+    try:
+        await asyncio.to_thread(music_store.save, MUSIC_STATE_FILE, others)
+    except OSError as e:
+        logger.error("failed to update saved player state: %s", e)
 
 
 
 async def cmd_poker(msg: discord.Message, arg: str = ""):
     """Start a heads-up poker match."""
+    from .poker import PokerMatch, PokerView
     arg = arg.strip()
     opponent: discord.User | None = None
     if arg:
@@ -2124,12 +2756,6 @@ def _parse_channel(arg: str, guild: discord.Guild | None) -> discord.TextChannel
 
 async def cmd_news(msg: discord.Message, arg: str) -> None:
     """ニュース送信先チャンネルを設定"""
-    if not msg.guild:
-        await msg.reply("サーバー内でのみ使用できます。")
-        return
-    if not msg.author.guild_permissions.administrator:
-        await msg.reply("管理者専用コマンドです。", delete_after=5)
-        return
     channel = _parse_channel(arg, msg.guild) or (
         msg.channel if isinstance(msg.channel, discord.TextChannel) else None
     )
@@ -2148,12 +2774,6 @@ async def cmd_news(msg: discord.Message, arg: str) -> None:
 
 async def cmd_eew(msg: discord.Message, arg: str) -> None:
     """地震速報送信先チャンネルを設定"""
-    if not msg.guild:
-        await msg.reply("サーバー内でのみ使用できます。")
-        return
-    if not msg.author.guild_permissions.administrator:
-        await msg.reply("管理者専用コマンドです.", delete_after=5)
-        return
     channel = _parse_channel(arg, msg.guild) or (
         msg.channel if isinstance(msg.channel, discord.TextChannel) else None
     )
@@ -2171,12 +2791,6 @@ async def cmd_eew(msg: discord.Message, arg: str) -> None:
 
 async def cmd_weather(msg: discord.Message, arg: str) -> None:
     """天気予報送信先チャンネルを設定"""
-    if not msg.guild:
-        await msg.reply("サーバー内でのみ使用できます。")
-        return
-    if not msg.author.guild_permissions.administrator:
-        await msg.reply("管理者専用コマンドです。", delete_after=5)
-        return
     channel = _parse_channel(arg, msg.guild) or (
         msg.channel if isinstance(msg.channel, discord.TextChannel) else None
     )
@@ -2245,7 +2859,8 @@ async def _summarize(text: str) -> str:
         "Unless otherwise instructed, reply in Japanese.\n" + text
     )
     try:
-        return await cappuccino_agent.call_llm(prompt)
+        with metrics.external("llm"):
+            return await cappuccino_agent.call_llm(prompt)
     except Exception as e:
         logger.error("summary failed: %s", e)
         return text[:200]
@@ -2270,13 +2885,15 @@ def _resolve_google_news_url(url: str) -> str:
         pass
     return url
 
+async def _fetch_article_html(url: str) -> str:
+    """記事ページの HTML (本文とサムネイルで同じものを使う)"""
+    entry = await content_cache.fetch(_resolve_google_news_url(url), ttl=3600, namespace="article")
+    return entry.text()
+
 async def _fetch_thumbnail(url: str) -> str | None:
     """Fetch og:image from article page"""
     try:
-        url = _resolve_google_news_url(url)
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url, timeout=10) as resp:
-                html = await resp.text()
+        html = await _fetch_article_html(url)
         m = re.search(r'<meta[^>]+property=["\']og:image["\'][^>]+content=["\'](.*?)["\']', html, re.IGNORECASE)
         if not m:
             m = re.search(r'<meta[^>]+content=["\'](.*?)["\'][^>]+property=["\']og:image["\']', html, re.IGNORECASE)
@@ -2288,11 +2905,8 @@ async def _fetch_thumbnail(url: str) -> str | None:
 async def _fetch_article_text(url: str) -> str | None:
     """Fetch article body text"""
     try:
-        url = _resolve_google_news_url(url)
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url, timeout=10) as resp:
-                html = await resp.text()
-        soup = BeautifulSoup(html, "html.parser")
+        html = await _fetch_article_html(url)
+        soup = bs4.BeautifulSoup(html, "html.parser")
         article = soup.find("article")
         if article:
             text = article.get_text(separator=" ", strip=True)
@@ -2360,24 +2974,36 @@ async def send_daily_digest(channel: discord.TextChannel):
     del daily_news[yesterday]
     _save_daily_news(daily_news)
 
+async def _feed_channel(channel_id: int, kind: str):
+    """定期投稿先のチャンネル
+
+    定期ジョブはリースを持つ 1 プロセスだけが動かす。投稿先のギルドが別のシャードでも
+    REST で取得して送れる。設定は別のプロセスで変わることがあるので呼び出し側でファイルから読む。
+    """
+    if not channel_id:
+        return None
+    channel = client.get_channel(channel_id)
+    if channel is None:
+        try:
+            channel = await client.fetch_channel(channel_id)
+        except Exception as e:
+            logger.error("failed to fetch %s channel: %s", kind, e)
+            return None
+    return channel if isinstance(channel, MESSAGE_CHANNEL_TYPES) else None
+
 news_task: asyncio.Task | None = None
 
 async def hourly_news() -> None:
     await client.wait_until_ready()
+    global sent_news, daily_news
     while True:
         now = datetime.datetime.now()
         next_hour = (now + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
         await asyncio.sleep((next_hour - now).total_seconds())
-        if not NEWS_CHANNEL_ID:
-            continue
-        channel = client.get_channel(NEWS_CHANNEL_ID)
-        if channel is None:
-            try:
-                channel = await client.fetch_channel(NEWS_CHANNEL_ID)
-            except Exception as e:
-                logger.error("failed to fetch news channel: %s", e)
-                continue
-        if isinstance(channel, MESSAGE_CHANNEL_TYPES):
+        channel = await _feed_channel(_load_news_channel(), "news")
+        if channel is not None:
+            # 他のプロセスのテスト送信 (y!news) でも更新されるので読み直す
+            sent_news, daily_news = _load_sent_news(), _load_daily_news()
             try:
                 await send_latest_news(channel)
                 current_hour = datetime.datetime.now().hour
@@ -2390,20 +3016,22 @@ eew_task: asyncio.Task | None = None
 EEW_LIST_URL = "https://www.jma.go.jp/bosai/quake/data/list.json"
 EEW_BASE_URL = "https://www.jma.go.jp/bosai/quake/data/"
 
+async def _fetch_eew_list(stale_if_error: bool = True) -> list:
+    # 毎回 If-Modified-Since 付きで問い合わせ、変わっていなければ 304 で済ませる
+    entry = await content_cache.fetch(EEW_LIST_URL, ttl=0, namespace="eew", stale_if_error=stale_if_error)
+    return entry.json()
+
 async def send_latest_eew(channel: discord.TextChannel):
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(EEW_LIST_URL, timeout=10) as resp:
-            data = await resp.json()
-        if not data:
-            return
-        latest = data[0]
-        await _send_eew(channel, latest)
+    data = await _fetch_eew_list()
+    if not data:
+        return
+    latest = data[0]
+    await _send_eew(channel, latest)
 
 async def _send_eew(channel: discord.TextChannel, item: dict):
     url = EEW_BASE_URL + item.get("json", "")
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(url, timeout=10) as resp:
-            detail = await resp.json(content_type=None)
+    # 詳細 JSON は発表ごとに別ファイルで、後から変わらない
+    detail = (await content_cache.fetch(url, ttl=24 * 3600, namespace="eew")).json()
     head = detail.get("Head", {})
     body = detail.get("Body", {})
     area = (
@@ -2478,40 +3106,35 @@ async def _send_eew(channel: discord.TextChannel, item: dict):
 async def watch_eew() -> None:
     await client.wait_until_ready()
     global LAST_EEW_ID
+    LAST_EEW_ID = _load_last_eew()  # 前のリース保持者が書いたものから続ける
     while True:
         try:
-            async with aiohttp.ClientSession() as sess:
-                try:
-                    async with sess.get(EEW_LIST_URL, timeout=10) as resp:
-                        if resp.status == 429:
-                            logger.warning("EEW API rate limited; backing off")
-                            await asyncio.sleep(60)
-                            continue
-                        resp.raise_for_status()
-                        data = await resp.json()
-                except aiohttp.ClientError as e:
+            try:
+                data = await _fetch_eew_list(stale_if_error=False)
+            except aiohttp.ClientResponseError as e:
+                if e.status == 429:
+                    logger.warning("EEW API rate limited; backing off")
+                    await asyncio.sleep(60)
+                else:
                     logger.error("EEW fetch network error: %s", e)
                     await asyncio.sleep(30)
-                    continue
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("EEW fetch network error: %s", e)
+                await asyncio.sleep(30)
+                continue
             if data:
                 latest = data[0]
                 eid = latest.get("json", "")
                 if eid and eid != LAST_EEW_ID:
                     LAST_EEW_ID = eid
                     _save_last_eew(eid)
-                    if EEW_CHANNEL_ID:
-                        ch = client.get_channel(EEW_CHANNEL_ID)
-                        if ch is None:
-                            try:
-                                ch = await client.fetch_channel(EEW_CHANNEL_ID)
-                            except Exception as e:
-                                logger.error("failed to fetch eew channel: %s", e)
-                                ch = None
-                        if isinstance(ch, MESSAGE_CHANNEL_TYPES):
-                            try:
-                                await _send_eew(ch, latest)
-                            except Exception as e:
-                                logger.error("failed to send eew: %s", e)
+                    ch = await _feed_channel(_load_eew_channel(), "eew")
+                    if ch is not None:
+                        try:
+                            await _send_eew(ch, latest)
+                        except Exception as e:
+                            logger.error("failed to send eew: %s", e)
         except Exception as e:
             logger.error("EEW monitor error: %s", e)
         # poll for new alerts roughly every 15 seconds
@@ -2528,9 +3151,8 @@ CITIES = {
 JST = datetime.timezone(datetime.timedelta(hours=9))
 
 async def _fetch_json(url: str) -> dict:
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(url, timeout=10) as resp:
-            return await resp.json()
+    entry = await content_cache.fetch(url, ttl=600, namespace="weather")
+    return entry.json()
 
 async def _fetch_overview() -> str | None:
     url = "https://www.jma.go.jp/bosai/forecast/data/overview_forecast/130000.json"
@@ -2594,16 +3216,8 @@ async def scheduled_weather() -> None:
         else:
             next_run = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(0, tzinfo=JST))
         await asyncio.sleep((next_run - now).total_seconds())
-        if not WEATHER_CHANNEL_ID:
-            continue
-        ch = client.get_channel(WEATHER_CHANNEL_ID)
-        if ch is None:
-            try:
-                ch = await client.fetch_channel(WEATHER_CHANNEL_ID)
-            except Exception as e:
-                logger.error("failed to fetch weather channel: %s", e)
-                continue
-        if isinstance(ch, MESSAGE_CHANNEL_TYPES):
+        ch = await _feed_channel(_load_weather_channel(), "weather")
+        if ch is not None:
             try:
                 await send_weather(ch, next_run)
             except Exception as e:
@@ -2611,222 +3225,378 @@ async def scheduled_weather() -> None:
 
 
 
+async def cmd_lag(msg: discord.Message) -> None:
+    """イベントループ遅延と停止箇所のレポート (管理者専用)"""
+    report = (
+        f"{loop_monitor.report()}\ncontent cache: {content_cache.summary()}\n"
+        f"{startup_timer.report(LAZY_MODULES)}"
+    )
+    logger.info("loop report requested by %s\n%s", msg.author, report)
+    await msg.reply(f"```\n{report[:1900]}\n```")
+
+
+async def cmd_memory(msg: discord.Message) -> None:
+    """このサーバーのキャッシュ量の見積もり (管理者専用)"""
+    report = memory_profile.report(client, MEMORY_PROFILE, msg.guild)
+    logger.info("memory report requested by %s\n%s", msg.author, report)
+    await msg.reply(f"```\n{report[:1900]}\n```")
+
+
+async def cmd_quote(msg: discord.Message):
+    """返信元メッセージを名言カードにする"""
+    if not msg.reference:
+        await msg.reply("名言化したいメッセージに返信して `y!?` を送ってね！", delete_after=5)
+        return
+    try:
+        # 返信元メッセージ取得
+        src = await msg.channel.fetch_message(msg.reference.message_id)
+        if not src.content:          # 空メッセージはスキップ
+            return
+
+        # 画像生成（初期はモノクロ）
+        png = await make_quote_image(src.author, src.content, color=False)
+
+        # ボタン用ペイロード
+        payload = {
+            "user":  src.author,
+            "text":  src.content[:200],
+            "color": False
+        }
+        view = QuoteView(invoker=msg.author, payload=payload)
+
+        # 元メッセージへ画像リプライ
+        await src.reply(
+            content=f"🖼️ made by {msg.author.mention}",
+            file=discord.File(io.BytesIO(png), filename="quote.png"),
+            view=view
+        )
+
+        # y!? コマンドを削除
+        await msg.delete()
+
+    except Exception as e:
+        await msg.reply(f"名言化に失敗: {e}", delete_after=10)
+
+
+# ───────────────── コマンド表 ─────────────────
+ADMIN = ("administrator",)
+
+# 重いコマンドの流量制限 (ユーザー / サーバー / 全体ごとの回数と同時実行数)
+GPT_LIMITS = Limits(user=Rate(3, 60), guild=Rate(10, 60), global_=Rate(30, 60), concurrency=4, queue=16)
+TEX_LIMITS = Limits(user=Rate(5, 60), global_=Rate(30, 60), concurrency=2, queue=8)
+PLAY_LIMITS = Limits(user=Rate(10, 60), guild=Rate(30, 60), concurrency=6, queue=32)
+PURGE_LIMITS = Limits(user=Rate(2, 60), guild=Rate(4, 60), concurrency=2, queue=2)
+QUOTE_LIMITS = Limits(user=Rate(3, 60), guild=Rate(10, 60), concurrency=2, queue=8)
+CODE_BATCH_LIMITS = Limits(user=Rate(5, 60), concurrency=2, queue=8)
+TRANSLATE_LIMITS = Limits(user=Rate(5, 60), guild=Rate(20, 60), global_=Rate(60, 60), concurrency=3, queue=12)
+
+
+def _dice_arg(arg: str) -> tuple[tuple, dict]:
+    return (arg or "1d100",), {}
+
+
+def _play_arg(arg: str) -> tuple[tuple, dict]:
+    return (arg,), {"split_commas": True}
+
+
+commands = CommandRegistry()
+rate_limiter = RateLimiter()
+for _command in (
+    Command("ping", cmd_ping, parser=no_args),
+    Command("say", cmd_say),
+    Command("date", cmd_date),
+    Command("user", cmd_user),
+    Command("server", cmd_server, parser=no_args),
+    Command("dice", cmd_dice, parser=_dice_arg),
+    Command("gpt", cmd_gpt, options={"limits": GPT_LIMITS}),
+    Command("help", cmd_help, parser=no_args),
+    Command("play", cmd_play, parser=_play_arg, options={"limits": PLAY_LIMITS}),
+    Command("queue", cmd_queue),
+    Command("remove", cmd_remove),
+    Command("keep", cmd_keep),
+    Command("seek", cmd_seek),
+    Command("rewind", cmd_rewind),
+    Command("forward", cmd_forward),
+    Command("stop", cmd_stop),
+    Command("purge", cmd_purge, guild_only=True, options={"limits": PURGE_LIMITS}),
+    Command("qr", cmd_qr),
+    Command("barcode", cmd_barcode),
+    Command("qrbatch", cmd_qr_batch, options={"limits": CODE_BATCH_LIMITS}),
+    Command("barcodebatch", cmd_barcode_batch, options={"limits": CODE_BATCH_LIMITS}),
+    Command("tex", cmd_tex, options={"limits": TEX_LIMITS}),
+    Command("news", cmd_news, permissions=ADMIN, cooldown=10),
+    Command("eew", cmd_eew, permissions=ADMIN, cooldown=10),
+    Command("weather", cmd_weather, permissions=ADMIN, cooldown=10),
+    Command("lag", cmd_lag, parser=no_args, permissions=ADMIN),
+    Command("memory", cmd_memory, parser=no_args, permissions=ADMIN),
+    Command("poker", cmd_poker),
+    Command("quote", cmd_quote, parser=no_args, options={"limits": QUOTE_LIMITS}),
+):
+    commands.add(_command)
+
+
+@commands.use
+async def _measure(command: Command, msg, call):
+    via = "slash" if isinstance(msg, SlashMessage) else "text"
+    async with metrics.track(command.name, via):
+        result = await call()
+    startup_timer.mark("first_command")
+    return result
+
+
+@commands.add_check
+def _check_limits(command: Command, msg) -> str | None:
+    limits = command.options.get("limits")
+    if limits is None:
+        return None
+    try:
+        rate_limiter.check(command.name, limits, msg.author.id, msg.guild.id if msg.guild else None)
+    except (RateLimited, Busy) as e:
+        return str(e)
+    return None
+
+
+@commands.use
+async def _limit(command: Command, msg, call):
+    limits = command.options.get("limits")
+    if limits is None:
+        return await call()
+    try:
+        rate_limiter.take(command.name, limits, msg.author.id, msg.guild.id if msg.guild else None)
+        # スラッシュコマンドは断らないと決まったら、枠を待つ前に応答を保留する (3 秒の期限切れ対策)
+        defer = msg.defer if isinstance(msg, SlashMessage) else None
+        async with rate_limiter.slot(command.name, limits, before_wait=defer):
+            return await call()
+    except (RateLimited, Busy) as e:
+        raise CommandRejected(str(e)) from e
+
+
+@commands.add_check
+def _check_shutdown(command: Command, msg) -> str | None:
+    if shutdown_gate.closing:
+        return "🔄 再起動のため停止中です。少し待ってからもう一度試してね！"
+    return None
+
+
+@commands.use
+async def _drain(command: Command, msg, call):
+    # 終了時はここを通っているコマンドが終わるまで待つ
+    async with shutdown_gate.track():
+        return await call()
+
+
+@commands.use
+async def _defer_slash(command: Command, msg, call):
+    # スラッシュコマンドはチェックとレート制限を通ってから応答を保留する
+    # (断るときは保留前なので本人にだけ返せる)。同時実行の枠を待つコマンドは _limit で保留済み
+    if isinstance(msg, SlashMessage):
+        await msg.defer()
+    return await call()
+
+
+async def run_command(name: str, msg, *args, **kwargs):
+    """コマンド表から name を引いて実行 (テキスト / スラッシュ共通の入口)"""
+    command = commands.get(name)
+    if command is None:
+        raise KeyError(name)
+    try:
+        return await commands.run(command, msg, *args, **kwargs)
+    except CommandRejected as e:
+        if isinstance(msg, SlashMessage):
+            await msg.reply(str(e), ephemeral=True)
+        else:
+            await msg.reply(str(e), delete_after=5)
+
+
 # ───────────────── イベント ─────────────────
 from discord import Activity, ActivityType, Status
 
+music_restore_task: asyncio.Task | None = None
+commands_synced = False
+
+
+async def sync_commands() -> None:
+    """スラッシュコマンドを (定義が変わっていれば) 同期する。成功したら以後は何もしない"""
+    global commands_synced
+    if commands_synced:
+        return
+    # 複数プロセスで動かすときはシャード 0 を持つプロセスだけが同期する
+    if SHARD_IDS and 0 not in SHARD_IDS:
+        commands_synced = True
+        return
+    try:
+        await tree_syncer.sync(discord.Object(DEV_GUILD_ID) if DEV_GUILD_ID else None)
+        commands_synced = True
+    except Exception as e:
+        logger.error("Slash command sync failed: %s", e)
+
+
+warm_task: asyncio.Task | None = None
+
+
+async def warm_up() -> None:
+    """ログイン後に、遅延読み込みのモジュールと画像生成の準備を裏で済ませる"""
+    if not tex_renderer.available():
+        tex_renderer.start()
+    if BOT_WARMUP:
+        await asyncio.to_thread(startup.warm, *LAZY_MODULES.values())
+        await asyncio.to_thread(code_images.warm)
+        await tex_renderer.warm()
+    startup_timer.mark("warm")
+    logger.info("%s", startup_timer.report(LAZY_MODULES))
+
+
 # 起動時に 1 回設定
 @client.event
 async def on_ready():
+    startup_timer.mark("ready")
+    loop_monitor.start()
+    global metrics_runner
+    if METRICS_PORT and metrics_runner is None:
+        try:
+            metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error("metrics endpoint failed: %s", e)
     await client.change_presence(
         status=Status.online,
         activity=Activity(type=ActivityType.playing,
                           name="y!help で使い方を見る")
     )
-    try:
-        await tree.sync()
-    except Exception as e:
-        logger.error("Slash command sync failed: %s", e)
+    await sync_commands()
     logger.info("LOGIN: %s", client.user)
+    # 再接続で on_ready が再び呼ばれても二重に起動しない。
+    # 複数プロセスで動かしてもリースを持つ 1 つだけが実際にジョブを動かす
     global news_task
     if news_task is None or news_task.done():
-        news_task = asyncio.create_task(hourly_news())
+        news_task = asyncio.create_task(leases.run_singleton("hourly_news", hourly_news))
     global eew_task
     if eew_task is None or eew_task.done():
-        eew_task = asyncio.create_task(watch_eew())
+        eew_task = asyncio.create_task(leases.run_singleton("watch_eew", watch_eew))
     global weather_task
     if weather_task is None or weather_task.done():
-        weather_task = asyncio.create_task(scheduled_weather())
+        weather_task = asyncio.create_task(leases.run_singleton("scheduled_weather", scheduled_weather))
+    # 前回の終了時に再生していたギルドは VC に入り直して続きから (起動後 1 回だけ)
+    global music_restore_task
+    if music_restore_task is None:
+        music_restore_task = asyncio.create_task(restore_music_states())
+    global warm_task
+    if warm_task is None:
+        warm_task = asyncio.create_task(warm_up())
 
 # ----- Slash command wrappers -----
-@tree.command(name="ping", description="Botの応答速度を表示")
-async def sc_ping(itx: discord.Interaction):
-
+async def run_slash(itx: discord.Interaction, name: str, *args, ephemeral: bool = False,
+                    attachments: list[discord.Attachment] | None = None, **kwargs) -> None:
+    """スラッシュコマンドをコマンド表経由で実行"""
+    msg = SlashMessage(itx, attachments, ephemeral=ephemeral)
     try:
-        await itx.response.defer()
-        await cmd_ping(SlashMessage(itx))
+        # チェックはコマンド表側で 1 回だけ。断られたら本人にだけ返す
+        await run_command(name, msg, *args, **kwargs)
     except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+        await msg.reply(f"エラー発生: {e}")
 
 
+@tree.command(name="ping", description="Botの応答速度を表示")
+async def sc_ping(itx: discord.Interaction):
+    await run_slash(itx, "ping")
+
 
 @tree.command(name="say", description="Botに発言させます")
 @app_commands.describe(text="送信するテキスト")
 async def sc_say(itx: discord.Interaction, text: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_say(SlashMessage(itx), text)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
+    await run_slash(itx, "say", text)
 
 
 @tree.command(name="date", description="Unix 時刻をDiscord形式で表示")
 @app_commands.describe(timestamp="Unixタイムスタンプ")
 async def sc_date(itx: discord.Interaction, timestamp: int | None = None):
-
-    try:
-        await itx.response.defer()
-        arg = str(timestamp) if timestamp is not None else ""
-        await cmd_date(SlashMessage(itx), arg)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
+    await run_slash(itx, "date", str(timestamp) if timestamp is not None else "")
 
 
 @tree.command(name="user", description="ユーザー情報を表示")
 @app_commands.describe(user="表示するユーザー")
 async def sc_user(itx: discord.Interaction, user: discord.User | None = None):
-
-    try:
-        await itx.response.defer()
-        target = user or itx.user
-        member = target if isinstance(target, discord.Member) else (itx.guild.get_member(target.id) if itx.guild else None)
-        emb = await build_user_embed(target, member, itx.channel)
-        await itx.followup.send(embed=emb)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "user", str(user.id) if user else "")
 
 
 @tree.command(name="server", description="サーバー情報を表示")
 async def sc_server(itx: discord.Interaction):
-
-    try:
-        await itx.response.defer()
-        msg = SlashMessage(itx)
-        await cmd_server(msg)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
+    await run_slash(itx, "server")
 
 
 @tree.command(name="dice", description="ダイスを振ります")
 @app_commands.describe(nota="(例: 2d6, d20)")
 async def sc_dice(itx: discord.Interaction, nota: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_dice(SlashMessage(itx), nota)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "dice", nota)
 
 
 @tree.command(name="qr", description="QR コードを生成")
 @app_commands.describe(text="QRコードにする文字列")
 async def sc_qr(itx: discord.Interaction, text: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_qr(SlashMessage(itx), text)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "qr", text)
 
 
 @tree.command(name="barcode", description="バーコードを生成")
 @app_commands.describe(text="バーコードにする文字列")
 async def sc_barcode(itx: discord.Interaction, text: str):
+    await run_slash(itx, "barcode", text)
 
-    try:
-        await itx.response.defer()
-        await cmd_barcode(SlashMessage(itx), text)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+
+@tree.command(name="qrbatch", description="複数の QR コードをまとめて生成")
+@app_commands.describe(items="| か改行で区切った文字列", as_zip="一覧画像ではなく zip で受け取る")
+async def sc_qrbatch(itx: discord.Interaction, items: str, as_zip: bool = False):
+    await run_slash(itx, "qrbatch", f"--zip {items}" if as_zip else items)
 
 
+@tree.command(name="barcodebatch", description="複数のバーコードをまとめて生成")
+@app_commands.describe(items="| か改行で区切った文字列", as_zip="一覧画像ではなく zip で受け取る")
+async def sc_barcodebatch(itx: discord.Interaction, items: str, as_zip: bool = False):
+    await run_slash(itx, "barcodebatch", f"--zip {items}" if as_zip else items)
+
 
 @tree.command(name="gpt", description="ChatGPT に質問")
 @app_commands.describe(text="質問内容")
 async def sc_gpt(itx: discord.Interaction, text: str):
-
-    try:
-        await itx.response.defer()
-        msg = SlashMessage(itx)
-        await cmd_gpt(msg, text)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "gpt", text)
 
 
 @tree.command(name="tex", description="TeX 数式を画像に変換")
 @app_commands.describe(expr="TeX 数式")
 async def sc_tex(itx: discord.Interaction, expr: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_tex(SlashMessage(itx), expr)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "tex", expr)
 
 
 @tree.command(name="news", description="ニュース送信先チャンネルを設定")
 @app_commands.describe(channel="投稿先チャンネル")
 async def sc_news(itx: discord.Interaction, channel: discord.TextChannel):
-
-    if not itx.user.guild_permissions.administrator:
-        await itx.response.send_message("管理者専用コマンドです。", ephemeral=True)
-        return
-    global NEWS_CHANNEL_ID
-    NEWS_CHANNEL_ID = channel.id
-    _save_news_channel(NEWS_CHANNEL_ID)
-    await itx.response.send_message(
-        f"ニュースチャンネルを {channel.mention} に設定しました。"
-    )
-    try:
-        await send_latest_news(channel)
-    except Exception as e:
-        await itx.followup.send(f"テスト送信に失敗: {e}")
+    await run_slash(itx, "news", channel.mention)
 
 
 @tree.command(name="eew", description="地震速報送信先チャンネルを設定")
 @app_commands.describe(channel="投稿先チャンネル")
 async def sc_eew(itx: discord.Interaction, channel: discord.TextChannel):
-
-    if not itx.user.guild_permissions.administrator:
-        await itx.response.send_message("管理者専用コマンドです。", ephemeral=True)
-        return
-    global EEW_CHANNEL_ID
-    EEW_CHANNEL_ID = channel.id
-    _save_eew_channel(EEW_CHANNEL_ID)
-    await itx.response.send_message(
-        f"地震速報チャンネルを {channel.mention} に設定しました。"
-    )
-    try:
-        await send_latest_eew(channel)
-    except Exception as e:
-        await itx.followup.send(f"テスト送信に失敗: {e}")
+    await run_slash(itx, "eew", channel.mention)
 
 
 @tree.command(name="weather", description="天気予報送信先チャンネルを設定")
 @app_commands.describe(channel="投稿先チャンネル")
 async def sc_weather(itx: discord.Interaction, channel: discord.TextChannel):
+    await run_slash(itx, "weather", channel.mention)
 
-    if not itx.user.guild_permissions.administrator:
-        await itx.response.send_message("管理者専用コマンドです。", ephemeral=True)
-        return
-    global WEATHER_CHANNEL_ID
-    WEATHER_CHANNEL_ID = channel.id
-    _save_weather_channel(WEATHER_CHANNEL_ID)
-    await itx.response.send_message(
-        f"天気予報チャンネルを {channel.mention} に設定しました。"
-    )
-    try:
-        target = datetime.datetime.now(JST).replace(minute=0, second=0, microsecond=0)
-        await send_weather(channel, target)
-    except Exception as e:
-        await itx.followup.send(f"テスト送信に失敗: {e}")
 
+@tree.command(name="lag", description="イベントループ遅延レポート (管理者)")
+async def sc_lag(itx: discord.Interaction):
+    await run_slash(itx, "lag", ephemeral=True)
 
-@tree.command(name="poker", description="BOTやプレイヤーとポーカーで遊ぶ")
 
-@app_commands.describe(opponent="対戦相手。省略するとBOT")
-async def sc_poker(itx: discord.Interaction, opponent: discord.User | None = None):
+@tree.command(name="memory", description="キャッシュのメモリ使用量レポート (管理者)")
+async def sc_memory(itx: discord.Interaction):
+    await run_slash(itx, "memory", ephemeral=True)
 
-    try:
-        await itx.response.defer()
-        arg = opponent.mention if opponent else ""
-        await cmd_poker(SlashMessage(itx), arg)
 
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+@tree.command(name="poker", description="BOTやプレイヤーとポーカーで遊ぶ")
+@app_commands.describe(opponent="対戦相手。省略するとBOT")
+async def sc_poker(itx: discord.Interaction, opponent: discord.User | None = None):
+    await run_slash(itx, "poker", opponent.mention if opponent else "")
 
 
 @tree.command(name="play", description="曲を再生キューに追加")
@@ -2847,166 +3617,116 @@ async def sc_play(
     query3: str | None = None,
     file3: discord.Attachment | None = None,
 ):
-    try:
-        await itx.response.defer()
-        opts = itx.data.get("options", [])
-        values = {
-            "query1": query1,
-            "file1": file1,
-            "query2": query2,
-            "file2": file2,
-            "query3": query3,
-            "file3": file3,
-        }
-        order: list[tuple[str, Any]] = []
-        for op in opts:
-            name = op.get("name")
-            if name.startswith("query") and values.get(name):
-                order.append(("query", values[name]))
-            elif name.startswith("file"):
-                att = values.get(name)
-                if att:
-                    order.append(("file", att))
-        if not order:
-            if query1:
-                order.append(("query", query1))
-            for key in ("file1", "file2", "file3"):
-                att = values.get(key)
-                if att:
-                    order.append(("file", att))
-        for kind, val in order:
-            if kind == "query":
-                msg = SlashMessage(itx)
-                await cmd_play(msg, val, first_query=True)
-            else:
-                msg = SlashMessage(itx, [val])
-                await cmd_play(msg, "", first_query=False)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
+    opts = itx.data.get("options", [])
+    values = {
+        "query1": query1,
+        "file1": file1,
+        "query2": query2,
+        "file2": file2,
+        "query3": query3,
+        "file3": file3,
+    }
+    order: list[tuple[str, Any]] = []
+    for op in opts:
+        name = op.get("name")
+        if name.startswith("query") and values.get(name):
+            order.append(("query", values[name]))
+        elif name.startswith("file"):
+            att = values.get(name)
+            if att:
+                order.append(("file", att))
+    if not order:
+        if query1:
+            order.append(("query", query1))
+        for key in ("file1", "file2", "file3"):
+            att = values.get(key)
+            if att:
+                order.append(("file", att))
+    for kind, val in order:
+        if kind == "query":
+            await run_slash(itx, "play", val, first_query=True)
+        else:
+            await run_slash(itx, "play", "", attachments=[val], first_query=False)
 
 
 @tree.command(name="queue", description="再生キューを表示")
 async def sc_queue(itx: discord.Interaction):
-
-    try:
-        await itx.response.defer()
-        await cmd_queue(SlashMessage(itx), "")
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
+    await run_slash(itx, "queue", "")
 
 
 @tree.command(name="remove", description="キューから曲を削除")
 @app_commands.describe(numbers="削除する番号 (スペース区切り)")
 async def sc_remove(itx: discord.Interaction, numbers: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_remove(SlashMessage(itx), numbers)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
+    await run_slash(itx, "remove", numbers)
 
 
 @tree.command(name="keep", description="指定番号以外を削除")
 @app_commands.describe(numbers="残す番号 (スペース区切り)")
 async def sc_keep(itx: discord.Interaction, numbers: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_keep(SlashMessage(itx), numbers)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "keep", numbers)
 
 
 @tree.command(name="seek", description="再生位置を指定")
 @app_commands.describe(position="例: 1m30s, 2:00")
 async def sc_seek(itx: discord.Interaction, position: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_seek(SlashMessage(itx), position)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "seek", position)
 
 
 @tree.command(name="rewind", description="再生位置を巻き戻し")
 @app_commands.describe(time="例: 10s, 1m, 1:00 (省略可)")
 async def sc_rewind(itx: discord.Interaction, time: str | None = None):
-
-    try:
-        await itx.response.defer()
-        await cmd_rewind(SlashMessage(itx), time or "")
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "rewind", time or "")
 
 
 @tree.command(name="forward", description="再生位置を早送り")
 @app_commands.describe(time="例: 10s, 1m, 1:00 (省略可)")
 async def sc_forward(itx: discord.Interaction, time: str | None = None):
-
-    try:
-        await itx.response.defer()
-        await cmd_forward(SlashMessage(itx), time or "")
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "forward", time or "")
 
 
 @tree.command(name="purge", description="メッセージを一括削除")
-@app_commands.describe(arg="削除数またはメッセージリンク")
+@app_commands.describe(arg="削除数またはメッセージリンク (続けて #チャンネル @ユーザー bots contains:語 で絞り込み)")
 async def sc_purge(itx: discord.Interaction, arg: str):
-
-    try:
-        await itx.response.defer()
-        await cmd_purge(SlashMessage(itx), arg)
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
+    await run_slash(itx, "purge", arg)
 
 
 @tree.command(name="stop", description="VC から退出")
 async def sc_stop(itx: discord.Interaction):
-
-    try:
-        await itx.response.defer()
-        await cmd_stop(SlashMessage(itx), "")
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
-
-
-
+    await run_slash(itx, "stop", "")
 
 
 @tree.command(name="help", description="コマンド一覧を表示")
 async def sc_help(itx: discord.Interaction):
-
-    try:
-        await itx.response.defer()
-        await cmd_help(SlashMessage(itx))
-    except Exception as e:
-        await itx.followup.send(f"エラー発生: {e}")
+    await run_slash(itx, "help")
 
 
 # ------------ 翻訳リアクション機能ここから ------------
 
-# flags.txt を読み込み「絵文字 ➜ ISO 国コード」を作る
-SPECIAL_EMOJI_ISO: dict[str, str] = {}
-try:
-    with open("flags.txt", "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            parts = line.split()
-            if len(parts) >= 2:
-                emoji = parts[0]                  # 例 🇯🇵
-                shortcode = parts[1]              # 例 :flag_jp:
-                if shortcode.startswith(":flag_") and shortcode.endswith(":"):
-                    iso = shortcode[6:-1].upper() # jp -> JP
-                    SPECIAL_EMOJI_ISO[emoji] = iso
-except FileNotFoundError:
-    logger.warning("flags.txt not found. Flag translation reactions disabled")
+# flags.txt を読み込み「絵文字 ➜ ISO 国コード」を作る (最初の翻訳リアクションで 1 回だけ)
+_special_emoji_iso: dict[str, str] | None = None
+
+
+def special_emoji_iso() -> dict[str, str]:
+    global _special_emoji_iso
+    if _special_emoji_iso is not None:
+        return _special_emoji_iso
+    _special_emoji_iso = {}
+    try:
+        with open("flags.txt", "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split()
+                if len(parts) >= 2:
+                    emoji = parts[0]                  # 例 🇯🇵
+                    shortcode = parts[1]              # 例 :flag_jp:
+                    if shortcode.startswith(":flag_") and shortcode.endswith(":"):
+                        iso = shortcode[6:-1].upper() # jp -> JP
+                        _special_emoji_iso[emoji] = iso
+    except FileNotFoundError:
+        logger.warning("flags.txt not found. Flag translation reactions disabled")
+    return _special_emoji_iso
 
 ISO_TO_LANG = {
     # A
@@ -3307,7 +4027,7 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     emoji = str(payload.emoji)
 
     # 2. 国旗 ⇒ ISO2 文字
-    iso = SPECIAL_EMOJI_ISO.get(emoji) or flag_to_iso(emoji)
+    iso = special_emoji_iso().get(emoji) or flag_to_iso(emoji)
     if not iso:
         return
 
@@ -3317,6 +4037,16 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
         logger.debug("未登録 ISO: %s", iso)
         return
 
+    try:
+        rate_limiter.take("translate", TRANSLATE_LIMITS, payload.user_id, payload.guild_id)
+        async with rate_limiter.slot("translate", TRANSLATE_LIMITS):
+            await _translate_reaction(payload, emoji, lang)
+    except (RateLimited, Busy) as e:
+        logger.info("翻訳を見送り (user=%s): %s", payload.user_id, e)
+
+
+async def _translate_reaction(payload: discord.RawReactionActionEvent, emoji: str, lang: str):
+    """リアクションされたメッセージを lang に翻訳して返信"""
     # 4. 元メッセージ取得
     channel  = await client.fetch_channel(payload.channel_id)
     message  = await channel.fetch_message(payload.message_id)
@@ -3331,7 +4061,8 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
                 f"Translate the following message into {lang}, considering the regional variant indicated by this flag {emoji}. "
                 "Provide only the translation, and keep it concise.\n" + original
             )
-            translated = await cappuccino_agent.call_llm(prompt)
+            with metrics.external("llm"):
+                translated = await cappuccino_agent.call_llm(prompt)
 
             # 6. Discord 2000 文字制限に合わせて 1 通で送信
             header     = f"💬 **{lang}** translation:\n"
@@ -3353,75 +4084,23 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
 
 @client.event
 async def on_message(msg: discord.Message):
+    member_index.on_message(msg)
+
     # ① Bot の発言は無視
     if msg.author.bot:
         return
 
     # ② y!? で名言カード化
     if msg.content.strip().lower() == "y!?" and msg.reference:
-        try:
-            # 返信元メッセージ取得
-            src = await msg.channel.fetch_message(msg.reference.message_id)
-            if not src.content:          # 空メッセージはスキップ
-                return
-
-            # 画像生成（初期はモノクロ）
-            img_path = await make_quote_image(src.author, src.content, color=False)
-
-            # ボタン用ペイロード
-            payload = {
-                "user":  src.author,
-                "text":  src.content[:200],
-                "color": False
-            }
-            view = QuoteView(invoker=msg.author, payload=payload)
-
-            # 元メッセージへ画像リプライ
-            await src.reply(
-                content=f"🖼️ made by {msg.author.mention}",
-                file=discord.File(img_path, filename=img_path.name),
-                view=view
-            )
-            try:
-                img_path.unlink()
-            except Exception:
-                pass
-
-            # y!? コマンドを削除
-            await msg.delete()
-
-        except Exception as e:
-            await msg.reply(f"名言化に失敗: {e}", delete_after=10)
+        await run_command("quote", msg)
         return  # ← ここで終了し、既存コマンド解析へ進まない
 
     # ③ 既存コマンド解析
     cmd, arg = parse_cmd(msg.content)
-    if cmd == "ping":   await cmd_ping(msg)
-    elif cmd == "say":  await cmd_say(msg, arg)
-    elif cmd == "date": await cmd_date(msg, arg)
-    elif cmd == "user": await cmd_user(msg, arg)
-    elif cmd == "dice": await cmd_dice(msg, arg or "1d100")
-    elif cmd == "gpt":
-        await cmd_gpt(msg, arg)
-    elif cmd == "help": await cmd_help(msg)
-    elif cmd == "play": await cmd_play(msg, arg, split_commas=True)
-    elif cmd == "queue":await cmd_queue(msg, arg)
-    elif cmd == "remove":await cmd_remove(msg, arg)
-    elif cmd == "keep": await cmd_keep(msg, arg)
-    elif cmd == "seek": await cmd_seek(msg, arg)
-    elif cmd == "rewind": await cmd_rewind(msg, arg)
-    elif cmd == "forward": await cmd_forward(msg, arg)
-    elif cmd == "server": await cmd_server(msg)
-    elif cmd == "purge":await cmd_purge(msg, arg)
-    elif cmd == "qr": await cmd_qr(msg, arg)
-    elif cmd == "barcode": await cmd_barcode(msg, arg)
-    elif cmd == "tex": await cmd_tex(msg, arg)
-    elif cmd == "news": await cmd_news(msg, arg)
-    elif cmd == "eew": await cmd_eew(msg, arg)
-    elif cmd == "weather": await cmd_weather(msg, arg)
-
-    elif cmd == "poker": await cmd_poker(msg, arg)
-
+    command = commands.get(cmd)
+    if command is not None:
+        args, kwargs = command.parser(arg)
+        await run_command(command.name, msg, *args, **kwargs)
     else:
         mention = client.user and any(m.id == client.user.id for m in msg.mentions)
         history = await _gather_reply_chain(msg)
@@ -3429,18 +4108,60 @@ async def on_message(msg: discord.Message):
         if mention or replied:
             text = _strip_bot_mention(msg.content)
             if text:
-                await cmd_gpt(msg, text)
+                await run_command("gpt", msg, text)
 
 
 # ───────────────── 起動 ─────────────────
+shutdown_task: asyncio.Task | None = None
+
+
+async def shutdown(reason: str) -> None:
+    """新しいコマンドを断り、実行中のものを待ち、再生状態を保存してから切断する"""
+    logger.info("shutting down (%s), %d command(s) in flight", reason, shutdown_gate.inflight)
+    shutdown_gate.close()
+    await shutdown_gate.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    jobs = [t for t in (news_task, eew_task, weather_task, music_restore_task, warm_task) if t is not None and not t.done()]
+    for task in jobs:
+        task.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+    await save_music_states()
+    await client.close()
+
+
+def request_shutdown(reason: str) -> None:
+    """シグナルハンドラ。2 回目以降は無視する"""
+    global shutdown_task
+    if shutdown_task is None:
+        shutdown_task = asyncio.create_task(shutdown(reason))
+
+
 async def start_bot():
     """Start the Discord bot."""
     if not TOKEN:
         raise RuntimeError("DISCORD_BOT_TOKEN is not set. Check your environment variables or .env file")
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY is not set. Check your environment variables or .env file")
-    await client.start(TOKEN)
-
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown, sig.name)
+        except NotImplementedError:     # Windows
+            pass
+    try:
+        await client.start(TOKEN)
+    finally:
+        if shutdown_task is None:       # シグナル以外で止まった: 再生状態だけは残す
+            await save_music_states()
+        await leases.release_all()     # 次のプロセスがすぐ引き継げるように
+        await content_cache.close()
+        loop_monitor.stop()
+        tex_renderer.shutdown()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        remove_media_dir(MEDIA_DIR)
+
+
+startup_timer.mark("imports")
 
 if __name__ == "__main__":
     asyncio.run(start_bot())
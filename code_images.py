@@ -0,0 +1,168 @@
+"""QR コード / バーコード画像の生成
+
+qrcode と python-barcode は一度だけ読み込んで保持し、PNG はメモリ上に書き出す。
+生成結果は (種類, 文字列, オプション) をキーにした LRU に置き、同じ内容は
+描き直さない。複数の文字列をまとめて 1 枚の一覧画像か zip にもできる。
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import io
+import math
+import zipfile
+from typing import Any
+
+KINDS = ("qr", "barcode")
+BATCH_MAX = 25
+
+
+class CodeUnavailable(Exception):
+    """必要なモジュールが無い"""
+
+
+class CodeError(Exception):
+    """この文字列からは生成できない"""
+
+
+class CodeImageService:
+    def __init__(self, max_entries: int = 256, max_bytes: int = 16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache: collections.OrderedDict[tuple, bytes] = collections.OrderedDict()
+        self._bytes = 0
+        self._qrcode: Any = None
+        self._barcode: Any = None
+        self.hits = 0
+        self.misses = 0
+
+    # ── モジュール ──
+    def warm(self) -> None:
+        """モジュールを読み込んでおく (無ければ何もしない)"""
+        for kind in KINDS:
+            try:
+                self._module(kind)
+            except CodeUnavailable:
+                pass
+
+    def _module(self, kind: str):
+        if kind == "qr":
+            if self._qrcode is None:
+                try:
+                    import qrcode
+                    import qrcode.exceptions  # noqa: F401
+                except ModuleNotFoundError:
+                    raise CodeUnavailable("qrcode モジュールが見つかりません。`pip install qrcode` を実行してください。") from None
+                self._qrcode = qrcode
+            return self._qrcode
+        if self._barcode is None:
+            try:
+                import barcode
+                import barcode.errors  # noqa: F401
+                import barcode.writer  # noqa: F401
+            except ModuleNotFoundError:
+                raise CodeUnavailable("barcode モジュールが見つかりません。`pip install python-barcode` を実行してください。") from None
+            self._barcode = barcode
+        return self._barcode
+
+    # ── 描画 ──
+    def _draw(self, kind: str, text: str, options: dict) -> bytes:
+        buf = io.BytesIO()
+        if kind == "qr":
+            qrcode = self._module("qr")
+            qr = qrcode.QRCode(box_size=options.get("box_size", 4), border=options.get("border", 2))
+            qr.add_data(text)
+            try:
+                qr.make(fit=True)
+            except qrcode.exceptions.DataOverflowError:
+                raise CodeError("文字列が長すぎて QR コードにできません。") from None
+            img = qr.make_image(fill_color="black", back_color="white")
+            img.save(buf, format="PNG")
+        elif kind == "barcode":
+            barcode = self._module("barcode")
+            try:
+                code = barcode.get("code128", text, writer=barcode.writer.ImageWriter())
+            except barcode.errors.IllegalCharacterError:
+                raise CodeError("Code128 では英数字など ASCII 文字のみ利用できます。") from None
+            code.write(buf)
+        else:
+            raise ValueError(f"unknown code kind: {kind}")
+        return buf.getvalue()
+
+    async def render(self, kind: str, text: str, **options: Any) -> bytes:
+        """PNG を返す (キャッシュがあればそれを返す)"""
+        key = (kind, text, tuple(sorted(options.items())))
+        data = self._cache.get(key)
+        if data is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return data
+        self.misses += 1
+        self._module(kind)  # 無いならスレッドに投げる前に断る
+        data = await asyncio.to_thread(self._draw, kind, text, options)
+        self._store(key, data)
+        return data
+
+    def _store(self, key: tuple, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._cache[key] = data
+        self._bytes += len(data)
+        while len(self._cache) > self.max_entries or self._bytes > self.max_bytes:
+            _key, evicted = self._cache.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    # ── まとめて生成 ──
+    async def render_batch(self, kind: str, texts: list[str], as_zip: bool = False) -> tuple[bytes, str]:
+        """複数の文字列をまとめて生成し、(データ, ファイル名) を返す"""
+        if len(texts) > BATCH_MAX:
+            raise CodeError(f"一度に作れるのは {BATCH_MAX} 個までです。")
+        images = []
+        for i, text in enumerate(texts, 1):
+            try:
+                images.append(await self.render(kind, text))
+            except CodeError as e:
+                raise CodeError(f"{i} 番目: {e}") from None
+        if as_zip:
+            return await asyncio.to_thread(_zip, kind, images), f"{kind}.zip"
+        return await asyncio.to_thread(_grid, images), f"{kind}_grid.png"
+
+
+def _zip(kind: str, images: list[bytes]) -> bytes:
+    buf = io.BytesIO()
+    width = len(str(len(images)))
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:  # PNG は圧縮済み
+        for i, data in enumerate(images, 1):
+            zf.writestr(f"{kind}_{i:0{width}d}.png", data)
+    return buf.getvalue()
+
+
+def _grid(images: list[bytes], margin: int = 12, label_height: int = 16) -> bytes:
+    """番号付きで格子状に並べた 1 枚の PNG"""
+    from PIL import Image, ImageDraw
+
+    tiles = [Image.open(io.BytesIO(data)).convert("RGB") for data in images]
+    cell_w = max(t.width for t in tiles)
+    cell_h = max(t.height for t in tiles) + label_height
+    cols = math.ceil(math.sqrt(len(tiles)))
+    if tiles[0].width > 2 * tiles[0].height:
+        cols = min(cols, 2)  # 横長のバーコードは 2 列まで
+    rows = math.ceil(len(tiles) / cols)
+    sheet = Image.new(
+        "RGB",
+        (cols * cell_w + (cols + 1) * margin, rows * cell_h + (rows + 1) * margin),
+        "white",
+    )
+    draw = ImageDraw.Draw(sheet)
+    for i, tile in enumerate(tiles):
+        r, c = divmod(i, cols)
+        x = margin + c * (cell_w + margin)
+        y = margin + r * (cell_h + margin)
+        draw.text((x, y), str(i + 1), fill="black")
+        sheet.paste(tile, (x + (cell_w - tile.width) // 2, y + label_height))
+    buf = io.BytesIO()
+    sheet.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
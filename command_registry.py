@@ -0,0 +1,113 @@
+"""テキスト / スラッシュ共通のコマンド表
+
+コマンド名 (と別名) から ``Command`` を辞書で引き、権限・クールダウンを確認してから
+ミドルウェアを通して handler を呼ぶ。計測やレート制限はミドルウェアとして
+``CommandRegistry.use()`` で差し込む。
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Iterator
+
+# (args, kwargs) を返す引数パーサー
+Parser = Callable[[str], tuple[tuple, dict]]
+# (command, msg, call) を受け取り、call() を呼んで結果を返すミドルウェア
+Middleware = Callable[["Command", Any, Callable[[], Awaitable[Any]]], Awaitable[Any]]
+# 実行前の確認。断る場合は理由の文字列を返す (副作用を持たないこと)
+Check = Callable[["Command", Any], "str | None"]
+
+
+def raw_arg(arg: str) -> tuple[tuple, dict]:
+    """引数文字列をそのまま 1 つ渡す"""
+    return (arg,), {}
+
+
+def no_args(_arg: str) -> tuple[tuple, dict]:
+    return (), {}
+
+
+class CommandRejected(Exception):
+    """権限不足やクールダウン中で実行しなかった"""
+
+
+@dataclass
+class Command:
+    name: str
+    handler: Callable[..., Awaitable[Any]]
+    aliases: tuple[str, ...] = ()
+    parser: Parser = raw_arg
+    cooldown: float = 0.0                    # 同じユーザーが再実行できるまでの秒数
+    permissions: tuple[str, ...] = ()        # 必要な guild_permissions の属性名
+    guild_only: bool = False
+    options: dict[str, Any] = field(default_factory=dict)   # ミドルウェア向けの追加設定
+
+
+class CommandRegistry:
+    def __init__(self) -> None:
+        self._lookup: dict[str, Command] = {}
+        self._commands: list[Command] = []
+        self._middleware: list[Middleware] = []
+        self._checks: list[Check] = []
+        self._last_used: dict[tuple[str, int], float] = {}
+
+    def add(self, command: Command) -> Command:
+        for key in (command.name, *command.aliases):
+            if key in self._lookup:
+                raise ValueError(f"duplicate command name: {key}")
+            self._lookup[key] = command
+        self._commands.append(command)
+        return command
+
+    def get(self, name: str | None) -> Command | None:
+        return self._lookup.get(name) if name else None
+
+    def __iter__(self) -> Iterator[Command]:
+        return iter(self._commands)
+
+    def use(self, middleware: Middleware) -> Middleware:
+        """ミドルウェアを追加 (先に追加したものが外側)"""
+        self._middleware.append(middleware)
+        return middleware
+
+    def add_check(self, check: Check) -> Check:
+        """check() で権限・クールダウンの後に呼ぶ確認を追加"""
+        self._checks.append(check)
+        return check
+
+    # ── 実行 ──
+    def check(self, command: Command, msg: Any) -> str | None:
+        """実行できない理由を返す。実行できるなら None"""
+        if (command.guild_only or command.permissions) and not msg.guild:
+            return "サーバー内でのみ使用できます。"
+        if command.permissions:
+            perms = msg.author.guild_permissions
+            if not all(getattr(perms, p, False) for p in command.permissions):
+                if command.permissions == ("administrator",):
+                    return "管理者専用コマンドです。"
+                return f"このコマンドには {', '.join(command.permissions)} 権限が必要です。"
+        if command.cooldown:
+            last = self._last_used.get((command.name, msg.author.id))
+            if last is not None:
+                remaining = command.cooldown - (time.monotonic() - last)
+                if remaining > 0:
+                    return f"クールダウン中です。あと {remaining:.0f} 秒待ってね。"
+        for extra in self._checks:
+            reason = extra(command, msg)
+            if reason:
+                return reason
+        return None
+
+    async def run(self, command: Command, msg: Any, *args: Any, **kwargs: Any) -> Any:
+        reason = self.check(command, msg)
+        if reason:
+            raise CommandRejected(reason)
+        if command.cooldown:
+            self._last_used[(command.name, msg.author.id)] = time.monotonic()
+
+        async def call(index: int = 0) -> Any:
+            if index < len(self._middleware):
+                return await self._middleware[index](command, msg, lambda: call(index + 1))
+            return await command.handler(msg, *args, **kwargs)
+
+        return await call()
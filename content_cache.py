@@ -0,0 +1,263 @@
+"""外部から取ってくる画像・HTML・JSON の共有キャッシュ
+
+URL ごとにメモリ (LRU) とディスクの 2 段で保持する。有効期限 (ttl) 内なら
+そのまま返し、切れていれば ETag / Last-Modified を付けて問い合わせ、
+304 なら手元のものを使い続ける。同じ URL への同時要求は 1 回の取得にまとめる。
+結果は ``bot_content_cache_requests_total`` に数える。
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import aiohttp
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+RESULTS = ("memory", "disk", "revalidated", "miss", "stale")
+
+REQUESTS = metrics.Counter(
+    "bot_content_cache_requests_total", "Content cache lookups by outcome", ("namespace", "result"),
+)
+
+
+@dataclass
+class Entry:
+    url: str
+    data: bytes
+    content_type: str = ""
+    charset: str | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+    fetched_at: float = 0.0      # 最後に取得 / 再検証した時刻
+
+    def fresh(self, ttl: float) -> bool:
+        return time.time() - self.fetched_at < ttl
+
+    def text(self) -> str:
+        return self.data.decode(self.charset or "utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.data)
+
+    def meta(self) -> dict:
+        meta = asdict(self)
+        del meta["data"]
+        return meta
+
+
+class ContentCache:
+    def __init__(
+        self,
+        cache_dir: str,
+        memory_bytes: int = 32 * 1024 * 1024,
+        disk_bytes: int = 256 * 1024 * 1024,
+        max_entry_bytes: int = 8 * 1024 * 1024,
+        default_ttl: float = 300.0,
+        timeout: float = 10.0,
+    ):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.default_ttl = default_ttl
+        self.timeout = timeout
+        self._memory: collections.OrderedDict[str, Entry] = collections.OrderedDict()
+        self._memory_used = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._session: aiohttp.ClientSession | None = None
+        self._writes = 0
+        self.stats: collections.Counter[str] = collections.Counter()
+
+    # ── 公開 API ──
+    async def fetch(
+        self,
+        url: str,
+        *,
+        ttl: float | None = None,
+        namespace: str = "http",
+        stale_if_error: bool = True,
+    ) -> Entry:
+        """url の内容を返す。ttl=0 なら毎回再検証する
+
+        取得に失敗した場合、stale_if_error なら期限切れのものでも返す。
+        HTTP エラーは ``aiohttp.ClientResponseError`` として送出する。
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        key = hashlib.sha256(url.encode()).hexdigest()
+
+        entry = self._memory_get(key)
+        if entry is not None and entry.fresh(ttl):
+            self._count(namespace, "memory")
+            return entry
+        if entry is None:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self._memory_put(key, entry)
+                if entry.fresh(ttl):
+                    self._count(namespace, "disk")
+                    return entry
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            try:
+                result, outcome = await self._request(key, url, entry)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if entry is None or not stale_if_error:
+                    raise
+                logger.warning("content fetch failed for %s, serving stale copy: %s", url, e)
+                result, outcome = entry, "stale"
+            self._count(namespace, outcome)
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # 待っている人がいなくても警告を出さない
+            raise
+        finally:
+            del self._inflight[key]
+
+    def hit_rate(self) -> float:
+        """ネットワークから本体を取り直さずに済んだ割合"""
+        total = sum(self.stats.values())
+        return (total - self.stats["miss"]) / total if total else 0.0
+
+    def summary(self) -> str:
+        parts = " ".join(f"{r}={self.stats[r]}" for r in RESULTS)
+        return (
+            f"hit {self.hit_rate():.0%} ({parts}) "
+            f"memory {self._memory_used / 1024 / 1024:.1f}/{self.memory_bytes / 1024 / 1024:.0f}MB"
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # ── 取得 ──
+    def _count(self, namespace: str, result: str) -> None:
+        self.stats[result] += 1
+        REQUESTS.inc(namespace=namespace, result=result)
+
+    def _http(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _request(self, key: str, url: str, entry: Entry | None) -> tuple[Entry, str]:
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        with metrics.external("http"):
+            async with self._http().get(url, headers=headers) as resp:
+                if resp.status == 304 and entry is not None:
+                    entry.fetched_at = time.time()
+                    return entry, "revalidated"
+                resp.raise_for_status()
+                data = await resp.read()
+                fresh = Entry(
+                    url=url,
+                    data=data,
+                    content_type=resp.content_type,
+                    charset=resp.charset,
+                    etag=resp.headers.get("ETag"),
+                    last_modified=resp.headers.get("Last-Modified"),
+                    fetched_at=time.time(),
+                )
+        if len(data) <= self.max_entry_bytes:
+            self._memory_put(key, fresh)
+            await asyncio.to_thread(self._write_disk, key, fresh)
+        return fresh, "miss"
+
+    # ── メモリ ──
+    def _memory_get(self, key: str) -> Entry | None:
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+        return entry
+
+    def _memory_put(self, key: str, entry: Entry) -> None:
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= len(old.data)
+        self._memory[key] = entry
+        self._memory_used += len(entry.data)
+        while self._memory_used > self.memory_bytes and len(self._memory) > 1:
+            _key, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted.data)
+
+    # ── ディスク ──
+    # 1 ファイルに「メタ情報の JSON 1 行 + 本体」を書く
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.bin")
+
+    def _read_disk(self, key: str) -> Entry | None:
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+            os.utime(path)  # 最近使ったものを残す
+        except (OSError, ValueError):
+            return None
+        try:
+            return Entry(data=data, **meta)
+        except TypeError:   # 古い形式
+            return None
+
+    def _write_disk(self, key: str, entry: Entry) -> None:
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"  # 複数プロセスで同じ一時ファイルを使わない
+            with open(tmp, "wb") as f:
+                f.write(json.dumps(entry.meta()).encode() + b"\n")
+                f.write(entry.data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("content cache write failed: %s", e)
+            return
+        self._writes += 1
+        if self._writes % 50 == 0:
+            self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        entries = []
+        total = 0
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.disk_bytes:
+            return
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,188 @@
+"""シャードを複数プロセスに分けて動かす監督プロセス
+
+使い方::
+
+    python -m discordbot.launcher --processes 4              # シャード数は Discord の推奨値
+    python -m discordbot.launcher --processes 2 --shards 8
+
+シャード 0..N-1 を processes 個のグループに分け、グループごとに
+``python -m discordbot.bot`` を SHARD_COUNT / SHARD_IDS 付きで起動する。
+各プロセスは AutoShardedClient として自分のシャードだけを受け持つので、
+音声のエンコードなども含めて CPU コアごとに分散される。
+
+子プロセスが落ちたら間隔を空けて (連続で落ちるほど長く) 起動し直す。
+SIGINT / SIGTERM は子に伝えて終了を待つ。METRICS_PORT が設定されていれば
+子ごとに METRICS_PORT + 番号 のポートを使う。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+from dataclasses import dataclass
+
+import aiohttp
+from dotenv import load_dotenv
+
+logger = logging.getLogger("launcher")
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+IDENTIFY_INTERVAL = 5.0     # IDENTIFY は max_concurrency 個ずつ 5 秒に 1 回まで
+STABLE_SECONDS = 600        # これ以上動いてから落ちたなら連続失敗に数えない
+MAX_BACKOFF = 300.0
+STOP_GRACE = 30.0
+
+
+@dataclass
+class Child:
+    index: int
+    shard_ids: list[int]
+    proc: asyncio.subprocess.Process | None = None
+    failures: int = 0
+
+    @property
+    def label(self) -> str:
+        return f"proc{self.index}[shards {self.shard_ids[0]}-{self.shard_ids[-1]}]"
+
+
+def split_shards(shard_count: int, processes: int) -> list[list[int]]:
+    """0..shard_count-1 を連続した processes 個のグループに分ける"""
+    processes = max(1, min(processes, shard_count))
+    base, extra = divmod(shard_count, processes)
+    groups, start = [], 0
+    for i in range(processes):
+        size = base + (1 if i < extra else 0)
+        groups.append(list(range(start, start + size)))
+        start += size
+    return groups
+
+
+async def recommended_shards(token: str) -> tuple[int, int]:
+    """Discord が推奨するシャード数と IDENTIFY の同時実行数"""
+    headers = {"Authorization": f"Bot {token}"}
+    async with aiohttp.ClientSession() as sess:
+        async with sess.get(GATEWAY_URL, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return int(data["shards"]), int(data.get("session_start_limit", {}).get("max_concurrency", 1))
+
+
+class Launcher:
+    def __init__(self, shard_count: int, groups: list[list[int]], max_concurrency: int = 1):
+        self.shard_count = shard_count
+        self.children = [Child(i, ids) for i, ids in enumerate(groups)]
+        self.max_concurrency = max(1, max_concurrency)
+        self.stopping = asyncio.Event()
+
+    def _env(self, child: Child) -> dict[str, str]:
+        env = dict(os.environ)
+        env["SHARD_COUNT"] = str(self.shard_count)
+        env["SHARD_IDS"] = ",".join(map(str, child.shard_ids))
+        if env.get("METRICS_PORT"):
+            env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + child.index)
+        return env
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        tasks = []
+        for child in self.children:
+            tasks.append(asyncio.create_task(self._supervise(child)))
+            # 前のグループの IDENTIFY が済むまで次を起動しない
+            delay = len(child.shard_ids) * IDENTIFY_INTERVAL / self.max_concurrency
+            if await self._wait_stop(delay):
+                break
+        await asyncio.gather(*tasks)
+
+    def stop(self) -> None:
+        if self.stopping.is_set():
+            return
+        logger.info("stopping %d processes", len(self.children))
+        self.stopping.set()
+        for child in self.children:
+            if child.proc and child.proc.returncode is None:
+                child.proc.send_signal(signal.SIGTERM)
+
+    async def _wait_stop(self, seconds: float) -> bool:
+        """seconds 待つ。途中で停止が要求されたら True"""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _supervise(self, child: Child) -> None:
+        while not self.stopping.is_set():
+            child.proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", f"{__package__}.bot", env=self._env(child),
+            )
+            started = time.monotonic()
+            logger.info("%s started (pid %d)", child.label, child.proc.pid)
+            if self.stopping.is_set():      # 起動中に止められた
+                child.proc.send_signal(signal.SIGTERM)
+            try:
+                code = await child.proc.wait()
+            except asyncio.CancelledError:
+                child.proc.kill()
+                raise
+            if self.stopping.is_set():
+                logger.info("%s exited with %s", child.label, code)
+                return
+            if time.monotonic() - started > STABLE_SECONDS:
+                child.failures = 0
+            child.failures += 1
+            delay = min(MAX_BACKOFF, IDENTIFY_INTERVAL * 2 ** (child.failures - 1))
+            logger.warning("%s exited with %s; restarting in %.0fs", child.label, code, delay)
+            if await self._wait_stop(delay):
+                return
+
+    async def wait_children(self) -> None:
+        """停止後、猶予を過ぎても残っている子を kill する"""
+        procs = [c.proc for c in self.children if c.proc and c.proc.returncode is None]
+        if not procs:
+            return
+        await asyncio.wait([asyncio.create_task(p.wait()) for p in procs], timeout=STOP_GRACE)
+        for proc in procs:
+            if proc.returncode is None:
+                logger.warning("pid %d did not exit; killing", proc.pid)
+                proc.kill()
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    load_dotenv(os.path.join(ROOT_DIR, "..", ".env"))
+    load_dotenv(os.path.join(ROOT_DIR, ".env"))
+    max_concurrency = 1
+    shard_count = args.shards
+    if not shard_count:
+        token = os.getenv("DISCORD_BOT_TOKEN", "")
+        if not token:
+            raise SystemExit("DISCORD_BOT_TOKEN is not set; pass --shards explicitly")
+        shard_count, max_concurrency = await recommended_shards(token)
+        logger.info("recommended shard count: %d (max_concurrency %d)", shard_count, max_concurrency)
+    processes = args.processes or os.cpu_count() or 1
+    groups = split_shards(shard_count, processes)
+    launcher = Launcher(shard_count, groups, max_concurrency)
+    for child in launcher.children:
+        logger.info("%s", child.label)
+    try:
+        await launcher.run()
+    finally:
+        await launcher.wait_children()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="シャードを複数プロセスで起動する")
+    parser.add_argument("--processes", type=int, default=0, help="プロセス数 (省略時は CPU コア数)")
+    parser.add_argument("--shards", type=int, default=0, help="総シャード数 (省略時は Discord の推奨値)")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""SQLite のリース表による単独実行ジョブのリーダー選出
+
+同じホストで動く複数のプロセス (シャードごとのプロセスなど) のうち、
+1 つだけがジョブを動かすようにする。リースを持つプロセスは期限が切れる前に
+更新し続け、落ちた場合は期限切れの後に別のプロセスが引き継ぐ。
+
+    leases = LeaseManager("leases.sqlite3")
+    task = asyncio.create_task(leases.run_singleton("eew", watch_eew))
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name    TEXT PRIMARY KEY,
+    owner   TEXT NOT NULL,
+    expires REAL NOT NULL
+)
+"""
+
+
+class LeaseManager:
+    def __init__(self, path: str, owner: str | None = None, ttl: float = 30.0, renew_every: float = 10.0):
+        self.path = path
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.renew_every = renew_every
+        self.held: set[str] = set()
+
+    # ── SQLite (スレッドで呼ぶ) ──
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute(_SCHEMA)
+        return conn
+
+    def _acquire(self, name: str) -> bool:
+        """空いている (期限切れ・自分のもの) ならリースを取って True"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != self.owner and row[1] > now:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute(
+                "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires",
+                (name, self.owner, now + self.ttl),
+            )
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    def _renew(self, name: str) -> bool:
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "UPDATE leases SET expires = ? WHERE name = ? AND owner = ?",
+                (time.time() + self.ttl, name, self.owner),
+            )
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def _release(self, names: list[str]) -> None:
+        conn = self._connect()
+        try:
+            conn.executemany("DELETE FROM leases WHERE name = ? AND owner = ?", [(n, self.owner) for n in names])
+        finally:
+            conn.close()
+
+    def holders(self) -> dict[str, tuple[str, float]]:
+        """名前 → (持ち主, 残り秒数)"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT name, owner, expires FROM leases").fetchall()
+        finally:
+            conn.close()
+        now = time.time()
+        return {name: (owner, expires - now) for name, owner, expires in rows}
+
+    # ── 非同期 API ──
+    async def acquire(self, name: str) -> bool:
+        try:
+            ok = await asyncio.to_thread(self._acquire, name)
+        except sqlite3.Error as e:
+            logger.warning("lease %s: acquire failed: %s", name, e)
+            return False
+        if ok:
+            self.held.add(name)
+        return ok
+
+    async def renew(self, name: str) -> bool:
+        try:
+            ok = await asyncio.to_thread(self._renew, name)
+        except sqlite3.Error as e:
+            logger.warning("lease %s: renew failed: %s", name, e)
+            ok = False
+        if not ok:
+            self.held.discard(name)
+        return ok
+
+    async def release_all(self) -> None:
+        names, self.held = list(self.held), set()
+        if names:
+            try:
+                await asyncio.to_thread(self._release, names)
+            except sqlite3.Error as e:
+                logger.warning("lease release failed: %s", e)
+
+    async def run_singleton(self, name: str, job: Callable[[], Awaitable[Any]]) -> None:
+        """リースを持っている間だけ job() を動かす (他のプロセスが持っていれば待つ)"""
+        while True:
+            if not await self.acquire(name):
+                await asyncio.sleep(self.renew_every)
+                continue
+            logger.info("lease %s acquired by %s", name, self.owner)
+            task = asyncio.create_task(job())
+            try:
+                while True:
+                    done, _ = await asyncio.wait({task}, timeout=self.renew_every)
+                    if done:
+                        exc = task.exception()
+                        if exc is not None:
+                            logger.error("singleton job %s failed: %r", name, exc)
+                        break
+                    if not await self.renew(name):
+                        logger.warning("lease %s lost; stopping job", name)
+                        break
+            finally:
+                if not task.done():
+                    task.cancel()
+                    try:
+                        await task
+                    except BaseException:
+                        pass
+            # 落ちた・失ったときはリースを手放して少し待ってから取り直す
+            if name in self.held:
+                self.held.discard(name)
+                try:
+                    await asyncio.to_thread(self._release, [name])
+                except sqlite3.Error:
+                    pass
+            await asyncio.sleep(self.renew_every)
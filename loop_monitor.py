@@ -0,0 +1,183 @@
+"""イベントループの遅延監視
+
+ループ上のサンプラーが一定間隔で眠り、予定より遅れて起きた分を遅延として記録する。
+別スレッドのウォッチドッグがサンプラーの最終鼓動を見張り、閾値を超えて止まって
+いればその時点のループスレッドのスタックを ``sys._current_frames()`` で取得するので、
+どのハンドラがループを塞いだかを後から特定できる。
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class Stall:
+    """閾値を超えてループが止まった 1 回分"""
+    at: float                      # 発生時刻 (time.time())
+    duration: float = 0.0          # 止まっていた秒数 (終わるまで 0)
+    task: str | None = None        # 実行中だったタスク
+    site: str = "?"                # 原因とみなす行 (パッケージ内の一番内側のフレーム)
+    stack: list[str] = field(default_factory=list)
+
+
+def _task_name(loop: asyncio.AbstractEventLoop) -> str | None:
+    # 別スレッドからの参照なので current_task() は使わず内部の辞書を読む
+    task = asyncio.tasks._current_tasks.get(loop)
+    if task is None:
+        return None
+    coro = task.get_coro()
+    name = getattr(coro, "__qualname__", None) or repr(coro)
+    return f"{task.get_name()} ({name})"
+
+
+def _summarize(frames: traceback.StackSummary) -> tuple[str, list[str]]:
+    site = "?"
+    for fs in reversed(frames):
+        if fs.filename.startswith(_PACKAGE_DIR):
+            site = f"{os.path.basename(fs.filename)}:{fs.lineno} in {fs.name}"
+            break
+    else:
+        if frames:
+            fs = frames[-1]
+            site = f"{os.path.basename(fs.filename)}:{fs.lineno} in {fs.name}"
+    lines = [
+        f"{os.path.basename(fs.filename)}:{fs.lineno} {fs.name}: {(fs.line or '').strip()}"
+        for fs in frames
+    ]
+    return site, lines
+
+
+class LoopMonitor:
+    """ループ遅延のサンプリングと停止時のスタック採取"""
+
+    def __init__(
+        self,
+        interval: float = 0.1,
+        threshold: float = 0.25,
+        samples: int = 6000,
+        keep: int = 50,
+        stack_depth: int = 20,
+        log_every: float = 600.0,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.log_every = log_every
+        self.lag: collections.deque[float] = collections.deque(maxlen=samples)
+        self.stalls: collections.deque[Stall] = collections.deque(maxlen=keep)
+        self.stall_count = 0
+        self.started_at = 0.0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread = 0
+        self._beat = 0.0
+        self._pending: Stall | None = None
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    # ── 開始・停止 ──
+    def start(self) -> None:
+        """実行中のループで監視を始める (二重起動しない)"""
+        if self._task is not None and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        self.started_at = time.time()
+        self._stop.clear()
+        self._task = self._loop.create_task(self._sample(), name="loop-monitor")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    # ── ループ側 ──
+    async def _sample(self) -> None:
+        next_log = time.monotonic() + self.log_every
+        while True:
+            self._beat = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - self._beat - self.interval)
+            self.lag.append(lag)
+            if lag >= self.threshold:
+                self._finish_stall(lag)
+            if self.log_every and time.monotonic() >= next_log:
+                next_log = time.monotonic() + self.log_every
+                logger.info("event loop report\n%s", self.report())
+
+    def _finish_stall(self, lag: float) -> None:
+        with self._lock:
+            stall, self._pending = self._pending, None
+        if stall is None:
+            # ウォッチドッグが見る前に終わった
+            stall = Stall(at=time.time() - lag, site="(stack not captured)")
+        stall.duration = lag
+        self.stalls.append(stall)
+        self.stall_count += 1
+        logger.warning(
+            "event loop blocked for %.0fms at %s (task: %s)\n%s",
+            lag * 1000, stall.site, stall.task, "\n".join(stall.stack),
+        )
+
+    # ── ウォッチドッグスレッド ──
+    def _watch(self) -> None:
+        poll = max(0.01, self.threshold / 4)
+        while not self._stop.wait(poll):
+            late = time.perf_counter() - self._beat - self.interval
+            if late < self.threshold or self._pending is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            frames = traceback.extract_stack(frame, limit=self.stack_depth)
+            site, lines = _summarize(frames)
+            stall = Stall(at=time.time() - late, task=_task_name(self._loop), site=site, stack=lines)
+            with self._lock:
+                if self._pending is None:
+                    self._pending = stall
+
+    # ── 集計 ──
+    def percentile(self, p: float) -> float:
+        values = sorted(self.lag)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def report(self, recent: int = 5) -> str:
+        span = len(self.lag) * self.interval
+        lines = [
+            f"loop lag (last {span / 60:.0f} min): "
+            f"p50 {self.percentile(0.5) * 1000:.1f}ms / p99 {self.percentile(0.99) * 1000:.1f}ms"
+            f" / max {max(self.lag, default=0) * 1000:.0f}ms",
+            f"stalls >= {self.threshold * 1000:.0f}ms: {self.stall_count} since start",
+        ]
+        if self.stalls:
+            by_site: dict[str, list[float]] = collections.defaultdict(list)
+            for s in self.stalls:
+                by_site[s.site].append(s.duration)
+            lines.append("top sites:")
+            ranked = sorted(by_site.items(), key=lambda kv: sum(kv[1]), reverse=True)
+            for site, durations in ranked[:5]:
+                lines.append(f"  {len(durations)}x max {max(durations) * 1000:.0f}ms  {site}")
+            lines.append("recent:")
+            for s in list(self.stalls)[-recent:][::-1]:
+                at = datetime.datetime.fromtimestamp(s.at).strftime("%H:%M:%S")
+                lines.append(f"  {at} {s.duration * 1000:.0f}ms  {s.site}  [{s.task or '-'}]")
+        return "\n".join(lines)
@@ -0,0 +1,160 @@
+"""ギルドごとのメンバー活動インデックス
+
+ゲートウェイのイベントから「ユーザーごとの最後の発言」と「オンライン人数」を
+更新しておき、y!user / y!server がメンバー一覧や履歴を走査せずに答えられる
+ようにする。オンライン人数は、メンバーの取得 (チャンク) が終わったギルドで
+一度だけ数え、その後は presence の変化で増減させる。
+
+ギルド全体の最後の発言として持つのは、起動後に実際に見た発言 (on_message) だけ。
+起動前の発言は呼ばれたチャンネルの履歴から探し、その結果はチャンネルごとに
+覚える。どちらも件数の上限を超えたら古いものから捨てる。発言者を捨てたときは
+その人の探索結果も捨てる (起動後の発言より古い結果を返さないように)。
+"""
+from __future__ import annotations
+
+import collections
+import datetime
+from dataclasses import dataclass, field
+
+import discord
+
+
+@dataclass(frozen=True)
+class LastMessage:
+    created_at: datetime.datetime
+    channel_id: int
+    message_id: int
+
+
+@dataclass
+class _GuildActivity:
+    # 起動後に見た発言 (ユーザー → 最後の発言)。古く更新されたものから捨てる
+    last_message: collections.OrderedDict[int, LastMessage] = field(default_factory=collections.OrderedDict)
+    online: int | None = None       # None はまだ数えていない
+    # 履歴を探した結果 ((チャンネル, ユーザー) → 見つかった発言 / None)
+    scanned: collections.OrderedDict[tuple[int, int], LastMessage | None] = field(
+        default_factory=collections.OrderedDict
+    )
+
+
+def _remember(d: collections.OrderedDict, key, value, limit: int) -> list:
+    """d[key] = value として、上限を超えた古いものを捨てる。捨てたキーを返す"""
+    d[key] = value
+    d.move_to_end(key)
+    evicted = []
+    while len(d) > limit:
+        evicted.append(d.popitem(last=False)[0])
+    return evicted
+
+
+def _is_online(member: discord.Member) -> bool:
+    return member.status is not discord.Status.offline
+
+
+class MemberActivityIndex:
+    def __init__(self, max_users: int = 10_000, max_scans: int = 2_000) -> None:
+        """max_users / max_scans: ギルドごとに覚える発言者数 / 履歴の探索結果数"""
+        self._guilds: dict[int, _GuildActivity] = {}
+        self.max_users = max_users
+        self.max_scans = max_scans
+
+    def _get(self, guild_id: int) -> _GuildActivity:
+        act = self._guilds.get(guild_id)
+        if act is None:
+            act = self._guilds[guild_id] = _GuildActivity()
+        return act
+
+    # ── イベント ──
+    def on_message(self, msg: discord.Message) -> None:
+        if msg.guild is None:
+            return
+        act = self._get(msg.guild.id)
+        evicted = _remember(
+            act.last_message, msg.author.id,
+            LastMessage(msg.created_at, msg.channel.id, msg.id), self.max_users,
+        )
+        for user_id in evicted:
+            # 起動後の発言を忘れたので、それより前に探した履歴の結果も古い
+            self._forget_scans(act, user_id)
+
+    def on_presence_update(self, before: discord.Member, after: discord.Member) -> None:
+        act = self._guilds.get(after.guild.id)
+        if act is None or act.online is None:
+            return
+        was, now = _is_online(before), _is_online(after)
+        if was != now:
+            act.online += 1 if now else -1
+
+    def on_member_join(self, member: discord.Member) -> None:
+        act = self._guilds.get(member.guild.id)
+        if act is not None and act.online is not None and _is_online(member):
+            act.online += 1
+
+    def on_member_remove(self, member: discord.Member) -> None:
+        act = self._guilds.get(member.guild.id)
+        if act is None:
+            return
+        act.last_message.pop(member.id, None)
+        self._forget_scans(act, member.id)
+        if act.online is not None and _is_online(member):
+            act.online -= 1
+
+    @staticmethod
+    def _forget_scans(act: _GuildActivity, user_id: int) -> None:
+        for key in [k for k in act.scanned if k[1] == user_id]:
+            del act.scanned[key]
+
+    def forget_guild(self, guild_id: int) -> None:
+        self._guilds.pop(guild_id, None)
+
+    # ── 参照 ──
+    def online(self, guild: discord.Guild) -> int:
+        """オンライン (offline 以外) のメンバー数"""
+        act = self._get(guild.id)
+        if act.online is None:
+            count = sum(1 for m in guild.members if _is_online(m))
+            if not guild.chunked:
+                return count    # メンバーがまだ揃っていないので覚えない
+            act.online = count
+        return act.online
+
+    def last_message(self, guild_id: int, user_id: int) -> LastMessage | None:
+        act = self._guilds.get(guild_id)
+        return act.last_message.get(user_id) if act else None
+
+    async def find_last_message(
+        self, channel: discord.abc.Messageable, user_id: int, limit: int = 100
+    ) -> LastMessage | None:
+        """最後の発言。起動後に見ていなければ channel の直近の履歴を探す
+
+        起動後の発言はどのチャンネルのものでも起動前の発言より新しいのでそれを返す。
+        起動前の発言は後から増えないので、履歴を探すのはチャンネルごとに 1 回でよい。
+        """
+        guild = getattr(channel, "guild", None)
+        if guild is None:
+            return await self._scan(channel, user_id, limit)
+        act = self._get(guild.id)
+        found = act.last_message.get(user_id)
+        if found is not None:
+            return found
+        key = (channel.id, user_id)
+        if key in act.scanned:
+            act.scanned.move_to_end(key)
+            return act.scanned[key]
+        found = await self._scan(channel, user_id, limit)
+        _remember(act.scanned, key, found, self.max_scans)
+        return found
+
+    @staticmethod
+    async def _scan(channel: discord.abc.Messageable, user_id: int, limit: int) -> LastMessage | None:
+        try:
+            async for m in channel.history(limit=limit):
+                if m.author.id == user_id:
+                    return LastMessage(m.created_at, m.channel.id, m.id)
+        except discord.HTTPException:
+            pass
+        return None
+
+    def stats(self) -> dict[int, int]:
+        """ギルドごとの記録済みユーザー数"""
+        return {gid: len(act.last_message) for gid, act in self._guilds.items()}
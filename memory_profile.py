@@ -0,0 +1,177 @@
+"""ゲートウェイのキャッシュ設定 (メモリプロファイル) とギルドごとのメモリ見積もり
+
+BOT_MEMORY_PROFILE で次のどれかを選ぶ。
+
+- ``full``     : presence を受け取り、全メンバーを起動時に取得してキャッシュする (従来どおり)
+- ``balanced`` : presence を受け取らない。キャッシュするのは VC 参加者と、
+                 起動後に参加・発言などで見えたメンバーだけ。メッセージキャッシュは 500 件
+- ``lean``     : members intent も切り、VC 参加者だけをキャッシュ。メッセージキャッシュなし
+
+名言カードの PNG キャッシュの大きさもプロファイルに合わせて小さくする。
+シーク用のストリーム先読みは full では再生開始時から、それ以外では最初のシークから行う。
+
+大きなギルドでは presence と全メンバーのキャッシュがメモリの大半を占める。
+"""
+from __future__ import annotations
+
+import logging
+import sys
+from dataclasses import dataclass
+from typing import Any
+
+import discord
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MemoryProfile:
+    name: str
+    presences: bool
+    members: bool                   # members intent (参加・退出イベント、メンバー一覧)
+    chunk_guilds_at_startup: bool   # 起動時に全メンバーを取得するか
+    max_messages: int | None
+    quote_cache_mb: int = 32        # 名言カードの PNG キャッシュ
+    prefetch_streams: bool = True   # 再生開始時からシーク用に先読みするか
+
+    def apply(self, intents: discord.Intents) -> dict[str, Any]:
+        """intents を書き換え、discord.Client に渡す追加の引数を返す"""
+        intents.presences = self.presences
+        intents.members = self.members
+        # VC 参加者は常に (自動切断で人数を見る)、members intent があれば参加・発言したメンバーも
+        return {
+            "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+            "chunk_guilds_at_startup": self.chunk_guilds_at_startup,
+            "max_messages": self.max_messages,
+        }
+
+
+PROFILES = {
+    "full": MemoryProfile("full", presences=True, members=True, chunk_guilds_at_startup=True, max_messages=1000,
+                          quote_cache_mb=32, prefetch_streams=True),
+    "balanced": MemoryProfile("balanced", presences=False, members=True, chunk_guilds_at_startup=False,
+                              max_messages=500, quote_cache_mb=8, prefetch_streams=False),
+    "lean": MemoryProfile("lean", presences=False, members=False, chunk_guilds_at_startup=False,
+                          max_messages=None, quote_cache_mb=2, prefetch_streams=False),
+}
+
+
+def load_profile(name: str | None) -> MemoryProfile:
+    profile = PROFILES.get((name or "full").strip().lower())
+    if profile is None:
+        logger.warning("unknown BOT_MEMORY_PROFILE %r; using full", name)
+        profile = PROFILES["full"]
+    return profile
+
+
+# ──────────── メモリの見積もり ────────────
+# 他のオブジェクトと共有しているもの (辿ると全体を数えてしまう)
+_SHARED = (discord.Client, discord.Guild, discord.abc.GuildChannel, discord.Role, type)
+
+
+def approx_size(obj: Any, depth: int = 3, _seen: set[int] | None = None) -> int:
+    """obj と、それが持っている値のおおよそのバイト数"""
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if depth <= 0 or isinstance(obj, (str, bytes, int, float, bool)):
+        return size
+    if isinstance(obj, dict):
+        children = [*obj.keys(), *obj.values()]
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = list(obj)
+    else:
+        children = []
+        for cls in type(obj).__mro__:
+            for slot in getattr(cls, "__slots__", ()):
+                if slot in ("_state", "guild") or not hasattr(obj, slot):
+                    continue
+                children.append(getattr(obj, slot))
+        children.extend(getattr(obj, "__dict__", {}).values())
+    for child in children:
+        if child is None or isinstance(child, _SHARED) or type(child).__name__ == "ConnectionState":
+            continue
+        size += approx_size(child, depth - 1, seen)
+    return size
+
+
+def _estimate(items: list, sample: int = 50) -> int:
+    """先頭 sample 件を測って全体に引き伸ばす"""
+    if not items:
+        return 0
+    picked = items[:sample]
+    return sum(approx_size(x) for x in picked) * len(items) // len(picked)
+
+
+@dataclass
+class GuildMemory:
+    guild_id: int
+    name: str
+    member_count: int
+    members_cached: int
+    with_presence: int
+    messages_cached: int
+    voice_states: int
+    members_bytes: int
+    messages_bytes: int
+    other_bytes: int         # ロール・チャンネル・絵文字
+
+    @property
+    def total_bytes(self) -> int:
+        return self.members_bytes + self.messages_bytes + self.other_bytes
+
+
+def guild_memory(client: discord.Client, guild: discord.Guild) -> GuildMemory:
+    members = list(guild.members)
+    messages = [m for m in client.cached_messages if m.guild is not None and m.guild.id == guild.id]
+    others = [*guild.roles, *guild.channels, *guild.emojis, *guild.stickers]
+    return GuildMemory(
+        guild_id=guild.id,
+        name=guild.name,
+        member_count=guild.member_count or 0,
+        members_cached=len(members),
+        with_presence=sum(1 for m in members if m.status is not discord.Status.offline or m.activities),
+        messages_cached=len(messages),
+        voice_states=len(getattr(guild, "_voice_states", {})),
+        members_bytes=_estimate(members),
+        messages_bytes=_estimate(messages),
+        # チャンネルやロールは _SHARED なので 1 段だけ数える
+        other_bytes=sum(approx_size(x, depth=1) for x in others),
+    )
+
+
+def _kb(n: int) -> str:
+    return f"{n / 1024:,.0f} KB"
+
+
+def report(client: discord.Client, profile: MemoryProfile, guild: discord.Guild | None = None) -> str:
+    """プロファイルとギルドごとのキャッシュ量 (guild 指定時はそのギルドだけ)"""
+    if resource is not None:
+        rss = f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.0f} MB"
+    else:
+        rss = "—"
+    lines = [
+        f"profile: {profile.name} (presences={profile.presences}, members={profile.members}, "
+        f"chunk={profile.chunk_guilds_at_startup}, max_messages={profile.max_messages}, "
+        f"quote_cache={profile.quote_cache_mb} MB, prefetch={profile.prefetch_streams})",
+        f"process peak RSS: {rss} / guilds: {len(client.guilds)} / "
+        f"users cached: {len(client.users)} / messages cached: {len(client.cached_messages)}",
+        "",
+    ]
+    guilds = [guild] if guild is not None else sorted(client.guilds, key=lambda g: g.member_count or 0, reverse=True)
+    for g in guilds[:15]:
+        gm = guild_memory(client, g)
+        lines.append(
+            f"{gm.name[:24]}: members {gm.members_cached}/{gm.member_count} "
+            f"(presence {gm.with_presence}) ≈{_kb(gm.members_bytes)}, "
+            f"messages {gm.messages_cached} ≈{_kb(gm.messages_bytes)}, "
+            f"voice {gm.voice_states}, other ≈{_kb(gm.other_bytes)} → ≈{_kb(gm.total_bytes)}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,255 @@
+"""コマンド単位の計測と Prometheus 形式のエクスポート
+
+コマンド実行中は ``contextvars`` に実行中の呼び出しを置き、その間に行われた
+Discord API / LLM / yt-dlp の呼び出し時間を ``external()`` で積み上げる。
+終了時にコマンドごとの合計時間と外部呼び出し時間をヒストグラムへ記録し、
+``serve()`` で立てた HTTP サーバーの ``/metrics`` から読める。
+"""
+from __future__ import annotations
+
+import bisect
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelKey = tuple[str, ...]
+
+
+def _fmt_labels(names: tuple[str, ...], values: LabelKey, extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, values: dict[str, object]) -> LabelKey:
+        return tuple(_escape(values.get(n, "")) for n in self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_fmt_labels(self.labels, k)} {v:g}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: object) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        # ラベルごとに [各バケットの件数..., 合計, 件数]
+        self._values: dict[LabelKey, list[float]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, row in items:
+            cumulative = 0.0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {cumulative:g}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {row[-1]:g}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {row[-2]:.6f}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {row[-1]:g}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+COMMAND_SECONDS = Histogram(
+    "bot_command_duration_seconds", "Wall time of a command from dispatch to return",
+    ("command", "via"),
+)
+COMMAND_BACKEND_SECONDS = Histogram(
+    "bot_command_backend_seconds", "Time a command spent waiting on an external backend",
+    ("command", "backend"),
+)
+COMMANDS_TOTAL = Counter(
+    "bot_commands_total", "Commands handled", ("command", "via", "status"),
+)
+COMMANDS_IN_FLIGHT = Gauge(
+    "bot_commands_in_flight", "Commands currently running", ("command",),
+)
+EXTERNAL_SECONDS = Histogram(
+    "bot_external_call_seconds", "Duration of individual external calls", ("backend", "command"),
+)
+EXTERNAL_ERRORS = Counter(
+    "bot_external_call_errors_total", "External calls that raised", ("backend", "command"),
+)
+
+
+# ──────────── コマンド単位の集計 ────────────
+@dataclass
+class Invocation:
+    command: str
+    via: str
+    backends: dict[str, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, backend: str, seconds: float) -> None:
+        with self._lock:
+            self.backends[backend] = self.backends.get(backend, 0.0) + seconds
+
+
+_current: contextvars.ContextVar[Invocation | None] = contextvars.ContextVar("metrics_invocation", default=None)
+
+
+def detached() -> contextvars.Context:
+    """コマンドに紐付けない長寿命タスク用の空コンテキスト"""
+    return contextvars.Context()
+
+
+def current_command() -> str:
+    inv = _current.get()
+    return inv.command if inv else "-"
+
+
+@contextlib.contextmanager
+def external(backend: str) -> Iterator[None]:
+    """外部呼び出し 1 回分を計測し、実行中のコマンドに積み上げる
+
+    ``asyncio.to_thread`` はコンテキストを引き継ぐので、スレッド側で使っても
+    呼び出し元のコマンドに計上される。
+    """
+    inv = _current.get()
+    command = inv.command if inv else "-"
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_ERRORS.inc(backend=backend, command=command)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        EXTERNAL_SECONDS.observe(elapsed, backend=backend, command=command)
+        if inv is not None:
+            inv.add(backend, elapsed)
+
+
+@contextlib.asynccontextmanager
+async def track(command: str, via: str = "text"):
+    """コマンド 1 回分を計測する (入れ子の場合は外側だけを数える)"""
+    if _current.get() is not None:
+        yield
+        return
+    inv = Invocation(command, via)
+    token = _current.set(inv)
+    COMMANDS_IN_FLIGHT.inc(command=command)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        _current.reset(token)
+        COMMANDS_IN_FLIGHT.dec(command=command)
+        COMMAND_SECONDS.observe(time.perf_counter() - started, command=command, via=via)
+        COMMANDS_TOTAL.inc(command=command, via=via, status=status)
+        for backend, seconds in inv.backends.items():
+            COMMAND_BACKEND_SECONDS.observe(seconds, command=command, backend=backend)
+
+
+def instrument_http(http: Any) -> None:
+    """discord.py の HTTPClient.request を包み、REST 呼び出しを discord として数える"""
+    if getattr(http, "_metrics_wrapped", False):
+        return
+    original = http.request
+
+    @functools.wraps(original)
+    async def request(*args, **kwargs):
+        with external("discord"):
+            return await original(*args, **kwargs)
+
+    http.request = request
+    http._metrics_wrapped = True
+
+
+# ──────────── エクスポート ────────────
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(_req: web.Request) -> web.Response:
+    return web.Response(
+        body=render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    """``/metrics`` を返す HTTP サーバーを起動する"""
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("metrics endpoint on http://%s:%d/metrics", host, port)
+    return runner
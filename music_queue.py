@@ -0,0 +1,206 @@
+"""音楽キュー用のインデックス付きリスト"""
+from __future__ import annotations
+
+import bisect
+import random
+from typing import Generic, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# 1 チャンクの目安サイズ。2 倍を超えたら分割する
+CHUNK_SIZE = 256
+
+
+class TrackQueue(Generic[T]):
+    """チャンク分割リストによる再生キュー
+
+    要素を最大 ``2 * CHUNK_SIZE`` 件ずつのチャンクに分けて持ち、
+    各チャンク先頭の通し番号を二分探索して位置を求める。
+    インデックス参照・削除・挿入・移動は O(log n + CHUNK_SIZE)、
+    ページ取得は表示する件数分だけしか触らない。
+
+    ``version`` は内容が変わるたびに増えるので、描画キャッシュの
+    無効化判定に使える。
+    """
+
+    def __init__(self, items: Iterable[T] = ()):
+        self._chunks: list[list[T]] = []
+        self._offsets: list[int] = []   # 各チャンク先頭の通し番号
+        self._dirty = False
+        self._len = 0
+        self.version = 0
+        self.extend(items)
+
+    # ── 基本 ──
+    def __len__(self) -> int:
+        return self._len
+
+    def __bool__(self) -> bool:
+        return self._len > 0
+
+    def __iter__(self) -> Iterator[T]:
+        for chunk in self._chunks:
+            yield from chunk
+
+    def __contains__(self, item: object) -> bool:
+        return any(item in chunk for chunk in self._chunks)
+
+    def __repr__(self) -> str:
+        return f"TrackQueue(len={self._len})"
+
+    def __getitem__(self, index: int) -> T:
+        ci, pos = self._locate(index)
+        return self._chunks[ci][pos]
+
+    def __delitem__(self, index: int) -> None:
+        self.pop(index)
+
+    # ── 内部 ──
+    def _touch(self) -> None:
+        self._dirty = True
+        self.version += 1
+
+    def _reindex(self) -> None:
+        offsets, total = [], 0
+        for chunk in self._chunks:
+            offsets.append(total)
+            total += len(chunk)
+        self._offsets = offsets
+        self._dirty = False
+
+    def _normalize(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("queue index out of range")
+        return index
+
+    def _locate(self, index: int) -> tuple[int, int]:
+        """通し番号 → (チャンク番号, チャンク内位置)"""
+        index = self._normalize(index)
+        if self._dirty:
+            self._reindex()
+        ci = bisect.bisect_right(self._offsets, index) - 1
+        return ci, index - self._offsets[ci]
+
+    def _drop_if_empty(self, ci: int) -> None:
+        if not self._chunks[ci]:
+            del self._chunks[ci]
+
+    def _split_if_large(self, ci: int) -> None:
+        chunk = self._chunks[ci]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[ci:ci + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+
+    # ── 追加 ──
+    def append(self, item: T) -> None:
+        if not self._chunks or len(self._chunks[-1]) >= CHUNK_SIZE:
+            self._chunks.append([])
+        self._chunks[-1].append(item)
+        self._len += 1
+        self._touch()
+
+    def extend(self, items: Iterable[T]) -> None:
+        for item in items:
+            self.append(item)
+
+    def insert(self, index: int, item: T) -> None:
+        """index の位置に挿入 (len 以上なら末尾)"""
+        if index < 0:
+            index = max(0, index + self._len)
+        if index >= self._len:
+            self.append(item)
+            return
+        ci, pos = self._locate(index)
+        self._chunks[ci].insert(pos, item)
+        self._len += 1
+        self._split_if_large(ci)
+        self._touch()
+
+    # ── 削除 ──
+    def pop(self, index: int = -1) -> T:
+        ci, pos = self._locate(index)
+        item = self._chunks[ci].pop(pos)
+        self._drop_if_empty(ci)
+        self._len -= 1
+        self._touch()
+        return item
+
+    def popleft(self) -> T:
+        return self.pop(0)
+
+    def remove_range(self, start: int, stop: int) -> list[T]:
+        """[start, stop) の範囲をまとめて削除して返す"""
+        start = max(0, start)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+        if self._dirty:
+            self._reindex()
+        removed: list[T] = []
+        ci = bisect.bisect_right(self._offsets, start) - 1
+        base = self._offsets[ci]
+        remaining = stop - start
+        while remaining:
+            chunk = self._chunks[ci]
+            lo = start - base
+            hi = min(len(chunk), lo + remaining)
+            removed.extend(chunk[lo:hi])
+            del chunk[lo:hi]
+            remaining -= hi - lo
+            if chunk:
+                base += len(chunk)
+                start = base
+                ci += 1
+            else:
+                del self._chunks[ci]
+        self._len -= len(removed)
+        self._touch()
+        return removed
+
+    def keep(self, indices: Iterable[int]) -> list[T]:
+        """指定位置 (0 始まり) だけ残し、それ以外を削除して返す"""
+        wanted = set(indices)
+        kept: list[T] = []
+        removed: list[T] = []
+        for i, item in enumerate(self):
+            (kept if i in wanted else removed).append(item)
+        self.clear()
+        self.extend(kept)
+        return removed
+
+    def clear(self) -> None:
+        self._chunks = []
+        self._offsets = []
+        self._len = 0
+        self._touch()
+
+    # ── 並べ替え ──
+    def move(self, src: int, dst: int) -> None:
+        """src の要素を取り出して dst の位置へ入れる"""
+        item = self.pop(src)
+        self.insert(dst, item)
+
+    def shuffle(self, rng: random.Random | None = None) -> None:
+        items = list(self)
+        (rng or random).shuffle(items)
+        self.clear()
+        self.extend(items)
+
+    # ── ページ表示 ──
+    def page(self, start: int, count: int) -> list[T]:
+        """start から最大 count 件を返す (触るのは該当チャンクだけ)"""
+        if count <= 0 or start >= self._len:
+            return []
+        start = max(0, start)
+        if self._dirty:
+            self._reindex()
+        out: list[T] = []
+        ci = bisect.bisect_right(self._offsets, start) - 1
+        pos = start - self._offsets[ci]
+        while ci < len(self._chunks) and len(out) < count:
+            chunk = self._chunks[ci]
+            out.extend(chunk[pos:pos + count - len(out)])
+            ci += 1
+            pos = 0
+        return out
@@ -0,0 +1,109 @@
+"""再起動をまたいで再生状態を引き継ぐための保存形式
+
+終了時にギルドごとの VC・通知先チャンネル・ループ設定・再生位置・キューを
+gzip した JSON 1 ファイルに書き、次の起動時に読む。再開を試みたあと、
+このプロセスで扱えなかった分 (別のプロセスのギルド) だけを書き戻す。
+曲は ``[タイトル, URL, 長さ, 元ページ URL]`` の配列で持つ。署名付きの
+ストリーム URL は期限が切れるうえに長いので、元ページ URL があれば
+保存せず、再生時に取り直す。
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+SavedTrack = tuple[str, str, int | None, str | None]   # title, url, duration, page_url
+
+
+@dataclass
+class SavedPlayer:
+    guild_id: int
+    voice_channel_id: int
+    text_channel_id: int
+    loop: int = 0
+    auto_leave: bool = True
+    position: float = 0.0       # tracks[0] の再生位置 (playing のとき)
+    playing: bool = False       # tracks[0] が再生中だった曲か
+    tracks: list[SavedTrack] = field(default_factory=list)
+
+    def to_json(self) -> dict:
+        return {
+            "g": self.guild_id, "v": self.voice_channel_id, "t": self.text_channel_id,
+            "l": self.loop, "a": int(self.auto_leave),
+            "p": round(self.position, 1), "c": int(self.playing),
+            "q": [list(t) for t in self.tracks],
+        }
+
+    @classmethod
+    def from_json(cls, d: dict) -> "SavedPlayer":
+        return cls(
+            guild_id=int(d["g"]), voice_channel_id=int(d["v"]), text_channel_id=int(d["t"]),
+            loop=int(d.get("l", 0)), auto_leave=bool(d.get("a", 1)),
+            position=float(d.get("p", 0)), playing=bool(d.get("c", 0)),
+            tracks=[(t[0], t[1], t[2], t[3]) for t in d.get("q", [])],
+        )
+
+
+def compact_track(title: str, url: str, duration: int | None, page_url: str | None) -> SavedTrack | None:
+    """保存用の曲。作り直せない曲 (元 URL のないローカルファイル) は None"""
+    if page_url:
+        # ストリーム URL は元ページから取り直せる。元ページ自体が URL なら重複させない
+        if url.startswith(("http://", "https://")) and url != page_url:
+            url = ""
+        elif not url.startswith(("http://", "https://")):
+            url = page_url      # 添付ファイル: 一時ファイルではなく元の URL から再生
+    elif not url.startswith(("http://", "https://")):
+        return None
+    return (title, url, duration, page_url)
+
+
+def save(path: str, players: list[SavedPlayer]) -> None:
+    if not players:
+        remove(path)
+        return
+    payload = {"v": VERSION, "ts": int(time.time()), "players": [p.to_json() for p in players]}
+    data = gzip.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode())
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    logger.info("saved %d player(s) to %s (%d bytes)", len(players), path, len(data))
+
+
+def load(path: str, max_age: float) -> list[SavedPlayer]:
+    """保存した状態を読む (ファイルは消さない)。無い・古すぎる・壊れているときは空"""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        logger.warning("could not read saved player state %s: %s", path, e)
+        return []
+    try:
+        payload = json.loads(gzip.decompress(raw))
+        if payload.get("v") != VERSION:
+            return []
+        age = time.time() - payload.get("ts", 0)
+        if age > max_age:
+            logger.info("saved player state is %.0fs old; not resuming", age)
+            return []
+        return [SavedPlayer.from_json(p) for p in payload.get("players", [])]
+    except (OSError, ValueError, KeyError, TypeError, IndexError) as e:
+        logger.warning("could not read saved player state %s: %s", path, e)
+        return []
+
+
+def remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,279 @@
+"""メッセージ一括削除のエンジン
+
+チャンネルごとに履歴を読む係と消す係をキューでつなぎ、読みながら消す。
+作成から 14 日以内のメッセージは 100 件ずつ一括削除し、それより古いものは
+1 件ずつ消す。同じチャンネルへの削除は順番に投げるので、discord.py の
+レートリミット処理 (バケットごとの待機) にそのまま乗る。複数チャンネルは
+``channel_concurrency`` 個まで並行に処理する。進捗は ``on_progress`` に
+一定間隔で渡す。
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+BULK_MAX = 100
+# 一括削除できるのは 14 日以内。境界ぎりぎりは弾かれるので少し余裕を取る
+BULK_WINDOW = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+MESSAGE_TOO_OLD = 50034   # 一括削除で古いメッセージが混ざったときのエラーコード
+
+
+@dataclass(frozen=True)
+class PurgeFilter:
+    """削除対象の条件 (空の項目は条件にしない)"""
+    authors: frozenset[int] = frozenset()
+    contains: str = ""
+    bots_only: bool = False
+    exclude: frozenset[int] = frozenset()       # 消さないメッセージ ID
+
+    def __call__(self, m: discord.Message) -> bool:
+        if m.id in self.exclude:
+            return False
+        if self.authors and m.author.id not in self.authors:
+            return False
+        if self.bots_only and not m.author.bot:
+            return False
+        if self.contains and self.contains.casefold() not in m.content.casefold():
+            return False
+        return True
+
+    def describe(self) -> str:
+        parts = []
+        if self.authors:
+            parts.append("投稿者: " + ", ".join(f"<@{a}>" for a in sorted(self.authors)))
+        if self.bots_only:
+            parts.append("BOT のみ")
+        if self.contains:
+            parts.append(f"「{self.contains}」を含む")
+        return " / ".join(parts)
+
+
+@dataclass
+class ChannelProgress:
+    name: str
+    scanned: int = 0
+    matched: int = 0
+    bulk: int = 0           # 一括削除した件数
+    single: int = 0         # 1 件ずつ削除した件数
+    failed: int = 0
+    done: bool = False
+    error: str | None = None
+
+    @property
+    def deleted(self) -> int:
+        return self.bulk + self.single
+
+
+@dataclass
+class PurgeProgress:
+    channels: dict[int, ChannelProgress] = field(default_factory=dict)
+    started: float = field(default_factory=time.monotonic)
+    finished: bool = False
+
+    def total(self, attr: str) -> int:
+        return sum(getattr(c, attr) for c in self.channels.values())
+
+    @property
+    def deleted(self) -> int:
+        return self.total("deleted")
+
+    def render(self) -> str:
+        """進捗メッセージ用のテキスト"""
+        head = "🧹 削除完了" if self.finished else "🧹 削除中…"
+        lines = [
+            f"{head} {self.deleted}/{self.total('matched')}件 "
+            f"(一括 {self.total('bulk')} / 個別 {self.total('single')}) "
+            f"確認 {self.total('scanned')}件・{time.monotonic() - self.started:.0f}秒"
+        ]
+        if len(self.channels) > 1 or any(c.error for c in self.channels.values()):
+            for c in self.channels.values():
+                mark = f"⚠️ {c.error}" if c.error else ("✅" if c.done else "…")
+                lines.append(f"#{c.name}: {c.deleted}件 {mark}")
+        failed = self.total("failed")
+        if failed:
+            lines.append(f"削除できなかったメッセージ: {failed}件")
+        return "\n".join(lines)
+
+
+class PurgeEngine:
+    def __init__(
+        self,
+        channels: list[Any],
+        check: Callable[[discord.Message], bool],
+        *,
+        limit: int | None = None,
+        after: discord.abc.Snowflake | None = None,
+        before: discord.abc.Snowflake | None = None,
+        max_scan: int = 10_000,
+        channel_concurrency: int = 3,
+        on_progress: Callable[[PurgeProgress], Awaitable[None]] | None = None,
+        report_every: float = 2.0,
+        reason: str | None = None,
+    ):
+        """
+        limit   : チャンネルごとに消す最大件数 (None なら範囲内すべて)
+        after   : これより新しいメッセージだけを対象にする (古い順に読む)
+        before  : これより古いメッセージだけを対象にする
+        max_scan: チャンネルごとに読む履歴の上限
+        """
+        self.channels = channels
+        self.check = check
+        self.limit = limit
+        self.after = after
+        self.before = before
+        self.max_scan = max_scan
+        self.on_progress = on_progress
+        self.report_every = report_every
+        self.reason = reason
+        self.progress = PurgeProgress()
+        self._sem = asyncio.Semaphore(channel_concurrency)
+        self._last_report = 0.0
+        self._reporting = False
+
+    async def run(self) -> PurgeProgress:
+        for ch in self.channels:
+            self.progress.channels[ch.id] = ChannelProgress(getattr(ch, "name", str(ch.id)))
+        await self._report(force=True)
+        await asyncio.gather(*(self._purge_channel(ch) for ch in self.channels))
+        self.progress.finished = True
+        await self._report(force=True)
+        return self.progress
+
+    # ── チャンネル単位 ──
+    async def _purge_channel(self, channel: Any) -> None:
+        prog = self.progress.channels[channel.id]
+        async with self._sem:
+            queue: asyncio.Queue[tuple[str, list[discord.Message]] | None] = asyncio.Queue(maxsize=2)
+            scanner = asyncio.create_task(self._scan_all(channel, prog, queue))
+            deleter = asyncio.create_task(self._delete(channel, prog, queue))
+            # 片方が想定外の例外で止まると、もう片方がキューで待ち続けるので両方止める
+            try:
+                await asyncio.wait((scanner, deleter), return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                for task in (scanner, deleter):
+                    task.cancel()
+                await asyncio.gather(scanner, deleter, return_exceptions=True)
+            for task in (deleter, scanner):
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+            prog.done = True
+
+    async def _scan_all(self, channel: Any, prog: ChannelProgress, queue: asyncio.Queue) -> None:
+        """_scan して、最後に終わりの印 (None) を流す"""
+        try:
+            await self._scan(channel, prog, queue)
+        except discord.Forbidden:
+            prog.error = "履歴を読む権限がありません"
+        except discord.HTTPException as e:
+            prog.error = f"履歴の取得に失敗 ({e.status})"
+            logger.warning("purge history failed in %s: %s", channel, e)
+        await queue.put(None)
+
+    async def _scan(self, channel: Any, prog: ChannelProgress, queue: asyncio.Queue) -> None:
+        """履歴を読み、一括削除用と個別削除用に分けてキューへ流す"""
+        young: list[discord.Message] = []
+        old: list[discord.Message] = []
+        history = channel.history(
+            limit=self.max_scan,
+            after=self.after,
+            before=self.before,
+            oldest_first=self.after is not None,
+        )
+        async for m in history:
+            if prog.error:      # 削除側が止まった
+                break
+            prog.scanned += 1
+            if not self.check(m):
+                continue
+            prog.matched += 1
+            if discord.utils.utcnow() - m.created_at < BULK_WINDOW:
+                young.append(m)
+                if len(young) >= BULK_MAX:
+                    await queue.put(("bulk", young))
+                    young = []
+            else:
+                old.append(m)
+                if len(old) >= BULK_MAX:
+                    await queue.put(("single", old))
+                    old = []
+            if self.limit is not None and prog.matched >= self.limit:
+                break
+            if prog.scanned % 100 == 0:
+                await self._report()
+        if young:
+            await queue.put(("bulk", young))
+        if old:
+            await queue.put(("single", old))
+
+    async def _delete(self, channel: Any, prog: ChannelProgress, queue: asyncio.Queue) -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if prog.error:
+                continue    # 読む側を止めるまでキューを捨てる
+            kind, batch = item
+            try:
+                if kind == "bulk" and len(batch) > 1:
+                    await self._bulk(channel, prog, batch)
+                else:
+                    await self._singles(prog, batch)
+            except discord.Forbidden:
+                prog.error = "削除する権限がありません"
+            except discord.HTTPException as e:
+                prog.failed += len(batch)
+                logger.warning("purge: bulk delete failed in %s: %s", channel, e)
+            await self._report()
+
+    async def _bulk(self, channel: Any, prog: ChannelProgress, batch: list[discord.Message]) -> None:
+        try:
+            await channel.delete_messages(batch, reason=self.reason)
+        except discord.NotFound:
+            # 一部が既に消えていると全体が失敗するので 1 件ずつやり直す
+            await self._singles(prog, batch)
+            return
+        except discord.HTTPException as e:
+            if e.code != MESSAGE_TOO_OLD:
+                raise
+            await self._singles(prog, batch)
+            return
+        prog.bulk += len(batch)
+
+    async def _singles(self, prog: ChannelProgress, batch: list[discord.Message]) -> None:
+        for m in batch:
+            try:
+                await m.delete()
+                prog.single += 1
+            except discord.NotFound:
+                prog.single += 1    # 既に消えている
+            except discord.Forbidden:
+                raise
+            except discord.HTTPException as e:
+                prog.failed += 1
+                logger.warning("purge: failed to delete %s: %s", m.id, e)
+            if prog.single % 10 == 0:
+                await self._report()
+
+    # ── 進捗 ──
+    async def _report(self, force: bool = False) -> None:
+        if self.on_progress is None or self._reporting:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_report < self.report_every:
+            return
+        self._last_report = now
+        self._reporting = True
+        try:
+            await self.on_progress(self.progress)
+        except Exception as e:
+            logger.warning("purge progress update failed: %s", e)
+        finally:
+            self._reporting = False
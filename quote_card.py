@@ -0,0 +1,227 @@
+"""名言カードの描画 (Pillow)
+
+アイコンを左に、本文と名前を右に置いた 1200x630 の画像を作る。
+できあがった PNG だけを合計バイト数の上限つきで覚えておく (層は覚えない。
+RGBA の層は 1 枚あたり数 MB になる)。カードを作ったときに反対の色の PNG も
+裏で作っておくので、カラー / モノクロの切り替えはふつうキャッシュから返せる。
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import io
+import os
+import unicodedata
+import logging
+from dataclasses import dataclass
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+logger = logging.getLogger(__name__)
+
+WIDTH, HEIGHT = 1200, 630
+TEXT_LEFT = 640                 # 本文の左端
+TEXT_RIGHT = WIDTH - 50
+TEXT_TOP, TEXT_BOTTOM = 60, HEIGHT - 150
+MAX_FONT, MIN_FONT = 60, 24
+NAME_FONT, HANDLE_FONT = 30, 24
+
+# 日本語が出るフォントを優先して探す (QUOTE_FONT で上書き可)
+FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansJP-Regular.ttf",
+    "/usr/share/fonts/opentype/ipafont-gothic/ipagp.ttf",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W4.ttc",
+    "C:/Windows/Fonts/meiryo.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+)
+
+
+def find_font(preferred: str | None = None) -> str | None:
+    for path in (preferred, *FONT_CANDIDATES):
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
+@dataclass
+class _Layers:
+    avatar_color: Image.Image
+    avatar_mono: Image.Image
+    text: Image.Image
+
+
+class QuoteCardRenderer:
+    def __init__(self, font_path: str | None = None, max_bytes: int = 32 * 1024 * 1024):
+        """max_bytes: 覚えておく PNG の合計サイズ (0 なら覚えない)"""
+        self.font_path = find_font(font_path)
+        self.max_bytes = max_bytes
+        self._fonts: dict[int, ImageFont.FreeTypeFont] = {}
+        self._pngs: collections.OrderedDict[tuple, bytes] = collections.OrderedDict()
+        self._bytes = 0
+        self._background: set[asyncio.Task] = set()
+        self._fade = self._fade_mask()
+
+    # ── 公開 API ──
+    async def render(
+        self, avatar_key: str, avatar: bytes, text: str, display_name: str, username: str, color: bool
+    ) -> bytes:
+        """カードの PNG を返す。反対の色の PNG も裏で作ってキャッシュしておく"""
+        card = (avatar_key, text, display_name, username)
+        png = self._get((*card, color))
+        if png is not None:
+            return png
+        layers = await asyncio.to_thread(self._build_layers, avatar, text, display_name, username)
+        png = await asyncio.to_thread(self._compose, layers, color)
+        self._put((*card, color), png)
+        if self.max_bytes and (*card, not color) not in self._pngs:
+            task = asyncio.create_task(self._compose_later(layers, (*card, not color)))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        return png
+
+    def cache_bytes(self) -> int:
+        return self._bytes
+
+    # ── キャッシュ ──
+    def _get(self, key: tuple) -> bytes | None:
+        png = self._pngs.get(key)
+        if png is not None:
+            self._pngs.move_to_end(key)
+        return png
+
+    def _put(self, key: tuple, png: bytes) -> None:
+        if len(png) > self.max_bytes:
+            return
+        old = self._pngs.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._pngs[key] = png
+        self._bytes += len(png)
+        while self._bytes > self.max_bytes:
+            _, dropped = self._pngs.popitem(last=False)
+            self._bytes -= len(dropped)
+
+    async def _compose_later(self, layers: _Layers, key: tuple) -> None:
+        try:
+            self._put(key, await asyncio.to_thread(self._compose, layers, key[-1]))
+        except Exception as e:
+            logger.warning("quote card pre-render failed: %s", e)
+
+    # ── 層の作成 ──
+    def _font(self, size: int) -> ImageFont.FreeTypeFont:
+        font = self._fonts.get(size)
+        if font is None:
+            if self.font_path:
+                font = ImageFont.truetype(self.font_path, size)
+            else:
+                font = ImageFont.load_default(size)
+            self._fonts[size] = font
+        return font
+
+    @staticmethod
+    def _fade_mask() -> Image.Image:
+        """アイコンを右へ向かって黒に溶かすためのマスク"""
+        mask = Image.new("L", (HEIGHT, HEIGHT), 255)
+        draw = ImageDraw.Draw(mask)
+        start = HEIGHT // 3
+        for x in range(start, HEIGHT):
+            draw.line([(x, 0), (x, HEIGHT)], fill=int(255 * (HEIGHT - x) / (HEIGHT - start)))
+        return mask
+
+    def _build_layers(self, avatar: bytes, text: str, display_name: str, username: str) -> _Layers:
+        src = Image.open(io.BytesIO(avatar)).convert("RGB")
+        src = ImageOps.fit(src, (HEIGHT, HEIGHT), Image.LANCZOS)
+        color = src.convert("RGBA")
+        color.putalpha(self._fade)
+        mono = ImageOps.grayscale(src).convert("RGBA")
+        mono.putalpha(self._fade)
+        return _Layers(color, mono, self._text_layer(text, display_name, username))
+
+    def _text_layer(self, text: str, display_name: str, username: str) -> Image.Image:
+        layer = Image.new("RGBA", (WIDTH, HEIGHT), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        width = TEXT_RIGHT - TEXT_LEFT
+
+        # 枠に収まる最大の文字サイズを探す
+        size = MAX_FONT
+        while True:
+            font = self._font(size)
+            lines = wrap(text, font, width)
+            line_h = int(size * 1.3)
+            if len(lines) * line_h <= TEXT_BOTTOM - TEXT_TOP or size <= MIN_FONT:
+                break
+            size -= 4
+        max_lines = max(1, (TEXT_BOTTOM - TEXT_TOP) // line_h)
+        if len(lines) > max_lines:
+            lines = lines[:max_lines]
+            lines[-1] = lines[-1].rstrip() + "…"
+
+        y = TEXT_TOP + ((TEXT_BOTTOM - TEXT_TOP) - len(lines) * line_h) // 2
+        cx = (TEXT_LEFT + TEXT_RIGHT) // 2
+        for line in lines:
+            draw.text((cx, y), line, font=font, fill="white", anchor="ma")
+            y += line_h
+
+        name_y = TEXT_BOTTOM + 30
+        draw.text((cx, name_y), f"- {display_name}", font=self._font(NAME_FONT), fill="white", anchor="ma")
+        draw.text((cx, name_y + NAME_FONT + 12), f"@{username}", font=self._font(HANDLE_FONT),
+                  fill=(150, 150, 150), anchor="ma")
+        return layer
+
+    @staticmethod
+    def _compose(layers: _Layers, color: bool) -> bytes:
+        card = Image.new("RGBA", (WIDTH, HEIGHT), "black")
+        card.alpha_composite(layers.avatar_color if color else layers.avatar_mono)
+        card.alpha_composite(layers.text)
+        buf = io.BytesIO()
+        card.convert("RGB").save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def _is_wide(ch: str) -> bool:
+    return unicodedata.east_asian_width(ch) in ("W", "F")
+
+
+def _tokens(text: str) -> list[str]:
+    """英単語はまとめ、全角文字は 1 文字ずつに分ける"""
+    out: list[str] = []
+    word = ""
+    for ch in text:
+        if ch == " " or _is_wide(ch):
+            if word:
+                out.append(word)
+                word = ""
+            out.append(ch)
+        else:
+            word += ch
+    if word:
+        out.append(word)
+    return out
+
+
+def wrap(text: str, font: ImageFont.FreeTypeFont, width: int) -> list[str]:
+    """width ピクセルに収まるように折り返す (改行はそのまま)"""
+    lines: list[str] = []
+    for para in text.splitlines() or [""]:
+        line = ""
+        for token in _tokens(para):
+            candidate = line + token
+            if font.getlength(candidate) <= width:
+                line = candidate
+                continue
+            if line.strip():
+                lines.append(line.rstrip())
+            line = token.lstrip()
+            # 1 単語で幅を超える場合は文字単位で切る
+            while font.getlength(line) > width and len(line) > 1:
+                cut = len(line) - 1
+                while cut > 1 and font.getlength(line[:cut]) > width:
+                    cut -= 1
+                lines.append(line[:cut])
+                line = line[cut:]
+        lines.append(line.rstrip())
+    return lines
@@ -0,0 +1,163 @@
+"""重いコマンド向けのレート制限と同時実行数の上限
+
+ユーザー / ギルド / 全体ごとのトークンバケットで流量を抑え、コマンドごとの
+セマフォで同時実行数を抑える。セマフォが埋まっている間は上限件数まで
+順番待ちさせ、それを超えた分はすぐに断る。
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable
+
+SCOPE_LABELS = {"user": "あなた", "guild": "このサーバー", "global": "Bot 全体"}
+
+
+@dataclass(frozen=True)
+class Rate:
+    """per 秒あたり count 回 (最大 count 回まで連続で使える)"""
+    count: int
+    per: float
+
+
+@dataclass(frozen=True)
+class Limits:
+    user: Rate | None = None
+    guild: Rate | None = None
+    global_: Rate | None = None
+    concurrency: int = 0          # 同時実行数 (0 なら無制限)
+    queue: int = 0                # 同時実行数を超えたときに待たせる件数
+
+
+class RateLimited(Exception):
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"{SCOPE_LABELS.get(scope, scope)}の利用上限に達しました。あと {retry_after:.0f} 秒待ってね。")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Busy(Exception):
+    def __init__(self):
+        super().__init__("混み合っています。少し待ってからもう一度試してね。")
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, rate: Rate):
+        self.capacity = float(rate.count)
+        self.rate = rate.count / rate.per
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, now: float) -> float:
+        """1 トークン取れるまでの秒数 (取れるなら 0)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Gate:
+    """同時実行数の上限と順番待ち"""
+
+    def __init__(self, concurrency: int, queue: int):
+        self.sem = asyncio.Semaphore(concurrency)
+        self.queue = queue
+        self.waiting = 0
+
+    def saturated(self) -> bool:
+        return self.sem.locked() and self.waiting >= self.queue
+
+
+class RateLimiter:
+    # この件数を超えたら満タンのバケットを捨てる
+    PRUNE_AT = 10_000
+
+    def __init__(self) -> None:
+        self._buckets: dict[tuple[str, str, int], TokenBucket] = {}
+        self._gates: dict[str, _Gate] = {}
+        self.rejected: dict[str, int] = {}
+
+    def _scopes(self, name: str, limits: Limits, user_id: int, guild_id: int | None):
+        for scope, rate, key in (
+            ("user", limits.user, user_id),
+            ("guild", limits.guild, guild_id),
+            ("global", limits.global_, 0),
+        ):
+            if rate is None or key is None:
+                continue
+            bucket = self._buckets.get((name, scope, key))
+            if bucket is None:
+                bucket = self._buckets[(name, scope, key)] = TokenBucket(rate)
+            yield scope, bucket
+
+    def check(self, name: str, limits: Limits, user_id: int, guild_id: int | None) -> None:
+        """トークンを消費せずに確認。足りなければ RateLimited / Busy"""
+        now = time.monotonic()
+        for scope, bucket in self._scopes(name, limits, user_id, guild_id):
+            wait = bucket.retry_after(now)
+            if wait > 0:
+                self._reject(name)
+                raise RateLimited(scope, wait)
+        gate = self._gates.get(name)
+        if gate is not None and gate.saturated():
+            self._reject(name)
+            raise Busy()
+
+    def take(self, name: str, limits: Limits, user_id: int, guild_id: int | None) -> None:
+        """全スコープで取れる場合だけトークンを消費する"""
+        self.check(name, limits, user_id, guild_id)
+        for _scope, bucket in self._scopes(name, limits, user_id, guild_id):
+            bucket.take()
+        if len(self._buckets) > self.PRUNE_AT:
+            self._prune()
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self, name: str, limits: Limits, before_wait: Callable[[], Awaitable[None]] | None = None
+    ) -> AsyncIterator[None]:
+        """同時実行数の枠を取る。待ち行列も埋まっていれば Busy
+
+        before_wait は Busy で断らないと決まった後、枠が空くのを待つ前に呼ぶ
+        (スラッシュコマンドの応答保留など)。
+        """
+        if not limits.concurrency:
+            yield
+            return
+        gate = self._gates.get(name)
+        if gate is None:
+            gate = self._gates[name] = _Gate(limits.concurrency, limits.queue)
+        if gate.saturated():
+            self._reject(name)
+            raise Busy()
+        gate.waiting += 1
+        try:
+            if before_wait is not None:
+                await before_wait()
+            await gate.sem.acquire()
+        finally:
+            gate.waiting -= 1
+        try:
+            yield
+        finally:
+            gate.sem.release()
+
+    def _reject(self, name: str) -> None:
+        self.rejected[name] = self.rejected.get(name, 0) + 1
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, b in self._buckets.items() if b.full(now)]:
+            del self._buckets[key]
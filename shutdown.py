@@ -0,0 +1,114 @@
+"""終了処理の補助: 実行中コマンドの待ち合わせと一時メディアの置き場
+
+SIGTERM などで止めるときは、まず ``ShutdownGate.close()`` で新しいコマンドを
+断り、``drain()`` で実行中のものが終わるのを (上限つきで) 待ってから
+状態の保存や切断に進む。
+
+添付ファイルやシーク用の先読みはプロセスごとのディレクトリに置き、
+終了時にまとめて消す。落ちて残ったディレクトリは、持ち主のプロセスが
+もう居なければ次の起動時に消す (Windows では os.kill が確認ではなく
+プロセスの終了になるので、PID は見ずに古さだけで判断する)。
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PREFIX = "yone_media_"
+STALE_MEDIA_AGE = 24 * 3600     # Windows で残ったディレクトリを消すまでの秒数
+
+
+class ShutdownGate:
+    def __init__(self) -> None:
+        self.closing = False
+        self._inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    @contextlib.asynccontextmanager
+    async def track(self) -> AsyncIterator[None]:
+        """この中の処理が終わるまで drain() は待つ"""
+        self._inflight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._idle.set()
+
+    def close(self) -> None:
+        self.closing = True
+
+    async def drain(self, timeout: float) -> int:
+        """実行中の処理が終わるまで最大 timeout 秒待つ。残った件数を返す"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%d command(s) still running after %.0fs; shutting down anyway",
+                           self._inflight, timeout)
+        return self._inflight
+
+
+# ──────────── 一時メディア ────────────
+def _pid_alive(pid: int) -> bool:
+    """シグナル 0 で存在だけ確かめる (POSIX 専用)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sweep_media_dirs(base: str | None = None) -> int:
+    """終了したプロセスの一時メディアディレクトリを消す。消した数を返す"""
+    base = base or tempfile.gettempdir()
+    removed = 0
+    try:
+        names = os.listdir(base)
+    except OSError:
+        return 0
+    for name in names:
+        if not name.startswith(MEDIA_PREFIX):
+            continue
+        pid = name[len(MEDIA_PREFIX):].partition("_")[0]
+        if not pid.isdecimal() or int(pid) == os.getpid():
+            continue
+        path = os.path.join(base, name)
+        if os.name == "nt":
+            try:
+                if time.time() - os.path.getmtime(path) < STALE_MEDIA_AGE:
+                    continue
+            except OSError:
+                continue
+        elif _pid_alive(int(pid)):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    if removed:
+        logger.info("removed %d stale media dir(s)", removed)
+    return removed
+
+
+def make_media_dir(base: str | None = None) -> str:
+    """このプロセス用の一時メディアディレクトリを作る"""
+    sweep_media_dirs(base)
+    return tempfile.mkdtemp(prefix=f"{MEDIA_PREFIX}{os.getpid()}_", dir=base)
+
+
+def remove_media_dir(path: str) -> None:
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,120 @@
+"""起動の高速化: 重いモジュールの遅延読み込みと起動時間の記録
+
+yt_dlp や bs4 のように一部のコマンドでしか使わないモジュールは
+``LazyModule`` で包んでおき、最初に属性を触ったとき (または ``warm()``)
+に読み込む。OpenAI クライアントなども ``LazyObject`` で最初の利用まで
+作らない。
+
+``StartupTimer`` はプロセス開始からの経過時間を節目ごとに記録する
+(モジュール読み込み完了・ゲートウェイ接続完了・最初のコマンド応答など)。
+"""
+from __future__ import annotations
+
+import importlib
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = metrics.Gauge(
+    "bot_startup_seconds", "Seconds from process start to each startup milestone", ("phase",)
+)
+
+
+class LazyModule:
+    """最初に属性を参照したときに import するモジュールの代理"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module: Any = None
+        self.load_seconds: float | None = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self) -> Any:
+        if self._module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)   # 並行して呼ばれても import ロックで 1 回
+            if self._module is None:
+                self.load_seconds = time.perf_counter() - started
+                self._module = module
+                logger.info("loaded %s in %.0f ms", self._name, self.load_seconds * 1000)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.load(), attr)
+
+    def __repr__(self) -> str:
+        return f"<LazyModule {self._name} {'loaded' if self.loaded else 'pending'}>"
+
+
+class LazyObject:
+    """最初に属性を参照したときに factory() で作るオブジェクトの代理"""
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self._name = name
+        self._factory = factory
+        self._obj: Any = None
+        self._lock = threading.Lock()
+        self.load_seconds: float | None = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._obj is not None
+
+    def load(self) -> Any:
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    started = time.perf_counter()
+                    self._obj = self._factory()
+                    self.load_seconds = time.perf_counter() - started
+                    logger.info("initialized %s in %.0f ms", self._name, self.load_seconds * 1000)
+        return self._obj
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.load(), attr)
+
+    def __repr__(self) -> str:
+        return f"<LazyObject {self._name} {'loaded' if self.loaded else 'pending'}>"
+
+
+def warm(*lazies: LazyModule | LazyObject) -> None:
+    """まとめて読み込む (スレッドから呼ぶ)。失敗したものは最初の利用時にもう一度試す"""
+    for lazy in lazies:
+        try:
+            lazy.load()
+        except Exception as e:
+            logger.warning("warm-up of %s failed: %s", lazy._name, e)
+
+
+class StartupTimer:
+    def __init__(self, started: float | None = None):
+        self.started = time.perf_counter() if started is None else started
+        self.marks: dict[str, float] = {}
+
+    def mark(self, phase: str) -> bool:
+        """phase に初めて到達した時刻を記録する。2 回目以降は False"""
+        if phase in self.marks:
+            return False
+        elapsed = time.perf_counter() - self.started
+        self.marks[phase] = elapsed
+        STARTUP_SECONDS.inc(elapsed, phase=phase)
+        logger.info("startup: %s at %.2fs", phase, elapsed)
+        return True
+
+    def report(self, lazies: dict[str, LazyModule | LazyObject] | None = None) -> str:
+        lines = ["startup: " + (" / ".join(f"{p} {t:.2f}s" for p, t in self.marks.items()) or "-")]
+        if lazies:
+            parts = [
+                f"{name} {lazy.load_seconds * 1000:.0f}ms" if lazy.load_seconds is not None else f"{name} -"
+                for name, lazy in lazies.items()
+            ]
+            lines.append("lazy: " + ", ".join(parts))
+        return "\n".join(lines)
@@ -0,0 +1,426 @@
+"""TeX 数式の描画ワーカー
+
+mathtext (matplotlib 内蔵の数式パーサー) で描ける式はこのプロセス内の専用スレッドで
+すぐに描き、amsmath が要る式や mathtext が受け付けない式だけを usetex に回す。
+
+usetex の描画は別プロセスのプールで行い、イベントループと rcParams を共有しない。
+ワーカーは起動時に matplotlib を読み込んで一度描画しておき (LaTeX のフォント
+キャッシュも温まる)、ジョブごとに CPU 時間の上限 (RLIMIT_CPU) を掛ける。
+結果の PNG は式の内容から求めたハッシュ名でディスクに保存し、同じ式は
+プールを通さずに返す。
+"""
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import hashlib
+import importlib.util
+import io
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# 描画方法を変えたら上げる (古いキャッシュを使わないように)
+RENDER_VERSION = 2
+DPI = 300
+PAD = 0.05
+FONT_SIZE = 20
+
+
+class TexError(Exception):
+    """数式を描画できなかった"""
+
+
+class TexTimeout(TexError):
+    """時間または CPU の上限を超えた"""
+
+
+class TexUnavailable(TexError):
+    """matplotlib や latex / dvipng が無い"""
+
+
+class _MathtextUnsupported(TexError):
+    """mathtext では描けない (usetex に回す)"""
+
+
+# mathtext に無い構文 (環境・改行・整列・\text など)
+_NEEDS_USETEX = re.compile(
+    r"\\(?:begin|end|text|intertext|tag|label|substack|DeclareMathOperator"
+    r"|newcommand|renewcommand|def|usepackage)\b|\\\\|&"
+)
+
+
+def needs_usetex(formula: str) -> bool:
+    """明らかに usetex が必要な式か (False でも mathtext が断ることはある)"""
+    return bool(_NEEDS_USETEX.search(formula))
+
+
+# ──────────── mathtext (このプロセス内) ────────────
+_mathtext_parser = None
+# mathtext はサンドボックスの外で動くので、大きい式・深い入れ子は usetex 側に回す
+MATHTEXT_MAX_CHARS = 400
+MATHTEXT_MAX_DEPTH = 12
+
+
+def _nesting_depth(formula: str) -> int:
+    depth = deepest = 0
+    for ch in formula:
+        if ch == "{":
+            depth += 1
+            deepest = max(deepest, depth)
+        elif ch == "}":
+            depth -= 1
+    return deepest
+
+
+def draw_mathtext(formula: str) -> bytes:
+    """mathtext で描画して PNG を返す。対応していなければ _MathtextUnsupported
+
+    pyplot も rcParams も使わないので、専用スレッドから呼んでよい。
+    """
+    global _mathtext_parser
+    if len(formula) > MATHTEXT_MAX_CHARS or _nesting_depth(formula) > MATHTEXT_MAX_DEPTH:
+        raise _MathtextUnsupported("formula too large for mathtext")
+    from matplotlib.figure import Figure
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.mathtext import MathTextParser
+
+    if _mathtext_parser is None:
+        _mathtext_parser = MathTextParser("path")
+    s = f"${formula}$"
+    prop = FontProperties(size=FONT_SIZE, math_fontfamily="cm")
+    try:
+        width, height, depth, _, _ = _mathtext_parser.parse(s, dpi=72, prop=prop)
+    except (ValueError, RecursionError) as e:
+        raise _MathtextUnsupported(str(e) or type(e).__name__) from None
+    if not width or not height:
+        raise _MathtextUnsupported("empty formula")
+    # usetex 版と同じく周囲に PAD 分の余白を付ける
+    fig = Figure(figsize=(width * (1 + PAD) / 72, height * (1 + PAD) / 72))
+    fig.text(
+        PAD / 2 / (1 + PAD),
+        (depth + height * PAD / 2) / (height * (1 + PAD)),
+        s, fontproperties=prop,
+    )
+    buf = io.BytesIO()
+    try:
+        fig.savefig(buf, format="png", dpi=DPI, transparent=True)
+    except (ValueError, RecursionError) as e:
+        raise _MathtextUnsupported(str(e) or type(e).__name__) from None
+    return buf.getvalue()
+
+
+# ──────────── ワーカープロセス側 ────────────
+_plt = None
+_cpu_seconds = 0
+
+
+def _init_worker(cpu_seconds: int) -> None:
+    global _plt, _cpu_seconds
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    # rcParams はこのプロセスだけのもの
+    plt.rcParams.update({
+        "text.usetex": True,
+        "font.family": "serif",
+        "text.latex.preamble": r"\usepackage{amsmath}",
+    })
+    _plt = plt
+    _cpu_seconds = cpu_seconds
+    try:
+        _draw("x")
+    except Exception:
+        # 温めに失敗しても本番のジョブで改めてエラーを返す
+        pass
+
+
+def _limit_cpu() -> None:
+    """このジョブで使える CPU 時間を _cpu_seconds 秒に制限する
+
+    RLIMIT_CPU はプロセスの累積時間に掛かるので、今までの使用量に足して設定する。
+    超えると SIGXCPU でワーカーが落ち、親には BrokenProcessPool として見える。
+    """
+    if resource is None or not _cpu_seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+    _soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = used + _cpu_seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _draw(formula: str) -> bytes:
+    plt = _plt
+    fig = plt.figure(dpi=DPI)
+    try:
+        text = fig.text(0, 0, f"${formula}$", fontsize=FONT_SIZE, ha="left", va="bottom")
+        # 余白を抑えるため一度描画し、テキストの bbox からキャンバスサイズを求める
+        fig.canvas.draw()
+        bbox = text.get_window_extent()
+        width, height = bbox.width / DPI, bbox.height / DPI
+        fig.set_size_inches(width * (1 + PAD), height * (1 + PAD))
+        text.set_position((PAD / 2, PAD / 2))
+        text.set_transform(fig.transFigure)
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=DPI, transparent=True, pad_inches=0.05)
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def _render_job(formula: str) -> bytes:
+    _limit_cpu()
+    try:
+        return _draw(formula)
+    except Exception as e:
+        # 例外の型は親で import できないことがあるので文字列にして返す
+        raise RuntimeError(str(e)) from None
+
+
+# ──────────── 親プロセス側 ────────────
+class TexRenderer:
+    """ワーカープールと PNG キャッシュ"""
+
+    def __init__(
+        self,
+        cache_dir: str,
+        workers: int = 2,
+        cpu_seconds: int = 10,
+        timeout: float = 20.0,
+        cache_max_files: int = 2000,
+    ):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.timeout = timeout
+        self.cache_max_files = cache_max_files
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+        self._mathtext = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="mathtext")
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.fast = 0      # mathtext で描いた数
+        self.slow = 0      # usetex で描いた数
+
+    # ── プール ──
+    def start(self) -> None:
+        """プールを作り、全ワーカーを先に起動しておく"""
+        if self._pool is not None:
+            return
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.cpu_seconds,),
+        )
+        for _ in range(self.workers):
+            self._pool.submit(os.getpid)
+
+    def _reset(self) -> None:
+        """止まったワーカーを殺してプールを作り直す"""
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            for proc in list(getattr(pool, "_processes", {}).values()):
+                try:
+                    proc.kill()
+                except Exception:
+                    pass
+            # 残りのジョブは BrokenProcessPool で失敗し、呼び出し側でやり直す
+            pool.shutdown(wait=False)
+        self.start()
+
+    def _reset_mathtext(self) -> None:
+        """詰まった mathtext スレッドを切り離し、新しいスレッドで受け付ける"""
+        old = self._mathtext
+        self._mathtext = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="mathtext")
+        # 後ろで待っていたジョブは取り消し、_render_mathtext が新しい方に出し直す
+        old.shutdown(wait=False, cancel_futures=True)
+
+    async def warm(self) -> None:
+        """mathtext 用スレッドで matplotlib を読み込み、一度描いておく"""
+        if importlib.util.find_spec("matplotlib") is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._mathtext, draw_mathtext, "x")
+        except Exception as e:
+            logger.warning("mathtext warm-up failed: %s", e)
+
+    def shutdown(self) -> None:
+        self._mathtext.shutdown(wait=False)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    # ── キャッシュ ──
+    def cache_key(self, formula: str, mode: str = "usetex") -> str:
+        raw = f"{RENDER_VERSION}\0{mode}\0{DPI}\0{formula}".encode()
+        return hashlib.sha256(raw).hexdigest()
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.png")
+
+    def _read_cache(self, key: str) -> bytes | None:
+        path = self._cache_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)  # 最近使ったものを残す
+        except OSError:
+            pass
+        return data
+
+    def _write_cache(self, key: str, data: bytes) -> None:
+        path = self._cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"  # 複数プロセスで同じ一時ファイルを使わない
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._prune_cache()
+
+    def _prune_cache(self) -> None:
+        entries = []
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        if len(entries) <= self.cache_max_files:
+            return
+        entries.sort()
+        for _mtime, path in entries[: len(entries) - self.cache_max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # ── 描画 ──
+    @staticmethod
+    def available() -> str | None:
+        """描画できない理由 (できるなら None)"""
+        if importlib.util.find_spec("matplotlib") is None:
+            return "matplotlib モジュールが見つかりません。`pip install matplotlib` を実行してください。"
+        if not shutil.which("latex") or not shutil.which("dvipng"):
+            return "LaTeX 環境 (latex, dvipng) が見つかりません。インストールしてください。"
+        return None
+
+    async def render(self, formula: str) -> bytes:
+        """数式を PNG にして返す (mathtext で描ければそちらを使う)"""
+        mathtext_error: TexError | None = None
+        if not needs_usetex(formula):
+            try:
+                return await self._cached(self.cache_key(formula, "mathtext"), self._render_mathtext, formula)
+            except (_MathtextUnsupported, TexTimeout) as e:
+                mathtext_error = e
+        if mathtext_error is not None and self.available():
+            # usetex が使えないなら mathtext のエラーをそのまま返す (時間切れは TexTimeout のまま)
+            if isinstance(mathtext_error, TexTimeout):
+                raise mathtext_error
+            raise TexError(str(mathtext_error))
+        return await self._cached(self.cache_key(formula, "usetex"), self._render_in_pool, formula)
+
+    async def _render_mathtext(self, formula: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        executor = self._mathtext
+        started: list[bool] = []
+
+        def job_fn() -> bytes:
+            started.append(True)
+            return draw_mathtext(formula)
+
+        job = loop.run_in_executor(executor, job_fn)
+        try:
+            # wait_for と違い、executor 側で取り消されても例外にならない
+            await asyncio.wait({job}, timeout=self.timeout)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        if not job.done() or (job.cancelled() and not started):
+            job.cancel()
+            # スレッドは止められないので、そのスレッドは見捨てて新しい executor に替える
+            # (替えないと後続の式がすべて詰まったスレッドの後ろで待たされる)
+            if executor is self._mathtext:
+                self._reset_mathtext()
+            if not started:
+                # 詰まったスレッドの後ろで待っていただけ: 新しい方でやり直す
+                return await self._render_mathtext(formula)
+            logger.warning("mathtext render timed out after %.0fs: %.80s", self.timeout, formula)
+            raise TexTimeout(f"{self.timeout:.0f} 秒以内に描画できませんでした")
+        data = job.result()
+        self.fast += 1
+        return data
+
+    async def _cached(self, key: str, produce, formula: str) -> bytes:
+        """キャッシュを引き、無ければ produce(formula)。同じ式の同時要求は 1 回にまとめる"""
+        data = await asyncio.to_thread(self._read_cache, key)
+        if data is not None:
+            self.hits += 1
+            return data
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            data = await produce(formula)
+            await asyncio.to_thread(self._write_cache, key, data)
+            fut.set_result(data)
+            return data
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # 待っている人がいなくても警告を出さない
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _render_in_pool(self, formula: str, retry: bool = True) -> bytes:
+        reason = self.available()
+        if reason:
+            raise TexUnavailable(reason)
+        self.start()
+        loop = asyncio.get_running_loop()
+        job = loop.run_in_executor(self._pool, _render_job, formula)
+        try:
+            data = await asyncio.wait_for(job, self.timeout)
+            self.slow += 1
+            return data
+        except asyncio.TimeoutError:
+            logger.warning("TeX render timed out after %.0fs: %.80s", self.timeout, formula)
+            self._reset()
+            raise TexTimeout(f"{self.timeout:.0f} 秒以内に描画できませんでした") from None
+        except BrokenProcessPool:
+            self._reset()
+            if retry:
+                # 他のジョブの巻き添えかもしれないので 1 回だけやり直す
+                return await self._render_in_pool(formula, retry=False)
+            raise TexTimeout("CPU 時間の上限を超えました") from None
+        except RuntimeError as e:
+            err = str(e)
+            if "latex could not be found" in err or "dvipng was not found" in err:
+                raise TexUnavailable("LaTeX 環境 (latex, dvipng) が見つかりません。インストールしてください。") from None
+            raise TexError(err) from None
@@ -0,0 +1,84 @@
+"""スラッシュコマンドの同期を、定義が変わったときだけ行う
+
+``tree.sync()`` はグローバルな REST 呼び出しで、それ自体にレートリミットがある。
+登録済みコマンドの定義 (Discord に送る JSON) のハッシュをファイルに
+残しておき、前回同期したときと同じなら呼ばない。ゲートウェイの再接続で
+on_ready が何度呼ばれても REST は発生しない。
+
+開発用に guild を渡すと、グローバルコマンドをそのギルドへコピーして
+ギルド単位で同期する (反映が即時)。強制的に同期し直したいときは
+記録ファイルを消すか ``force=True`` を渡す。
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any
+
+import discord
+from discord import app_commands
+
+logger = logging.getLogger(__name__)
+
+
+def _command_dict(command: Any, tree: app_commands.CommandTree) -> dict:
+    try:
+        return command.to_dict(tree)
+    except TypeError:       # tree を取らない古い discord.py
+        return command.to_dict()
+
+
+def fingerprint(tree: app_commands.CommandTree, guild: discord.abc.Snowflake | None = None) -> str:
+    """guild (None ならグローバル) に同期されるコマンド定義のハッシュ"""
+    payload = sorted(
+        (_command_dict(c, tree) for c in tree.get_commands(guild=guild)),
+        key=lambda d: (d.get("type", 1), d["name"]),
+    )
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class TreeSyncer:
+    def __init__(self, tree: app_commands.CommandTree, path: str):
+        self.tree = tree
+        self.path = path
+
+    def _load(self) -> dict[str, str]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, data: dict[str, str]) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def _key(self, guild: discord.abc.Snowflake | None) -> str:
+        app_id = self.tree.client.application_id or 0
+        return f"{app_id}:{'global' if guild is None else f'guild:{guild.id}'}"
+
+    async def sync(self, guild: discord.abc.Snowflake | None = None, *, force: bool = False) -> bool:
+        """定義が前回と違えば同期して True。同じなら何もしないで False"""
+        if guild is not None:
+            self.tree.copy_global_to(guild=guild)
+        digest = fingerprint(self.tree, guild)
+        key = self._key(guild)
+        stored = self._load()
+        if not force and stored.get(key) == digest:
+            logger.info("slash commands unchanged (%s); skipping sync", key)
+            return False
+        synced = await self.tree.sync(guild=guild)
+        logger.info("synced %d slash commands (%s)", len(synced), key)
+        stored = self._load()    # 他のプロセスが書いた分を消さないよう読み直す
+        stored[key] = digest
+        try:
+            self._save(stored)
+        except OSError as e:
+            logger.warning("could not save command fingerprint: %s", e)
+        return True
@@ -0,0 +1,175 @@
+"""ボイス接続の管理
+
+ギルドごとのロック、同時ハンドシェイク数の上限、再接続の待ち時間と
+サーキットブレーカー、接続時間の統計をまとめて扱う。
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class VoiceCircuitOpen(Exception):
+    """このギルドへの接続は一時的に止められている"""
+
+    def __init__(self, guild_id: int, retry_after: float):
+        super().__init__(f"voice circuit open for guild {guild_id} ({retry_after:.0f}s)")
+        self.guild_id = guild_id
+        self.retry_after = retry_after
+
+
+@dataclass
+class ReconnectPolicy:
+    """再接続の待ち時間と遮断条件"""
+    base: float = 1.0              # 初回の待ち時間の上限 (秒)
+    cap: float = 60.0              # 待ち時間の上限 (秒)
+    failure_threshold: int = 5     # window 秒以内にこれだけ失敗したら遮断
+    window: float = 300.0
+    cooldown: float = 60.0         # 遮断する秒数
+
+    def delay(self, attempt: int) -> float:
+        """指数バックオフ (full jitter)"""
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+@dataclass
+class _GuildVoice:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    failures: collections.deque[float] = field(default_factory=collections.deque)
+    attempt: int = 0
+    open_until: float = 0.0
+
+
+class VoiceManager:
+    """ギルド単位でボイス接続を直列化し、全体の同時接続数を抑える"""
+
+    def __init__(self, policy: ReconnectPolicy | None = None, max_handshakes: int = 4):
+        self.policy = policy or ReconnectPolicy()
+        self._handshakes = asyncio.Semaphore(max_handshakes)
+        self._guilds: dict[int, _GuildVoice] = {}
+        # 統計
+        self.connect_latency: collections.deque[float] = collections.deque(maxlen=200)
+        self.connects = 0
+        self.connect_failures = 0
+        self.reconnects = 0
+        self.circuit_trips = 0
+
+    def _state(self, guild_id: int) -> _GuildVoice:
+        st = self._guilds.get(guild_id)
+        if st is None:
+            st = self._guilds[guild_id] = _GuildVoice()
+        return st
+
+    def lock(self, guild_id: int) -> asyncio.Lock:
+        return self._state(guild_id).lock
+
+    # ── サーキットブレーカー ──
+    def retry_after(self, guild_id: int) -> float:
+        """遮断中なら残り秒数、そうでなければ 0"""
+        st = self._guilds.get(guild_id)
+        if st is None:
+            return 0.0
+        return max(0.0, st.open_until - time.monotonic())
+
+    def trip(self, guild_id: int, duration: float | None = None) -> None:
+        """このギルドへの接続を duration 秒止める"""
+        st = self._state(guild_id)
+        st.open_until = time.monotonic() + (duration if duration is not None else self.policy.cooldown)
+        self.circuit_trips += 1
+
+    def record_failure(self, guild_id: int) -> None:
+        st = self._state(guild_id)
+        now = time.monotonic()
+        st.failures.append(now)
+        while st.failures and now - st.failures[0] > self.policy.window:
+            st.failures.popleft()
+        if len(st.failures) >= self.policy.failure_threshold and self.retry_after(guild_id) == 0:
+            logger.warning(
+                "voice reconnect storm in guild %s: %d failures in %.0fs, pausing for %.0fs",
+                guild_id, len(st.failures), self.policy.window, self.policy.cooldown,
+            )
+            st.failures.clear()
+            self.trip(guild_id)
+
+    def record_success(self, guild_id: int) -> None:
+        self._state(guild_id).attempt = 0
+
+    def next_reconnect_delay(self, guild_id: int) -> float | None:
+        """切断後、次に再接続するまでの秒数。遮断中なら None"""
+        self.reconnects += 1
+        self.record_failure(guild_id)
+        if self.retry_after(guild_id) > 0:
+            return None
+        st = self._state(guild_id)
+        delay = self.policy.delay(st.attempt)
+        st.attempt += 1
+        return delay
+
+    # ── 接続 ──
+    @contextlib.asynccontextmanager
+    async def handshake(self, guild_id: int, count_failure: bool = True) -> AsyncIterator[None]:
+        """同時ハンドシェイク数の枠を取り、所要時間と成否を記録する
+
+        再接続では next_reconnect_delay() が失敗を数えるので count_failure=False で呼ぶ。
+        キャンセル (終了処理など) は失敗に数えない。
+        """
+        async with self._handshakes:
+            started = time.perf_counter()
+            try:
+                yield
+            except asyncio.CancelledError:
+                raise
+            except BaseException:
+                self.connect_failures += 1
+                if count_failure:
+                    self.record_failure(guild_id)
+                raise
+            self.connects += 1
+            self.connect_latency.append(time.perf_counter() - started)
+            self.record_success(guild_id)
+
+    async def connect(
+        self,
+        guild_id: int,
+        factory: Callable[[], Awaitable[T]],
+        timeout: float,
+        existing: Callable[[], T | None] | None = None,
+    ) -> T:
+        """ギルドのロックとハンドシェイク枠を取って factory() を実行
+
+        ``existing`` はロック取得後に呼ばれ、既に接続済みならその値を返す。
+        """
+        retry = self.retry_after(guild_id)
+        if retry > 0:
+            raise VoiceCircuitOpen(guild_id, retry)
+        async with self.lock(guild_id):
+            if existing is not None and (current := existing()) is not None:
+                return current
+            async with self.handshake(guild_id):
+                return await asyncio.wait_for(factory(), timeout)
+
+    def stats(self) -> dict:
+        lat = sorted(self.connect_latency)
+
+        def pct(p: float) -> float:
+            return lat[min(len(lat) - 1, int(len(lat) * p))] if lat else 0.0
+
+        return {
+            "connects": self.connects,
+            "connect_failures": self.connect_failures,
+            "reconnects": self.reconnects,
+            "circuit_trips": self.circuit_trips,
+            "open_circuits": [g for g in self._guilds if self.retry_after(g) > 0],
+            "connect_p50": pct(0.5),
+            "connect_p95": pct(0.95),
+        }